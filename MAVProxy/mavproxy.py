@@ -20,6 +20,7 @@ from MAVProxy.modules.lib import textconsole
 from MAVProxy.modules.lib import rline
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import dumpstacks
+from MAVProxy.modules.lib import mp_command
 
 # adding all this allows pyinstaller to build a working windows executable
 # note that using --hidden-import does not work for these modules
@@ -190,6 +191,10 @@ class MPState(object):
         self.sitl_output = None
 
         self.mav_param = mavparm.MAVParmDict()
+
+        # COMMAND_LONG transactions awaiting COMMAND_ACK
+        self.command_manager = mp_command.CommandManager(self)
+
         self.modules = []
         self.public_modules = {}
         self.functions = MAVFunctions()
@@ -573,6 +578,10 @@ def process_master(m):
                 if opts.show_errors:
                     mpstate.console.writeln("MAV error: %s" % msg)
                 mpstate.status.mav_error += 1
+        # deliver this chunk of packets to modules that take batches
+        link = mpstate.module('link')
+        if link is not None:
+            link.flush_packet_batch()
 
 
 
@@ -761,6 +770,9 @@ def periodic_tasks():
 
     set_stream_rates()
 
+    # retry or time out unacknowledged commands
+    mpstate.command_manager.check()
+
     # call optional module idle tasks. These are called at several hundred Hz
     for (m,pm) in mpstate.modules:
         if hasattr(m, 'idle_task'):
@@ -26,6 +26,7 @@ class Graph_UI(object):
 	    self.mg.set_linestyle(self.mestate.settings.linestyle)
 	    self.mg.set_show_flightmode(self.mestate.settings.show_flightmode)
 	    self.mg.set_legend(self.mestate.settings.legend)
+	    self.mg.set_cache(getattr(self.mestate, 'series_cache', None))
 	    self.mg.add_mav(self.mestate.mlog)
 	    for f in graphdef.expression.split():
 	        self.mg.add_field(f)
@@ -37,6 +38,7 @@ class Graph_UI(object):
 	    #To avoid slowdowns in Windows (which copies the vars to the new process)
 	    #We need to empty this var when we're finished with it
 	    self.mg.mav_list = []
+	    self.mg.cache = None
 	    child = Process(target=self.mg.show, args=[self.lenmavlist, ])
 	    child.start()
 	    self.mestate.mlog.rewind()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+'''
+cache of evaluated graph series
+
+SeriesCache keeps the (x, y) values a graph field evaluated to over a
+log, keyed by the log, the expression and everything else that changes
+the values: condition, x axis, flight mode selections and timeshift.
+Opening the same graph again, or another graph sharing some of its
+fields, takes the series from the cache instead of going through the
+log. The least recently used series are dropped to keep the cache
+under a memory limit.
+
+Entries hold a weak reference to their log, so a series is never given
+for a different log that happens to be at the same address, and are
+dropped if the log has been reduced by flight modes since.
+
+Run this file directly with a log and graph fields to time graphing
+them with and without the cache.
+'''
+
+import weakref
+from collections import OrderedDict
+import numpy
+
+def value_nbytes(value):
+    '''approximate memory used by a cached value'''
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        if len(value) > 0 and isinstance(value[0], (tuple, list, numpy.ndarray)):
+            return sum([value_nbytes(v) for v in value])
+        # a python object and a pointer to it for each element
+        return 32 * len(value)
+    return 32
+
+class SeriesCache(object):
+    '''LRU cache of graph series holding at most max_bytes'''
+    def __init__(self, max_bytes=256*1024*1024):
+        self.max_bytes = max_bytes
+        # key -> (log reference, log masks, value, nbytes), oldest first
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, mlog, key):
+        '''the value cached for key over a log, or None'''
+        k = (id(mlog),) + tuple(key)
+        e = self.entries.get(k, None)
+        if e is not None and (e[0]() is not mlog or e[1] is not getattr(mlog, '_masks', None)):
+            # a different log, or the same one since reduced by flight modes
+            self.remove(k)
+            e = None
+        if e is None:
+            self.misses += 1
+            return None
+        # move to the newest end
+        del self.entries[k]
+        self.entries[k] = e
+        self.hits += 1
+        return e[2]
+
+    def put(self, mlog, key, value):
+        '''cache a value for key over a log, dropping the least recently
+        used values to stay under max_bytes'''
+        k = (id(mlog),) + tuple(key)
+        nbytes = value_nbytes(value)
+        if k in self.entries:
+            self.remove(k)
+        if nbytes > self.max_bytes:
+            return
+        while self.nbytes + nbytes > self.max_bytes and len(self.entries) > 0:
+            self.remove(next(iter(self.entries)))
+        self.entries[k] = (weakref.ref(mlog), getattr(mlog, '_masks', None), value, nbytes)
+        self.nbytes += nbytes
+
+    def remove(self, k):
+        e = self.entries.pop(k)
+        self.nbytes -= e[3]
+
+    def clear(self):
+        '''empty the cache'''
+        self.entries.clear()
+        self.nbytes = 0
+
+
+if __name__ == "__main__":
+    import time
+    from optparse import OptionParser
+    parser = OptionParser("graphcache.py [options] <LOG> <FIELD...>")
+    parser.add_option("--condition", default=None, help="select packets by a condition")
+    (opts, args) = parser.parse_args()
+    if len(args) < 2:
+        print("Usage: graphcache.py [options] <LOG> <FIELD...>")
+        raise SystemExit(1)
+    from MAVProxy.modules.lib import mavcolumnlog, grapher
+    mlog = mavcolumnlog.load(args[0])
+    cache = SeriesCache()
+
+    def graph(fields):
+        mg = grapher.MavGraph()
+        mg.set_cache(cache)
+        mg.set_condition(opts.condition)
+        mg.add_mav(mlog)
+        for f in fields:
+            mg.add_field(f)
+        t0 = time.time()
+        mg.process([], mlog._flightmodes)
+        return (time.time() - t0, sum([len(x) for x in mg.x]))
+
+    for name in ['first', 'cached']:
+        (t, n) = graph(args[1:])
+        print("%s: %u points in %.4fs" % (name, n, t))
+    (t, n) = graph(args[1:2])
+    print("one field again: %u points in %.4fs" % (n, t))
+    print("%u series, %.1fMB, %u hits, %u misses" % (
+        len(cache.entries), cache.nbytes/(1024.0*1024), cache.hits, cache.misses))
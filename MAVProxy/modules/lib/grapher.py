@@ -11,7 +11,17 @@ import matplotlib
 from math import *
 from pymavlink.mavextra import *
 import pylab
+import numpy
 from pymavlink import mavutil
+from MAVProxy.modules.lib import mavcolumnexpr
+from MAVProxy.modules.lib.mp_decimate import MinMaxPyramid
+
+def series_array(values):
+    '''a list of graph values as an array, if they are numbers'''
+    a = numpy.asarray(values)
+    if a.ndim == 1 and a.dtype.kind in 'biuf':
+        return a
+    return list(values)
 
 colors = [ 'red', 'green', 'blue', 'orange', 'olive', 'black', 'grey', 'yellow', 'brown', 'darkcyan',
            'cornflowerblue', 'darkmagenta', 'deeppink', 'darkred']
@@ -38,6 +48,9 @@ flightmode_colours = [
 
 edge_colour = (0.1, 0.1, 0.1)
 
+# lines with more points than this are drawn decimated to the view
+decimate_points = 20000
+
 class MavGraph(object):
     def __init__(self):
         self.lowest_x = None
@@ -60,6 +73,9 @@ class MavGraph(object):
         self.flightmode_colourmap = {}
         self.ax1 = None
         self.locator = None
+        # (axes, line, MinMaxPyramid) of lines drawn decimated
+        self.decimated = []
+        self.cache = None
 
     def add_field(self, field):
         '''add another field to plot'''
@@ -105,6 +121,10 @@ class MavGraph(object):
         '''set multiple graph option'''
         self.multi = multi
 
+    def set_cache(self, cache):
+        '''set a graphcache.SeriesCache to keep evaluated series in'''
+        self.cache = cache
+
     def make_format(self, current, other):
         # current and other are axes
         def format_coord(x, y):
@@ -155,6 +175,37 @@ class MavGraph(object):
         '''called when x limits are changed'''
         xrange = axsubplot.get_xbound()
         self.setup_xrange(xrange[1] - xrange[0])
+        self.redecimate(xrange)
+
+    def redecimate(self, xrange):
+        '''redraw decimated lines for a new x range'''
+        for (ax, line, pyramid) in self.decimated:
+            (x, y) = pyramid.view(xrange[0], xrange[1], ax.bbox.width)
+            line.set_data(x, y)
+
+    def plot_decimated(self, ax, x, y, **kwargs):
+        '''plot a line against date, decimated to the view if it has
+        many points. Lines against an xaxis expression are never
+        decimated, as nothing redraws them when zoomed'''
+        if len(x) <= decimate_points or self.xaxis:
+            return ax.plot_date(x, y, **kwargs)
+        try:
+            if not numpy.all(numpy.diff(numpy.asarray(x, dtype=numpy.float64)) >= 0):
+                # several logs in one line, or time jumping back in a log,
+                # which the pyramid can't look up by x
+                return ax.plot_date(x, y, **kwargs)
+            pyramid = MinMaxPyramid(x, y)
+        except (TypeError, ValueError):
+            # values that aren't numbers
+            return ax.plot_date(x, y, **kwargs)
+        (vx, vy) = pyramid.view(pyramid.x[0], pyramid.x[-1], ax.bbox.width)
+        lines = ax.plot_date(vx, vy, **kwargs)
+        # autoscale to the whole line, not just the points drawn
+        ax.update_datalim(numpy.column_stack(([pyramid.x[0], pyramid.x[-1]],
+                                              [numpy.nanmin(pyramid.y), numpy.nanmax(pyramid.y)])))
+        ax.autoscale_view()
+        self.decimated.append((ax, lines[0], pyramid))
+        return lines
 
     def plotit(self, x, y, fields, colors=[]):
         '''plot a set of graphs using date for x axis'''
@@ -193,6 +244,8 @@ class MavGraph(object):
                 if ax2 is None:
                     ax2 = self.ax1.twinx()
                     ax2.format_coord = self.make_format(ax2, self.ax1)
+                    if not self.xaxis:
+                        ax2.callbacks.connect('xlim_changed', self.xlim_changed)
                 ax = ax2
                 if not self.xaxis:
                     ax2.xaxis.set_major_locator(self.locator)
@@ -252,8 +305,8 @@ class MavGraph(object):
                                 alpha=0.3,
                                 verticalalignment='baseline')
                 else:
-                    ax.plot_date(x[i], y[i], color=color, label=fields[i],
-                             linestyle=linestyle, marker=marker, tz=None)
+                    self.plot_decimated(ax, x[i], y[i], color=color, label=fields[i],
+                                        linestyle=linestyle, marker=marker, tz=None)
 
             empty = False
             
@@ -323,6 +376,92 @@ class MavGraph(object):
 
     def process_mav(self, mlog, timeshift, flightmode_selections, _flightmodes):
         '''process one file'''
+        if self.cache is not None and self.process_cached(mlog, timeshift, flightmode_selections):
+            return
+        start = [len(x) for x in self.x]
+        nmodes = len(self.modes)
+        self.evaluate_mav(mlog, timeshift, flightmode_selections, _flightmodes)
+        if self.cache is not None:
+            for i in range(len(self.fields)):
+                self.cache.put(mlog, self.series_key(i, timeshift, flightmode_selections),
+                               (series_array(self.x[i][start[i]:]), series_array(self.y[i][start[i]:])))
+            if self.show_flightmode:
+                self.cache.put(mlog, self.modes_key(timeshift, flightmode_selections), self.modes[nmodes:])
+
+    def series_key(self, i, timeshift, flightmode_selections):
+        '''cache key of the values of field i'''
+        if True not in flightmode_selections:
+            # all false means all modes
+            flightmode_selections = []
+        return ('series', self.parse_field(i), self.condition, self.xaxis,
+                tuple(flightmode_selections), timeshift)
+
+    def modes_key(self, timeshift, flightmode_selections):
+        '''cache key of the flight mode changes'''
+        if True not in flightmode_selections:
+            flightmode_selections = []
+        return ('modes', tuple(sorted(self.msg_types)), self.condition,
+                tuple(flightmode_selections), timeshift)
+
+    def process_cached(self, mlog, timeshift, flightmode_selections):
+        '''add the values of all fields from the cache, returning False,
+        having added nothing, if any aren't cached'''
+        series = [self.cache.get(mlog, self.series_key(i, timeshift, flightmode_selections))
+                  for i in range(len(self.fields))]
+        if None in series:
+            return False
+        modes = []
+        if self.show_flightmode:
+            key = self.modes_key(timeshift, flightmode_selections)
+            modes = self.cache.get(mlog, key)
+            if modes is None and hasattr(mlog, 'column'):
+                # cached fields graphed together for the first time
+                try:
+                    modes = self.column_modes(mlog, timeshift, flightmode_selections)
+                except mavcolumnexpr.Unvectorisable:
+                    return False
+                self.cache.put(mlog, key, modes)
+            if modes is None:
+                return False
+        for i in range(len(self.fields)):
+            (x, y) = series[i]
+            self.add_series(i, x, y)
+        self.add_modes(modes)
+        return True
+
+    def parse_field(self, i):
+        '''the expression of field i, setting its axis and first only
+        flags from its suffix'''
+        f = self.fields[i]
+        if f.endswith(":2"):
+            self.axes[i] = 2
+            f = f[:-2]
+        if f.endswith(":1"):
+            self.first_only[i] = True
+            f = f[:-2]
+        return f
+
+    def add_series(self, i, x, y):
+        '''add arrays or lists of values to field i'''
+        if len(self.x[i]) == 0:
+            self.x[i] = x
+            self.y[i] = y
+        elif isinstance(self.x[i], numpy.ndarray) and isinstance(x, numpy.ndarray) and \
+                isinstance(self.y[i], numpy.ndarray) and isinstance(y, numpy.ndarray):
+            self.x[i] = numpy.concatenate((self.x[i], x))
+            self.y[i] = numpy.concatenate((self.y[i], y))
+        else:
+            self.x[i] = list(self.x[i]) + list(x)
+            self.y[i] = list(self.y[i]) + list(y)
+
+    def evaluate_mav(self, mlog, timeshift, flightmode_selections, _flightmodes):
+        '''evaluate the fields over one file'''
+        if hasattr(mlog, 'column') and self.process_columns(mlog, timeshift, flightmode_selections):
+            return
+        for i in range(len(self.x)):
+            # add_data appends to lists
+            self.x[i] = list(self.x[i])
+            self.y[i] = list(self.y[i])
         self.vars = {}
         idx = 0
         all_false = True
@@ -353,6 +492,82 @@ class MavGraph(object):
                 elif (idx < len(flightmode_selections) and flightmode_selections[idx]):
                     self.add_data(tdays, msg, mlog.messages, mlog.flightmode)
 
+    def process_columns(self, mlog, timeshift, flightmode_selections):
+        '''process a columnar log with array operations. Returns False,
+        having added nothing, for graphs that can't be done this way'''
+        try:
+            xaxis = None
+            if self.xaxis is not None:
+                xaxis = mavcolumnexpr.ColumnExpression(self.xaxis)
+            results = []
+            for i in range(len(self.fields)):
+                f = self.parse_field(i)
+                (pos, t) = self.column_samples(mlog, self.field_types[i], flightmode_selections)
+                (v, valid) = mavcolumnexpr.ColumnExpression(f).evaluate(mlog, pos)
+                if v.dtype.kind not in 'biuf':
+                    # text and objects are graphed a message at a time
+                    return False
+                if xaxis is None:
+                    x = self.date_numbers(t[valid] + timeshift)
+                else:
+                    (xv, xvalid) = xaxis.evaluate(mlog, pos)
+                    if xv.dtype.kind not in 'biuf':
+                        return False
+                    valid &= xvalid
+                    x = xv[valid]
+                results.append((x, v[valid]))
+            modes = []
+            if self.show_flightmode:
+                modes = self.column_modes(mlog, timeshift, flightmode_selections)
+        except mavcolumnexpr.Unvectorisable:
+            return False
+
+        for i in range(len(self.fields)):
+            (x, y) = results[i]
+            self.add_series(i, x, y)
+        self.add_modes(modes)
+        return True
+
+    def column_samples(self, mlog, mtypes, flightmode_selections):
+        '''positions and timestamps of the messages of some types in a
+        columnar log that the condition and flightmode selections keep'''
+        (pos, t) = mavcolumnexpr.sample_positions(mlog, mtypes)
+        keep = numpy.ones(len(pos), dtype=bool)
+        if self.condition:
+            (v, valid) = mavcolumnexpr.ColumnExpression(self.condition).evaluate(mlog, pos)
+            keep = valid & v.astype(bool)
+        if True in flightmode_selections:
+            keep &= mlog.flightmode_selected(t, flightmode_selections)
+        return (pos[keep], t[keep])
+
+    def column_modes(self, mlog, timeshift, flightmode_selections):
+        '''(time, flightmode) of each flight mode change in the messages
+        graphed from a columnar log'''
+        (pos, t) = self.column_samples(mlog, self.msg_types, flightmode_selections)
+        modes = mlog.flightmode_at(t)
+        change = numpy.flatnonzero(numpy.diff(modes) != 0) + 1
+        tdays = self.date_numbers(t + timeshift)
+        ret = []
+        for n in ([0] if len(t) > 0 else []) + change.tolist():
+            mode = None if modes[n] < 0 else mlog._flightmodes[modes[n]][0]
+            ret.append((tdays[n], mode))
+        return ret
+
+    def add_modes(self, modes):
+        '''add flight mode changes'''
+        for m in modes:
+            if len(self.modes) == 0 or self.modes[-1][1] != m[1]:
+                self.modes.append(m)
+
+    def date_numbers(self, t):
+        '''matplotlib date numbers of an array of unix times, as
+        date2num(datetime.fromtimestamp()) gives'''
+        if len(t) == 0:
+            return t
+        t0 = float(t[0])
+        base = matplotlib.dates.date2num(datetime.datetime.fromtimestamp(t0)) - t0 / 86400.0
+        return t / 86400.0 + base
+
     def process(self, flightmode_selections, _flightmodes, block=True):
         '''process and display graph'''
         self.msg_types = set()
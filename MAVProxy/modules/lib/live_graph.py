@@ -61,8 +61,12 @@ class LiveGraph():
 
     def add_values(self, values):
         '''add some data to the graph'''
-        if self.child.is_alive():
-            self.parent_pipe.send(values)
+        self.add_values_list([values])
+
+    def add_values_list(self, values_list):
+        '''add a list of rows of data to the graph in one send'''
+        if len(values_list) > 0 and self.child.is_alive():
+            self.parent_pipe.send(values_list)
 
     def close(self):
         '''close the graph'''
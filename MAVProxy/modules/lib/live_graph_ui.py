@@ -158,7 +158,8 @@ class GraphFrame(wx.Frame):
             self.Destroy()
             return
         while state.child_pipe.poll():
-            state.values = state.child_pipe.recv()
+            # the graph is sampled every tick, so the latest row is used
+            state.values = state.child_pipe.recv()[-1]
         if self.paused:
             return
         for i in range(len(self.plot_data)):
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+'''
+graph expressions over log columns
+
+ColumnExpression compiles a graph expression such as ATT.Roll,
+degrees(ATT.Roll) or mag_heading_df(MAG,ATT) once, then evaluates it
+over the columns of a mavcolumnlog for a whole array of samples,
+rather than with a Python eval per message.
+
+Each message type in an expression is lined up with the samples by
+position in the log, so a sample sees the latest message of each type
+at or before it, as mavutil.evaluate_expression sees the messages of a
+log being read in order. Math functions are replaced with their numpy
+equivalents. Other functions, including those from mavextra, are tried
+with whole arrays and called a sample at a time if that fails, or if
+they keep state between calls.
+
+Run this file directly with a log and expressions to compare against
+evaluating them per message.
+'''
+
+import ast, re, types
+import numpy
+from pymavlink import mavexpression
+from MAVProxy.modules.lib.mavcolumnlog import ColumnMessage
+
+class Unvectorisable(Exception):
+    '''an expression that can't be evaluated over arrays'''
+    pass
+
+def numpy_log(x, base=None):
+    if base is None:
+        return numpy.log(x)
+    return numpy.log(x) / numpy.log(base)
+
+# math functions and their numpy equivalents
+numpy_functions = {
+    'degrees' : numpy.degrees,
+    'radians' : numpy.radians,
+    'sqrt' : numpy.sqrt,
+    'sin' : numpy.sin,
+    'cos' : numpy.cos,
+    'tan' : numpy.tan,
+    'asin' : numpy.arcsin,
+    'acos' : numpy.arccos,
+    'atan' : numpy.arctan,
+    'atan2' : numpy.arctan2,
+    'sinh' : numpy.sinh,
+    'cosh' : numpy.cosh,
+    'tanh' : numpy.tanh,
+    'exp' : numpy.exp,
+    'log' : numpy_log,
+    'log10' : numpy.log10,
+    'fabs' : numpy.fabs,
+    'floor' : numpy.floor,
+    'ceil' : numpy.ceil,
+    'hypot' : numpy.hypot,
+    'fmod' : numpy.fmod,
+    'copysign' : numpy.copysign,
+    'isnan' : numpy.isnan,
+    'isinf' : numpy.isinf,
+    'abs' : numpy.abs,
+}
+
+# builtins that need a sample at a time when given arrays
+sample_builtins = {
+    'min' : min,
+    'max' : max,
+    'int' : int,
+    'float' : float,
+    'round' : round,
+}
+
+def stateful(func):
+    '''True for a function that keeps state between calls in module
+    globals, like mavextra.lowpass, which must be called a sample at a
+    time in log order'''
+    code = getattr(func, '__code__', None)
+    if code is None:
+        return False
+    g = getattr(func, '__globals__', {})
+    for name in code.co_names:
+        if name in g and (g[name] is None or isinstance(g[name], (dict, list, set))):
+            return True
+    return False
+
+_stateful = {}
+
+class ColumnVars(object):
+    '''the fields of a message type in a columnar log, lined up with
+    the samples at positions in the log. Samples before the first
+    message of the type are not valid'''
+    def __init__(self, mlog, mtype, positions):
+        self._mlog = mlog
+        self._type = mtype
+        rows = numpy.searchsorted(mlog.positions(mtype), positions, side='right') - 1
+        self._valid = rows >= 0
+        self._rows = numpy.maximum(rows, 0)
+        self._columns = {}
+
+    def _column(self, field):
+        if field not in self._columns:
+            c = self._mlog.column(self._type, field)
+            if c is None or len(c) == 0:
+                raise AttributeError(field)
+            if c.ndim != 1:
+                # arrays within messages index differently as columns
+                raise Unvectorisable("%s.%s is an array field" % (self._type, field))
+            # compute with the precision of python numbers
+            if c.dtype.kind in 'biu':
+                c = c.astype(numpy.int64)
+            elif c.dtype.kind == 'f':
+                c = c.astype(numpy.float64)
+            self._columns[field] = c
+        return self._columns[field]
+
+    def __getattr__(self, field):
+        if field.startswith('_'):
+            raise AttributeError(field)
+        return self._column(field)[self._rows]
+
+    def _message(self, k):
+        '''the message sample k sees'''
+        row = self._rows[k]
+        fields = self._mlog.fields(self._type)
+        values = []
+        for f in fields:
+            v = self._mlog.column(self._type, f)[row]
+            if hasattr(v, 'tolist'):
+                v = v.tolist()
+            values.append(v)
+        return ColumnMessage(self._type, fields, values, float(self._mlog.timestamps(self._type)[row]))
+
+
+class ColumnEvaluation(object):
+    '''the state of one evaluation over n samples. valid is cleared
+    for samples a function fails for'''
+    def __init__(self, n, valid):
+        self.n = n
+        self.valid = valid
+
+    def sample(self, x, k):
+        '''the value of an argument for sample k'''
+        if isinstance(x, ColumnVars):
+            return x._message(k)
+        if isinstance(x, numpy.ndarray) and x.shape == (self.n,):
+            v = x[k]
+            if hasattr(v, 'tolist'):
+                v = v.tolist()
+            return v
+        return x
+
+    def per_sample(self, func, args, kwargs):
+        '''call a function a sample at a time'''
+        values = []
+        for k in range(self.n):
+            v = None
+            if self.valid[k]:
+                a = [self.sample(x, k) for x in args]
+                kw = dict([(name, self.sample(x, k)) for (name, x) in kwargs.items()])
+                try:
+                    v = func(*a, **kw)
+                except Exception:
+                    v = None
+            if v is None:
+                self.valid[k] = False
+            values.append(v)
+        ok = [v for v in values if v is not None]
+        if len(ok) > 0 and not isinstance(ok[0], (int, float, bool)):
+            ret = numpy.empty(self.n, dtype=object)
+            ret[:] = values
+            return ret
+        return numpy.array([numpy.nan if v is None else v for v in values], dtype=numpy.float64)
+
+    def wrap(self, func, try_arrays=True):
+        '''wrap a function to take arrays'''
+        def call(*args, **kwargs):
+            allargs = list(args) + list(kwargs.values())
+            if not [x for x in allargs if isinstance(x, (ColumnVars, numpy.ndarray))]:
+                return func(*args, **kwargs)
+            if try_arrays:
+                try:
+                    ret = func(*args, **kwargs)
+                    if isinstance(ret, numpy.ndarray) and ret.shape == (self.n,):
+                        return ret
+                except Exception:
+                    pass
+            return self.per_sample(func, args, kwargs)
+        return call
+
+    def namespace(self):
+        '''the globals of evaluate_expression, taking arrays'''
+        ret = {}
+        for (name, obj) in vars(mavexpression).items():
+            if name in numpy_functions:
+                ret[name] = numpy_functions[name]
+            elif isinstance(obj, (types.FunctionType, types.BuiltinFunctionType)):
+                if obj not in _stateful:
+                    _stateful[obj] = stateful(obj)
+                ret[name] = self.wrap(obj, not _stateful[obj])
+            else:
+                ret[name] = obj
+        for (name, func) in sample_builtins.items():
+            if name not in ret:
+                ret[name] = self.wrap(func, False)
+        ret['abs'] = numpy.abs
+        return ret
+
+
+class ColumnExpression(object):
+    '''a graph expression, optionally with a {CONDITION} suffix as
+    evaluate_expression takes, compiled for evaluation over columns'''
+    def __init__(self, expression):
+        self.expression = expression
+        self.condition = None
+        if expression.endswith('}') and expression.rfind('{') != -1:
+            i = expression.rfind('{')
+            self.condition = self.compile(expression[i+1:-1])
+            expression = expression[:i]
+        self.code = self.compile(expression)
+
+    def compile(self, expression):
+        '''return (code, names used in it)'''
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+            code = compile(tree, '<expression>', 'eval')
+        except SyntaxError as e:
+            raise Unvectorisable(str(e))
+        names = set([n.id for n in ast.walk(tree) if isinstance(n, ast.Name)])
+        return (code, names)
+
+    def run(self, compiled, mlog, positions):
+        '''evaluate compiled code at positions, returning (values, valid),
+        with nothing valid if a name is missing'''
+        (code, names) = compiled
+        n = len(positions)
+        valid = numpy.ones(n, dtype=bool)
+        msgs = {}
+        for name in names:
+            if re.match('^[A-Z_][A-Z0-9_]+$', name) and mlog.timestamps(name) is not None:
+                msgs[name] = ColumnVars(mlog, name, positions)
+                valid &= msgs[name]._valid
+        ev = ColumnEvaluation(n, valid)
+        try:
+            with numpy.errstate(all='ignore'):
+                v = eval(code, ev.namespace(), msgs)
+        except (NameError, ZeroDivisionError, IndexError):
+            # evaluate_expression gives None for these
+            return (numpy.zeros(n), numpy.zeros(n, dtype=bool))
+        except Unvectorisable:
+            raise
+        except Exception as e:
+            raise Unvectorisable(str(e))
+        if isinstance(v, (int, float, bool, numpy.number, numpy.bool_)):
+            v = numpy.full(n, v)
+        if not isinstance(v, numpy.ndarray) or v.shape != (n,):
+            raise Unvectorisable("not an array result")
+        return (v, ev.valid)
+
+    def evaluate(self, mlog, positions):
+        '''evaluate at an array of positions in a mavcolumnlog, returning
+        (values, valid). Samples evaluate_expression would give None for
+        are not valid. Raises Unvectorisable if it can't be done over
+        arrays'''
+        if self.condition is not None:
+            (c, cvalid) = self.run(self.condition, mlog, positions)
+            cvalid = cvalid & c.astype(bool)
+        (v, valid) = self.run(self.code, mlog, positions)
+        if self.condition is not None:
+            valid &= cvalid
+        if v.dtype.kind == 'f':
+            # a division by zero, which evaluate_expression skips
+            valid &= ~numpy.isinf(v)
+        return (v, valid)
+
+
+def column_condition(mlog, condition, positions):
+    '''evaluate a condition for the samples at positions in a columnar
+    log, as evaluate_condition would, returning a mask or None if it
+    can't be done with arrays'''
+    try:
+        (v, valid) = ColumnExpression(condition).evaluate(mlog, positions)
+    except Unvectorisable:
+        return None
+    return valid & v.astype(bool)
+
+def sample_positions(mlog, mtypes):
+    '''(positions, timestamps) of the messages of any of a set of types
+    in a columnar log, in log order'''
+    mtypes = [t for t in mtypes if mlog.timestamps(t) is not None]
+    if len(mtypes) == 0:
+        return (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0))
+    pos = numpy.concatenate([mlog.positions(t) for t in mtypes])
+    t = numpy.concatenate([numpy.asarray(mlog.timestamps(t), dtype=numpy.float64) for t in mtypes])
+    order = numpy.argsort(pos, kind='mergesort')
+    return (pos[order], t[order])
+
+
+if __name__ == "__main__":
+    import time
+    from optparse import OptionParser
+    from pymavlink import mavutil
+    from MAVProxy.modules.lib import mavcolumnlog
+    parser = OptionParser("mavcolumnexpr.py [options] <LOG> <EXPRESSION...>")
+    (opts, args) = parser.parse_args()
+    if len(args) < 2:
+        print("Usage: mavcolumnexpr.py [options] <LOG> <EXPRESSION...>")
+        raise SystemExit(1)
+    mlog = mavcolumnlog.load(args[0])
+    for expression in args[1:]:
+        mtypes = set(re.findall('[A-Z_][A-Z0-9_]+', expression))
+        t0 = time.time()
+        (pos, t) = sample_positions(mlog, mtypes)
+        (v, valid) = ColumnExpression(expression).evaluate(mlog, pos)
+        t1 = time.time()
+        mlog.rewind()
+        slow = []
+        while True:
+            m = mlog.recv_msg()
+            if m is None:
+                break
+            if m.get_type() in mtypes:
+                x = mavutil.evaluate_expression(expression, mlog.messages)
+                if x is not None:
+                    slow.append(x)
+        t2 = time.time()
+        # functions that keep state, like lowpass, carry it from the
+        # first evaluation into the second
+        fast = v[valid]
+        same = len(fast) == len(slow) and numpy.allclose(fast.astype(numpy.float64), slow, equal_nan=True)
+        print("%s: %u samples, arrays %.3fs, per message %.2fs, %s" % (
+            expression, len(fast), t1-t0, t2-t1, "same" if same else "DIFFERENT"))
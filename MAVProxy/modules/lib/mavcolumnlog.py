@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+'''
+columnar mavlink log
+
+mavcolumnlog holds a log as numpy arrays, one per field of each message
+type plus a timestamp column, rather than as a list of message objects.
+The columns are saved as a cache next to the log and memory mapped when
+the log is opened again, so reopening a log is nearly instant and only
+the columns used are read from disk.
+
+The order of the messages in the log is kept as an array of type
+numbers, so it can still be read a message at a time like mavmemlog,
+for code that needs whole messages.
+
+Run this file directly with a log to compare loading it against
+mavmemlog.
+'''
+
+import os, json
+import numpy
+from pymavlink import mavutil
+from MAVProxy.modules.lib import mp_dfload
+
+CACHE_VERSION = 1
+
+def cache_dirname(filename):
+    '''the directory the columns of a log are cached in'''
+    return filename + '.cols'
+
+class ColumnMessage(object):
+    '''a message rebuilt from the columns of a log'''
+    def __init__(self, type, fieldnames, values, timestamp):
+        self._type = type
+        self._fieldnames = fieldnames
+        self._timestamp = timestamp
+        for (f, v) in zip(fieldnames, values):
+            setattr(self, f, v)
+
+    def get_type(self):
+        return self._type
+
+    def get_fieldnames(self):
+        return self._fieldnames
+
+    def to_dict(self):
+        d = {'mavpackettype' : self._type}
+        for f in self._fieldnames:
+            d[f] = getattr(self, f)
+        return d
+
+    def __str__(self):
+        return "%s {%s}" % (self._type, ", ".join(["%s : %s" % (f, getattr(self, f)) for f in self._fieldnames]))
+
+
+class ColumnBuilder(object):
+    '''collect the messages of one type into columns, converting them to
+    arrays chunk_size messages at a time. Fields that don't make a
+    numeric, string or fixed size array column are left out'''
+    def __init__(self, fieldnames, chunk_size=65536):
+        self.fieldnames = list(fieldnames)
+        self.chunk_size = chunk_size
+        self.rows = []
+        self.times = []
+        self.chunks = [[] for f in self.fieldnames]
+        self.time_chunks = []
+        self.dropped = set()
+
+    def add(self, m):
+        self.rows.append(tuple([getattr(m, f, None) for f in self.fieldnames]))
+        self.times.append(m._timestamp)
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+        columns = list(zip(*self.rows))
+        for i in range(len(self.fieldnames)):
+            if i in self.dropped:
+                continue
+            try:
+                a = numpy.array(columns[i])
+            except ValueError:
+                a = None
+            if a is None or a.dtype.kind not in 'biufSU' or a.ndim > 2:
+                self.dropped.add(i)
+                self.chunks[i] = []
+                continue
+            self.chunks[i].append(a)
+        self.time_chunks.append(numpy.array(self.times, dtype=numpy.float64))
+        self.rows = []
+        self.times = []
+
+    def finish(self):
+        '''return (fieldnames, columns, timestamps)'''
+        self.flush()
+        fields = []
+        columns = []
+        for i in range(len(self.fieldnames)):
+            if i in self.dropped:
+                continue
+            try:
+                a = numpy.concatenate(self.chunks[i])
+            except ValueError:
+                # arrays that changed size part way through
+                continue
+            fields.append(self.fieldnames[i])
+            columns.append(a)
+        return (fields, columns, numpy.concatenate(self.time_chunks))
+
+
+class mavcolumnlog(mavutil.mavfile):
+    '''a MAVLink or dataflash log held as columns. Use load() to open a
+    log from its cache, or build and cache it'''
+    def __init__(self):
+        mavutil.mavfile.__init__(self, None, 'columnlog')
+        self._types = []
+        self._fields = {}
+        self._columns = {}
+        self._timestamps = {}
+        self._order = numpy.zeros(0, dtype=numpy.uint16)
+        self._flightmodes = []
+        self._masks = None
+        self._positions = {}
+        self._count = 0
+        self.mav_type = None
+        self.rewind()
+
+    def build(self, mav, progress_callback=None):
+        '''read all of an open log into columns'''
+        builders = {}
+        ids = {}
+        order = []
+        self._flightmodes = []
+        last_flightmode = None
+        last_timestamp = None
+        last_pct = 0
+        while True:
+            m = mav.recv_msg()
+            if m is None:
+                break
+            if int(mav.percent) != last_pct and progress_callback:
+                progress_callback(int(mav.percent))
+                last_pct = int(mav.percent)
+            type = m.get_type()
+            if type not in ids:
+                ids[type] = len(self._types)
+                self._types.append(str(type))
+                builders[type] = ColumnBuilder(m.get_fieldnames())
+            builders[type].add(m)
+            order.append(ids[type])
+            if mav.flightmode != last_flightmode:
+                if len(self._flightmodes) > 0:
+                    (mode, t1, t2) = self._flightmodes[-1]
+                    self._flightmodes[-1] = (mode, t1, m._timestamp)
+                self._flightmodes.append((mav.flightmode, m._timestamp, None))
+                last_flightmode = mav.flightmode
+            last_timestamp = m._timestamp
+            self.check_param(m)
+        if last_timestamp is not None and len(self._flightmodes) > 0:
+            (mode, t1, t2) = self._flightmodes[-1]
+            self._flightmodes[-1] = (mode, t1, last_timestamp)
+        for type in self._types:
+            (fields, columns, timestamps) = builders[type].finish()
+            self._fields[type] = fields
+            self._columns[type] = dict(zip(fields, columns))
+            self._timestamps[type] = timestamps
+        self._order = numpy.array(order, dtype=numpy.uint16)
+        self._count = len(self._order)
+        self.mav_type = getattr(mav, 'mav_type', None)
+        self.rewind()
+
+    def build_dataflash(self, filename, progress_callback=None, processes=None, zero_time_base=False):
+        '''read a binary dataflash log into columns in parallel chunks,
+        returning False if it needs reading a message at a time'''
+        cols = mp_dfload.load_columns(filename, progress_callback, processes,
+                                      zero_time_base=zero_time_base)
+        if cols is None:
+            return False
+        self._types = cols.types
+        self._fields = cols.fields
+        self._columns = cols.columns
+        self._timestamps = cols.timestamps
+        self._order = cols.order
+        self._flightmodes = cols.flightmodes
+        self.params.update(cols.params)
+        self.mav_type = cols.mav_type
+        self._count = len(self._order)
+        self.rewind()
+        return True
+
+    def save(self, dirname, source=None):
+        '''save the columns to a cache directory. The metadata is written
+        last, so an interrupted save leaves no usable cache'''
+        if not os.path.exists(dirname):
+            os.mkdir(dirname)
+        meta_file = os.path.join(dirname, 'meta.json')
+        if os.path.exists(meta_file):
+            os.unlink(meta_file)
+        numpy.save(os.path.join(dirname, 'order.npy'), self._order)
+        types = []
+        for (i, type) in enumerate(self._types):
+            numpy.save(os.path.join(dirname, 't%u.npy' % i), self._timestamps[type])
+            for (j, f) in enumerate(self._fields[type]):
+                numpy.save(os.path.join(dirname, 't%u_%u.npy' % (i, j)), self._columns[type][f])
+            types.append({'name' : type, 'fields' : self._fields[type]})
+        meta = {'version' : CACHE_VERSION,
+                'types' : types,
+                'flightmodes' : self._flightmodes,
+                'params' : self.params,
+                'mav_type' : self.mav_type}
+        if source is not None:
+            st = os.stat(source)
+            meta['size'] = st.st_size
+            meta['mtime'] = st.st_mtime
+        f = open(meta_file + '.tmp', 'w')
+        json.dump(meta, f)
+        f.close()
+        os.rename(meta_file + '.tmp', meta_file)
+
+    def open_cache(self, dirname, source=None):
+        '''memory map the columns from a cache directory, returning False
+        if there is no cache or it is not of the current source'''
+        try:
+            f = open(os.path.join(dirname, 'meta.json'))
+            meta = json.load(f)
+            f.close()
+        except (IOError, OSError, ValueError):
+            return False
+        if meta.get('version', None) != CACHE_VERSION:
+            return False
+        if source is not None:
+            st = os.stat(source)
+            if meta.get('size', None) != st.st_size or meta.get('mtime', None) != st.st_mtime:
+                return False
+        self._order = numpy.load(os.path.join(dirname, 'order.npy'), mmap_mode='r')
+        for (i, t) in enumerate(meta['types']):
+            type = str(t['name'])
+            fields = [str(f) for f in t['fields']]
+            self._types.append(type)
+            self._fields[type] = fields
+            self._timestamps[type] = numpy.load(os.path.join(dirname, 't%u.npy' % i), mmap_mode='r')
+            self._columns[type] = {}
+            for (j, f) in enumerate(fields):
+                self._columns[type][f] = numpy.load(os.path.join(dirname, 't%u_%u.npy' % (i, j)), mmap_mode='r')
+        self._flightmodes = [(m, t1, t2) for (m, t1, t2) in meta['flightmodes']]
+        self.params.update(meta['params'])
+        self.mav_type = meta['mav_type']
+        self._count = len(self._order)
+        self.rewind()
+        return True
+
+    def types(self):
+        '''names of the message types in the log'''
+        return self._types[:]
+
+    def fields(self, type):
+        '''names of the columns of a message type'''
+        return self._fields.get(type, [])[:]
+
+    def mask(self, type):
+        '''the messages of a type kept by reduce_by_flightmodes, or None'''
+        if self._masks is None:
+            return None
+        return self._masks[type]
+
+    def column(self, type, field):
+        '''the values of a field, or None if the log has no such column'''
+        if type not in self._columns or field not in self._columns[type]:
+            return None
+        c = self._columns[type][field]
+        if self._masks is not None:
+            c = c[self._masks[type]]
+        return c
+
+    def timestamps(self, type):
+        '''the timestamps of the messages of a type'''
+        if type not in self._timestamps:
+            return None
+        t = self._timestamps[type]
+        if self._masks is not None:
+            t = t[self._masks[type]]
+        return t
+
+    def positions(self, type):
+        '''the positions in the log of the messages of a type, for
+        lining up the messages of different types in log order'''
+        if type not in self._timestamps:
+            return None
+        if type not in self._positions:
+            self._positions[type] = numpy.flatnonzero(self._order == self._types.index(type))
+        p = self._positions[type]
+        if self._masks is not None:
+            p = p[self._masks[type]]
+        return p
+
+    def flightmode_index(self, t):
+        '''the index in the flightmode list of the mode ending after each
+        of an array of timestamps, as the flightmode selections count'''
+        ends = numpy.array([t2 for (mode, t1, t2) in self._flightmodes], dtype=numpy.float64)
+        return numpy.searchsorted(ends, t, side='right')
+
+    def flightmode_selected(self, t, flightmode_selections):
+        '''mask of timestamps in the selected flightmodes'''
+        sel = numpy.array(list(flightmode_selections) + [False], dtype=bool)
+        idx = numpy.minimum(self.flightmode_index(t), len(flightmode_selections))
+        return sel[idx]
+
+    def flightmode_at(self, t):
+        '''the index in the flightmode list of the mode at each of an array
+        of timestamps, -1 before the first'''
+        starts = numpy.array([t1 for (mode, t1, t2) in self._flightmodes], dtype=numpy.float64)
+        return numpy.searchsorted(starts, t, side='right') - 1
+
+    def message(self, type, row):
+        '''rebuild a message from a row of its columns'''
+        values = []
+        for f in self._fields[type]:
+            v = self._columns[type][f][row]
+            if hasattr(v, 'tolist'):
+                v = v.tolist()
+            values.append(v)
+        return ColumnMessage(type, self._fields[type], values, float(self._timestamps[type][row]))
+
+    def recv_msg(self):
+        '''message receive routine'''
+        while self._index < len(self._order):
+            type = self._types[self._order[self._index]]
+            row = self._rows.get(type, 0)
+            self._rows[type] = row + 1
+            self._index += 1
+            if self._masks is None or self._masks[type][row]:
+                break
+        else:
+            return None
+        m = self.message(type, row)
+        self.percent = (100.0 * self._index) / max(len(self._order), 1)
+        self.messages[type] = m
+        self._timestamp = m._timestamp
+
+        if self._flightmode_index < len(self._flightmodes):
+            (mode, tstamp, t2) = self._flightmodes[self._flightmode_index]
+            if m._timestamp >= tstamp:
+                self.flightmode = mode
+                self._flightmode_index += 1
+
+        self.check_param(m)
+        return m
+
+    def last_messages(self):
+        '''the last message of each type, as the messages of a log read
+        to the end'''
+        ret = {}
+        for type in self._types:
+            if len(self._timestamps[type]) > 0:
+                ret[type] = self.message(type, len(self._timestamps[type])-1)
+        return ret
+
+    def check_param(self, m):
+        type = m.get_type()
+        if type == 'PARAM_VALUE':
+            self.params[str(m.param_id)] = m.param_value
+        elif type == 'PARM' and getattr(m, 'Name', None) is not None:
+            self.params[m.Name] = m.Value
+
+    def rewind(self):
+        '''rewind to start'''
+        self._index = 0
+        self._rows = {}
+        self.percent = 0
+        self.messages.clear()
+        self._flightmode_index = 0
+        self._timestamp = None
+        self.flightmode = None
+
+    def flightmode_list(self):
+        '''return list of all flightmodes as tuple of mode and start time'''
+        return self._flightmodes
+
+    def reduce_by_flightmodes(self, flightmode_selections):
+        '''reduce data using flightmode selections. Unlike mavmemlog this
+        can be undone, by passing no selections'''
+        self._masks = None
+        self._count = len(self._order)
+        if True not in flightmode_selections:
+            # treat all false as all modes wanted
+            self.rewind()
+            return
+        masks = {}
+        count = 0
+        for type in self._types:
+            masks[type] = self.flightmode_selected(self._timestamps[type], flightmode_selections)
+            count += int(numpy.count_nonzero(masks[type]))
+        self._masks = masks
+        self._count = count
+        self.rewind()
+
+
+def is_dataflash_binary(filename):
+    '''True for a binary dataflash log'''
+    if not filename.lower().endswith(('.bin', '.px4log')):
+        return False
+    try:
+        f = open(filename, 'rb')
+        head = f.read(2)
+        f.close()
+    except (IOError, OSError):
+        return False
+    return head == b'\xa3\x95'
+
+def load(filename, progress_callback=None, use_cache=True, processes=None, **kwargs):
+    '''open a log as columns, from its cache if that is up to date,
+    otherwise reading the log and saving the cache. Binary dataflash
+    logs are read with processes processes, by default one per CPU.
+    kwargs are passed to mavlink_connection'''
+    dirname = cache_dirname(filename)
+    mlog = mavcolumnlog()
+    if use_cache and mlog.open_cache(dirname, filename):
+        return mlog
+    if not (is_dataflash_binary(filename) and
+            mlog.build_dataflash(filename, progress_callback, processes,
+                                 zero_time_base=kwargs.get('zero_time_base', False))):
+        mlog.build(mavutil.mavlink_connection(filename, **kwargs), progress_callback)
+    if use_cache:
+        try:
+            mlog.save(dirname, filename)
+        except (IOError, OSError) as msg:
+            print("Unable to cache log columns - %s" % msg)
+    return mlog
+
+
+if __name__ == "__main__":
+    import time, resource
+    from optparse import OptionParser
+    parser = OptionParser("mavcolumnlog.py [options] <LOG>")
+    parser.add_option("--no-memlog", action='store_true', default=False, help="skip the mavmemlog comparison")
+    (opts, args) = parser.parse_args()
+    if len(args) < 1:
+        print("Usage: mavcolumnlog.py [options] <LOG>")
+        raise SystemExit(1)
+    logfile = args[0]
+
+    def maxrss():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+    t0 = time.time()
+    mlog = load(logfile, use_cache=False)
+    t1 = time.time()
+    mlog.save(cache_dirname(logfile), logfile)
+    t2 = time.time()
+    print("columns: built %u messages in %.2fs, saved in %.2fs, %.0fMB peak" % (mlog._count, t1-t0, t2-t1, maxrss()))
+    t0 = time.time()
+    mlog = load(logfile)
+    t1 = time.time()
+    print("columns: reopened from cache in %.3fs" % (t1-t0))
+    if not opts.no_memlog:
+        from MAVProxy.modules.lib import mavmemlog
+        t0 = time.time()
+        memlog = mavmemlog.mavmemlog(mavutil.mavlink_connection(logfile))
+        t1 = time.time()
+        print("mavmemlog: loaded %u messages in %.2fs, %.0fMB peak" % (memlog._count, t1-t0, maxrss()))
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+'''
+COMMAND_LONG transaction manager
+
+Tracks COMMAND_LONG messages that are in flight, correlates the
+COMMAND_ACK replies with them, retries unacknowledged commands with
+backoff and keeps latency and success statistics per command
+'''
+
+import time, sys, traceback
+from pymavlink import mavutil
+
+def command_name(command):
+    '''return a printable name for a MAV_CMD value'''
+    try:
+        return mavutil.mavlink.enums['MAV_CMD'][command].name
+    except Exception:
+        return str(command)
+
+# result given to the callback of a transaction replaced by a new
+# command of the same type before it completed
+RESULT_REPLACED = -1
+
+# commands that act again each time they are received, so a retry
+# after a lost COMMAND_ACK would repeat the action
+non_idempotent = set([mavutil.mavlink.MAV_CMD_DO_REPEAT_RELAY,
+                      mavutil.mavlink.MAV_CMD_DO_REPEAT_SERVO,
+                      mavutil.mavlink.MAV_CMD_DO_MOTOR_TEST])
+
+def result_name(result):
+    '''return a printable name for a MAV_RESULT value, or TIMEOUT for None'''
+    if result is None:
+        return 'TIMEOUT'
+    if result == RESULT_REPLACED:
+        return 'REPLACED'
+    try:
+        return mavutil.mavlink.enums['MAV_RESULT'][result].name
+    except Exception:
+        return str(result)
+
+
+class CommandTransaction(object):
+    '''one COMMAND_LONG in flight'''
+    def __init__(self, target_system, target_component, command, params,
+                 callback=None, retries=3, timeout=1.0):
+        self.target_system = target_system
+        self.target_component = target_component
+        self.command = command
+        self.params = params
+        self.callback = callback
+        self.retries = retries
+        self.timeout = timeout
+        self.attempts = 0
+        self.first_sent = None
+        self.deadline = None
+        self.result = None
+        self.ack = None
+
+    def key(self):
+        '''key used to match a COMMAND_ACK to this transaction'''
+        return (self.target_system, self.command)
+
+    def latency(self):
+        '''time from first send to now'''
+        return time.time() - self.first_sent
+
+
+class CommandStats(object):
+    '''success and latency statistics for one command'''
+    def __init__(self):
+        self.sent = 0
+        self.retries = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        # superseded by a new command of the same type before completing
+        self.replaced = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def mean_latency(self):
+        '''mean latency of acknowledged commands'''
+        acked = self.accepted + self.rejected
+        if acked == 0:
+            return 0.0
+        return self.total_latency / acked
+
+
+class CommandManager(object):
+    '''track COMMAND_LONG transactions by (target_system, command)'''
+    def __init__(self, mpstate):
+        self.mpstate = mpstate
+        self.pending = {}
+        self.stats = {}
+
+    def send(self, command, params, target_system=None, target_component=None,
+             callback=None, retries=None, timeout=1.0):
+        '''send a COMMAND_LONG, retrying with backoff until acknowledged.
+
+        params is a list of up to 7 parameters. callback, if given, is
+        called as callback(transaction, result) where result is a
+        MAV_RESULT value, None on timeout or RESULT_REPLACED if another
+        command of the same type is sent first. retries defaults to 3,
+        or 0 for non_idempotent commands'''
+        if retries is None:
+            if command in non_idempotent:
+                retries = 0
+            else:
+                retries = 3
+        if target_system is None:
+            target_system = self.mpstate.settings.target_system
+        if target_component is None:
+            target_component = self.mpstate.settings.target_component
+        params = list(params)
+        while len(params) < 7:
+            params.append(0)
+        t = CommandTransaction(target_system, target_component, command, params,
+                               callback=callback, retries=retries, timeout=timeout)
+        old = self.pending.pop(t.key(), None)
+        if old is not None:
+            # a new command of the same type replaces the old one
+            self.complete(old, RESULT_REPLACED)
+        t.first_sent = time.time()
+        self.pending[t.key()] = t
+        self.get_stats(command).sent += 1
+        self.transmit(t)
+        return t
+
+    def transmit(self, t):
+        '''(re)send a transaction, setting its next deadline'''
+        master = self.mpstate.master()
+        if master is None:
+            return
+        # the confirmation field counts retransmissions
+        master.mav.command_long_send(t.target_system, t.target_component,
+                                     t.command, min(t.attempts, 255), *t.params)
+        t.deadline = time.time() + t.timeout * (2 ** t.attempts)
+        t.attempts += 1
+
+    def get_stats(self, command):
+        if not command in self.stats:
+            self.stats[command] = CommandStats()
+        return self.stats[command]
+
+    def handle_ack(self, m):
+        '''handle a COMMAND_ACK, returning the matching transaction or None'''
+        key = (m.get_srcSystem(), m.command)
+        if not key in self.pending:
+            # commands sent to the broadcast system
+            key = (0, m.command)
+            if not key in self.pending:
+                return None
+        t = self.pending[key]
+        if m.result == mavutil.mavlink.MAV_RESULT_IN_PROGRESS:
+            # the vehicle is working on it, stop retransmitting for now
+            t.deadline = time.time() + t.timeout * (2 ** t.attempts)
+            return t
+        self.pending.pop(key)
+        t.ack = m
+        self.complete(t, m.result)
+        return t
+
+    def complete(self, t, result):
+        '''finish a transaction, updating stats and calling its callback'''
+        t.result = result
+        stats = self.get_stats(t.command)
+        stats.retries += t.attempts - 1
+        if result is None:
+            stats.timeouts += 1
+        elif result == RESULT_REPLACED:
+            stats.replaced += 1
+        else:
+            latency = t.latency()
+            stats.total_latency += latency
+            stats.max_latency = max(stats.max_latency, latency)
+            if result == mavutil.mavlink.MAV_RESULT_ACCEPTED:
+                stats.accepted += 1
+            else:
+                stats.rejected += 1
+        if t.callback is not None:
+            # a failing callback mustn't take down the main loop
+            try:
+                t.callback(t, result)
+            except Exception as msg:
+                if self.mpstate.settings.moddebug == 1:
+                    print(msg)
+                elif self.mpstate.settings.moddebug > 1:
+                    exc_type, exc_value, exc_traceback = sys.exc_info()
+                    traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                              limit=2, file=sys.stdout)
+        elif result != RESULT_REPLACED:
+            self.mpstate.console.writeln("%s: %s (%.2fs, %u tries)" % (
+                command_name(t.command), result_name(result), t.latency(), t.attempts))
+
+    def check(self):
+        '''retransmit or time out transactions past their deadline'''
+        if len(self.pending) == 0:
+            return
+        now = time.time()
+        for key in list(self.pending.keys()):
+            t = self.pending[key]
+            if now < t.deadline:
+                continue
+            if t.attempts > t.retries:
+                self.pending.pop(key)
+                self.complete(t, None)
+                continue
+            self.transmit(t)
+
+    def show(self):
+        '''show in-flight commands and statistics'''
+        print("%u commands in flight" % len(self.pending))
+        for t in self.pending.values():
+            print("  %s target=%u attempts=%u age=%.1fs" % (
+                command_name(t.command), t.target_system, t.attempts, t.latency()))
+        for command in sorted(self.stats.keys()):
+            s = self.stats[command]
+            print("%-36s sent=%u ok=%u rej=%u timeout=%u replaced=%u retries=%u latency=%.3f/%.3fs" % (
+                command_name(command), s.sent, s.accepted, s.rejected, s.timeouts,
+                s.replaced, s.retries, s.mean_latency(), s.max_latency))
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+'''
+min/max decimation of graph lines
+
+A line with millions of points is drawn no better than one with a few
+points per pixel, but takes far longer to draw. MinMaxPyramid keeps,
+for buckets of points of sizes growing by a factor at each level, the
+indexes of the lowest and highest point in each bucket. view() picks
+the level with buckets of about one pixel for the visible x range and
+returns the lowest and highest points of those buckets in order, so the
+line drawn has the same envelope as the full data. When zoomed in far
+enough it returns the points themselves.
+
+The x values must be in increasing order, as they are for a time axis.
+
+Run this file directly for a benchmark with a large random walk.
+'''
+
+import numpy
+
+class MinMaxPyramid(object):
+    '''min/max decimation levels of a line with x in increasing order'''
+    def __init__(self, x, y, factor=4, min_points=1000):
+        self.x = numpy.asarray(x, dtype=numpy.float64)
+        self.y = numpy.asarray(y, dtype=numpy.float64)
+        self.factor = factor
+        n = len(self.x)
+        itype = numpy.int32 if n < 2**31 else numpy.int64
+        # (bucket size, index of lowest, index of highest) of each level
+        self.levels = []
+        imin = numpy.arange(n, dtype=itype)
+        imax = imin
+        bucket = 1
+        while len(imin) > min_points:
+            imin = self.reduce(imin, numpy.argmin)
+            imax = self.reduce(imax, numpy.argmax)
+            bucket *= factor
+            self.levels.append((bucket, imin, imax))
+
+    def reduce(self, idx, argfunc):
+        '''combine each factor indexes into the index of the lowest or
+        highest of their points'''
+        pad = (-len(idx)) % self.factor
+        if pad:
+            # repeating the last index doesn't change a min or max
+            idx = numpy.concatenate((idx, numpy.repeat(idx[-1:], pad)))
+        idx = idx.reshape(-1, self.factor)
+        yv = self.y[idx]
+        # treat NaN as missing rather than as the lowest or highest
+        if argfunc is numpy.argmin:
+            yv = numpy.where(numpy.isnan(yv), numpy.inf, yv)
+        else:
+            yv = numpy.where(numpy.isnan(yv), -numpy.inf, yv)
+        choice = argfunc(yv, axis=1)
+        return idx[numpy.arange(len(idx)), choice]
+
+    def view(self, xmin, xmax, pixels):
+        '''(x, y) arrays to draw for the range xmin to xmax on an axis
+        pixels wide, with a point either side of the range so the line
+        runs to the edges'''
+        n = len(self.x)
+        i0 = max(int(numpy.searchsorted(self.x, xmin, side='left')) - 1, 0)
+        i1 = min(int(numpy.searchsorted(self.x, xmax, side='right')) + 1, n)
+        pixels = max(int(pixels), 1)
+        level = None
+        for (bucket, imin, imax) in self.levels:
+            if (i1 - i0) // bucket < pixels:
+                break
+            level = (bucket, imin, imax)
+        if level is None:
+            return (self.x[i0:i1], self.y[i0:i1])
+        (bucket, imin, imax) = level
+        b0 = i0 // bucket
+        b1 = (i1 - 1) // bucket + 1
+        idx = numpy.concatenate(([i0], imin[b0:b1], imax[b0:b1], [i1-1]))
+        idx = numpy.unique(idx)
+        idx = idx[(idx >= i0) & (idx < i1)]
+        return (self.x[idx], self.y[idx])
+
+
+if __name__ == "__main__":
+    import time
+    from optparse import OptionParser
+    parser = OptionParser("mp_decimate.py [options]")
+    parser.add_option("--points", type='int', default=10000000, help="number of points")
+    parser.add_option("--pixels", type='int', default=1200, help="axis width in pixels")
+    (opts, args) = parser.parse_args()
+
+    n = opts.points
+    x = numpy.arange(n) * 0.001
+    y = numpy.cumsum(numpy.random.normal(size=n))
+    t0 = time.time()
+    p = MinMaxPyramid(x, y)
+    t1 = time.time()
+    print("pyramid of %u points built in %.2fs, %u levels" % (n, t1-t0, len(p.levels)))
+    for zoom in [1, 10, 100, 1000, 10000, 100000]:
+        span = x[-1] / zoom
+        xmin = x[-1] / 3.0
+        xmax = xmin + span
+        t0 = time.time()
+        (vx, vy) = p.view(xmin, xmax, opts.pixels)
+        t1 = time.time()
+        sel = (x >= xmin) & (x <= xmax)
+        same = vy.min() <= y[sel].min() and vy.max() >= y[sel].max()
+        print("zoom %6u: %7u points in %.4fs, envelope %s" % (
+            zoom, len(vx), t1-t0, "kept" if same else "LOST"))
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+'''
+dataflash log index
+
+DFIndexer parses a dataflash log as it is written, using the FMT
+messages in the log to find where each message starts, and records
+the type, file offset and timestamp of every message in a sidecar
+index file next to the log. DFIndex loads the index, so a tool can
+find all the messages of the types it wants, and the time range of the
+log, without reading the whole log. load_index gives the index only
+if it is complete and newer than the log, for loaders that can then
+skip searching the log for its messages.
+
+The index file is a short header followed by fixed size records, so
+it can be appended to while the log is streamed and loaded as one
+array. Messages without a timestamp of their own get the timestamp of
+the message before them.
+
+Run this file directly with a log to index it, and to compare loading
+the index against a full scan of the log.
+'''
+
+import os, struct
+
+HEAD1 = 0xA3
+HEAD2 = 0x95
+FMT_TYPE = 128
+FMT_LENGTH = 89
+
+INDEX_MAGIC = b'DFIDX1\n\0'
+RECORD = struct.Struct('<BQQ')
+
+class DFFormat(object):
+    '''a message format from a FMT message'''
+    def __init__(self, type, length, name, format, columns):
+        self.type = type
+        self.length = length
+        self.name = name
+        self.format = format
+        self.columns = columns
+        # where to find a timestamp in the message body, if it has one
+        self.time_struct = None
+        self.time_scale = 1
+        if len(columns) > 0 and len(format) > 0:
+            if columns[0] == 'TimeUS' and format[0] == 'Q':
+                self.time_struct = struct.Struct('<Q')
+            elif columns[0] == 'TimeMS' and format[0] in 'Ii':
+                self.time_struct = struct.Struct('<I')
+                self.time_scale = 1000
+
+def null_term(b):
+    '''decode a null padded string'''
+    b = bytes(b)
+    i = b.find(b'\0')
+    if i != -1:
+        b = b[:i]
+    return b.decode('ascii', 'replace')
+
+def parse_fmt(body):
+    '''return a DFFormat from the body of a FMT message, after the header'''
+    (type, length) = (body[0], body[1])
+    name = null_term(body[2:6])
+    format = null_term(body[6:22])
+    columns = null_term(body[22:86])
+    return DFFormat(type, length, name, format, columns.split(',') if columns else [])
+
+
+class DFIndexer(object):
+    '''index a dataflash log fed in order with feed(). Records are
+    written to index_fh if given, and are also counted per type'''
+    def __init__(self, index_fh=None, write_size=65536):
+        self.index_fh = index_fh
+        self.write_size = write_size
+        self.formats = { FMT_TYPE : DFFormat(FMT_TYPE, FMT_LENGTH, 'FMT', 'BBnNZ',
+                                             ['Type', 'Length', 'Name', 'Format', 'Columns']) }
+        self.buf = bytearray()
+        self.ofs = 0
+        self.timestamp = 0
+        self.counts = {}
+        self.skipped = 0
+        self.records = bytearray()
+        if index_fh is not None:
+            index_fh.write(INDEX_MAGIC)
+
+    def end(self):
+        '''offset of the log data fed so far'''
+        return self.ofs + len(self.buf)
+
+    def feed(self, data):
+        '''add the next data of the log and index the whole messages in it'''
+        self.buf.extend(data)
+        buf = self.buf
+        pos = 0
+        n = len(buf)
+        formats = self.formats
+        while n - pos >= 3:
+            if buf[pos] != HEAD1 or buf[pos+1] != HEAD2 or buf[pos+2] not in formats:
+                # resync after corruption or a gap filled with zeros
+                nxt = buf.find(b'\xa3\x95', pos+1)
+                if nxt == -1:
+                    nxt = max(n - 1, pos + 1)
+                self.skipped += nxt - pos
+                pos = nxt
+                continue
+            fmt = formats[buf[pos+2]]
+            if n - pos < fmt.length:
+                break
+            if fmt.type == FMT_TYPE:
+                f = parse_fmt(buf[pos+3:pos+FMT_LENGTH])
+                if f.length >= 3:
+                    formats[f.type] = f
+            elif fmt.time_struct is not None:
+                self.timestamp = fmt.time_struct.unpack_from(buf, pos+3)[0] * fmt.time_scale
+            self.records.extend(RECORD.pack(fmt.type, self.ofs + pos, self.timestamp))
+            self.counts[fmt.type] = self.counts.get(fmt.type, 0) + 1
+            pos += fmt.length
+        del buf[:pos]
+        self.ofs += pos
+        if len(self.records) >= self.write_size:
+            self.flush()
+
+    def flush(self):
+        '''write out buffered index records'''
+        if self.index_fh is None:
+            self.records = bytearray()
+            return
+        if len(self.records) > 0:
+            self.index_fh.write(self.records)
+            self.records = bytearray()
+        self.index_fh.flush()
+
+    def close(self):
+        self.flush()
+        if self.index_fh is not None:
+            self.index_fh.close()
+            self.index_fh = None
+
+
+def index_filename(logfile):
+    '''the name of the index of a log'''
+    return logfile + '.idx'
+
+def record_dtype():
+    '''numpy type of an index record'''
+    import numpy
+    return numpy.dtype([('type', 'u1'), ('ofs', '<u8'), ('time', '<u8')])
+
+def load_index(logfile):
+    '''the DFIndex of a log if its index is up to date and covers the
+    whole log, otherwise None'''
+    try:
+        if os.path.getmtime(index_filename(logfile)) < os.path.getmtime(logfile):
+            return None
+        idx = DFIndex(logfile)
+    except (OSError, IOError, ValueError):
+        return None
+    if not idx.complete():
+        return None
+    return idx
+
+def index_log(logfile, chunk_size=1024*1024):
+    '''build the index of a log file, returning the indexer'''
+    indexer = DFIndexer(open(index_filename(logfile), 'wb'))
+    f = open(logfile, 'rb')
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        indexer.feed(data)
+    f.close()
+    indexer.close()
+    return indexer
+
+
+class DFIndex(object):
+    '''a loaded log index. Offsets and timestamps of each message type
+    are numpy arrays in log order'''
+    def __init__(self, logfile):
+        import numpy
+        self.logfile = logfile
+        f = open(index_filename(logfile), 'rb')
+        magic = f.read(len(INDEX_MAGIC))
+        if magic != INDEX_MAGIC:
+            f.close()
+            raise ValueError("Not a log index: %s" % index_filename(logfile))
+        self.records = numpy.fromfile(f, dtype=record_dtype())
+        f.close()
+        self.formats = {}
+        self.names = {}
+        # a type defined differently in different places in the log
+        self.redefined = False
+        log = open(logfile, 'rb')
+        for ofs in self.records['ofs'][self.records['type'] == FMT_TYPE]:
+            log.seek(int(ofs))
+            body = log.read(FMT_LENGTH)
+            fmt = parse_fmt(bytearray(body[3:]))
+            old = self.formats.get(fmt.type, None)
+            if old is not None and (old.name, old.format, old.columns) != (fmt.name, fmt.format, fmt.columns):
+                self.redefined = True
+            self.formats[fmt.type] = fmt
+            self.names[fmt.name] = fmt.type
+        log.close()
+        self._by_type = {}
+
+    def length(self, type):
+        '''length of a message type, or None if not known'''
+        if type in self.formats:
+            return self.formats[type].length
+        if type == FMT_TYPE:
+            return FMT_LENGTH
+        return None
+
+    def complete(self):
+        '''True if no whole message follows the last one indexed, so
+        only padding or a cut off message is left out of the index'''
+        if len(self.records) == 0:
+            return False
+        length = self.length(int(self.records['type'][-1]))
+        if length is None:
+            return False
+        f = open(self.logfile, 'rb')
+        f.seek(int(self.records['ofs'][-1]) + length)
+        tail = f.read()
+        f.close()
+        pos = tail.find(b'\xa3\x95')
+        while pos != -1 and pos + 2 < len(tail):
+            length = self.length(bytearray(tail[pos+2:pos+3])[0])
+            if length is not None and pos + length <= len(tail):
+                return False
+            pos = tail.find(b'\xa3\x95', pos+1)
+        return True
+
+    def types(self):
+        '''names of the message types in the log'''
+        present = set(self.records['type'].tolist())
+        return sorted([f.name for f in self.formats.values() if f.type in present])
+
+    def select(self, name):
+        '''index records of one message type'''
+        if name not in self._by_type:
+            type = self.names.get(name, None)
+            if type is None:
+                self._by_type[name] = self.records[:0]
+            else:
+                self._by_type[name] = self.records[self.records['type'] == type]
+        return self._by_type[name]
+
+    def count(self, name):
+        return len(self.select(name))
+
+    def offsets(self, name):
+        '''file offsets of the messages of a type'''
+        return self.select(name)['ofs']
+
+    def timestamps(self, name):
+        '''timestamps in microseconds of the messages of a type'''
+        return self.select(name)['time']
+
+    def time_range(self):
+        '''(first, last) timestamp in microseconds, or None'''
+        t = self.records['time']
+        t = t[t != 0]
+        if len(t) == 0:
+            return None
+        return (int(t.min()), int(t.max()))
+
+    def bodies(self, name):
+        '''the message bodies of a type, after the header, as a 2d numpy
+        array of bytes, one row per message'''
+        import numpy
+        fmt = self.formats[self.names[name]]
+        data = numpy.memmap(self.logfile, dtype='u1', mode='r')
+        ofs = self.offsets(name).astype(numpy.int64)
+        cols = numpy.arange(3, fmt.length)
+        return data[ofs[:, numpy.newaxis] + cols]
+
+
+if __name__ == "__main__":
+    import time
+    from optparse import OptionParser
+    parser = OptionParser("mp_dfindex.py [options] <LOG>")
+    parser.add_option("--no-scan", action='store_true', default=False, help="skip the full scan comparison")
+    (opts, args) = parser.parse_args()
+    if len(args) < 1:
+        print("Usage: mp_dfindex.py [options] <LOG>")
+        raise SystemExit(1)
+    logfile = args[0]
+    t0 = time.time()
+    indexer = index_log(logfile)
+    t1 = time.time()
+    print("indexed %u messages in %.2fs, %u bytes skipped" % (
+        sum(indexer.counts.values()), t1-t0, indexer.skipped))
+    t0 = time.time()
+    idx = DFIndex(logfile)
+    types = idx.types()
+    counts = [(t, idx.count(t)) for t in types]
+    t1 = time.time()
+    print("index loaded in %.3fs: %s" % (t1-t0, ' '.join(['%s:%u' % c for c in counts])))
+    if not opts.no_scan:
+        from pymavlink import mavutil
+        t0 = time.time()
+        mlog = mavutil.mavlink_connection(logfile)
+        scan = {}
+        while True:
+            m = mlog.recv_msg()
+            if m is None:
+                break
+            scan[m.get_type()] = scan.get(m.get_type(), 0) + 1
+        t1 = time.time()
+        mismatch = [t for t in scan if t in idx.names and scan[t] != idx.count(t)]
+        print("full scan in %.2fs, %u types differ" % (t1-t0, len(mismatch)))
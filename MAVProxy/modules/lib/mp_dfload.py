@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+'''
+parallel dataflash log loading
+
+load_columns reads a binary dataflash log into numpy columns, one per
+field of each message type, with a pool of processes. The FMT messages
+are found first with a search of the whole log. The log is then split
+into chunks that are walked a message at a time and decoded one
+message type at a time in parallel, each chunk carrying on from the
+message boundary the chunk before it ended on. The columns of the
+chunks are joined in log order.
+
+If the log has an up to date index from mp_dfindex, as the dataflash
+logger writes, the formats and message offsets come from the index
+instead, and neither the search nor the walk is needed.
+
+Timestamps follow DFReader's microsecond clock. The flight modes,
+parameters and vehicle type come from DFReader reading just the
+messages that set them, so the result is the same as reading the log
+with mavutil. Logs with other clocks give None, to be read a message
+at a time.
+
+Run this file directly with a log for a benchmark against reading it
+a message at a time.
+'''
+
+import os, mmap, struct, platform
+import numpy
+from pymavlink import DFReader
+from MAVProxy.modules.lib import mp_dfindex
+
+if platform.system() == 'Darwin':
+    from billiard import Pool, cpu_count
+else:
+    from multiprocessing import Pool, cpu_count
+
+# longest possible message, read past the end of each chunk
+MAX_LENGTH = 256
+# messages that must follow a candidate boundary at the start of a chunk
+SYNC_CHECK = 8
+
+# numpy types of the struct types in DFReader.FORMAT_TO_STRUCT
+STRUCT_TO_DTYPE = {
+    'b' : 'i1', 'B' : 'u1', 'h' : '<i2', 'H' : '<u2', 'i' : '<i4', 'I' : '<u4',
+    'q' : '<i8', 'Q' : '<u8', 'e' : '<f2', 'f' : '<f4', 'd' : '<f8',
+    '4s' : 'S4', '16s' : 'S16', '64s' : 'S64',
+}
+
+# messages that change the flight mode, vehicle type or parameters
+STATE_TYPES = ['MODE', 'MSG', 'VER', 'STAT', 'PARM']
+
+def format_dtype(format):
+    '''numpy structured type of a message body, or None if the
+    format has a type DFReader doesn't know'''
+    fields = []
+    for (i, c) in enumerate(format):
+        if c not in DFReader.FORMAT_TO_STRUCT:
+            return None
+        if c == 'a':
+            fields.append(('f%u' % i, '<i2', (32,)))
+        else:
+            fields.append(('f%u' % i, STRUCT_TO_DTYPE[DFReader.FORMAT_TO_STRUCT[c][0]]))
+    return numpy.dtype(fields)
+
+def valid_format(f):
+    '''check a FMT found by searching the log is a real one'''
+    if len(f.name) == 0 or not f.name.replace('_', '').isalnum():
+        return False
+    if len(f.columns) != len(f.format):
+        return False
+    dtype = format_dtype(f.format)
+    return dtype is not None and dtype.itemsize + 3 == f.length
+
+def find_formats(data):
+    '''find the FMT messages in a log, returning {type : DFFormat}, or
+    None if a type is defined differently in different places'''
+    formats = {}
+    pos = 0
+    while True:
+        pos = data.find(b'\xa3\x95\x80', pos)
+        if pos == -1 or pos + mp_dfindex.FMT_LENGTH > len(data):
+            break
+        f = mp_dfindex.parse_fmt(bytearray(data[pos+3:pos+mp_dfindex.FMT_LENGTH]))
+        if not valid_format(f):
+            pos += 1
+            continue
+        old = formats.get(f.type, None)
+        if old is not None and (old.name, old.format, old.columns) != (f.name, f.format, f.columns):
+            return None
+        formats[f.type] = f
+        pos += mp_dfindex.FMT_LENGTH
+    return formats
+
+def chains(data, lengths, pos, count):
+    '''check count messages follow on from pos, or the data ends'''
+    for i in range(count):
+        if len(data) - pos < 3:
+            return True
+        if data[pos] != mp_dfindex.HEAD1 or data[pos+1] != mp_dfindex.HEAD2 or lengths[data[pos+2]] == 0:
+            return False
+        pos += lengths[data[pos+2]]
+    return True
+
+def first_boundary(data, lengths, pos, end):
+    '''the first message boundary at or after pos, before end'''
+    while pos < end:
+        pos = data.find(b'\xa3\x95', pos)
+        if pos == -1 or pos >= end:
+            return end
+        if chains(data, lengths, pos, SYNC_CHECK):
+            return pos
+        pos += 1
+    return end
+
+def walk(data, lengths, pos, end):
+    '''return (offsets, types, next) of the messages starting before
+    end, skipping bad data as DFReader does, and the offset after them'''
+    offsets = []
+    types = bytearray()
+    n = len(data)
+    while pos < end and n - pos >= 3:
+        t = data[pos+2]
+        if data[pos] != mp_dfindex.HEAD1 or data[pos+1] != mp_dfindex.HEAD2 or lengths[t] == 0:
+            nxt = data.find(b'\xa3\x95', pos+1)
+            if nxt == -1:
+                nxt = n
+            pos = min(nxt, max(end, pos+1))
+            continue
+        if n - pos < lengths[t]:
+            break
+        offsets.append(pos)
+        types.append(t)
+        pos += lengths[t]
+    return (offsets, types, pos)
+
+def null_term(b):
+    '''decode a string as DFMessage does'''
+    try:
+        s = b.decode('utf-8')
+    except UnicodeDecodeError:
+        s = b.decode('ISO-8859-1')
+    i = s.find('\0')
+    if i != -1:
+        s = s[:i]
+    return s
+
+def convert(raw, c):
+    '''convert raw values of format character c to the values DFMessage
+    gives, as a column'''
+    if c in 'nNZ':
+        return numpy.array([null_term(b) for b in raw.tolist()])
+    if c == 'a':
+        return raw
+    (s, mul, type) = DFReader.FORMAT_TO_STRUCT[c]
+    if mul is not None:
+        # DFMessage divides rather than multiplies, for accuracy
+        return raw.astype(numpy.float64) / (1 / mul)
+    if type is float:
+        return raw.astype(numpy.float64)
+    return raw.astype(numpy.int64)
+
+def read_records(index_file, first, count):
+    '''(offsets, types) of count records of a log index from first'''
+    rec = numpy.fromfile(index_file, dtype=mp_dfindex.record_dtype(), count=count,
+                         offset=len(mp_dfindex.INDEX_MAGIC) + first * mp_dfindex.RECORD.size)
+    return (rec['ofs'].astype(numpy.int64), rec['type'].copy())
+
+def parse_chunk(args):
+    '''parse the messages of a log starting from start up to end, in a
+    pool process. If synced, start is known to be a message boundary.
+    records is None to walk the messages, or (index file, first, count)
+    of the index records of the chunk'''
+    (filename, formats, start, end, synced, timebase, records) = args
+    f = open(filename, 'rb')
+    f.seek(start)
+    data = bytearray(f.read(end - start + MAX_LENGTH))
+    f.close()
+    if records is not None:
+        (offsets, types) = read_records(*records)
+        offsets -= start
+        pos = 0
+        nxt = end - start
+    else:
+        lengths = [0] * 256
+        for (type, (length, name, format, columns)) in formats.items():
+            lengths[type] = length
+        pos = 0
+        if not synced:
+            pos = first_boundary(data, lengths, 0, end - start)
+        (offsets, types, nxt) = walk(data, lengths, pos, end - start)
+        offsets = numpy.array(offsets, dtype=numpy.int64)
+        types = numpy.frombuffer(bytes(types), dtype=numpy.uint8)
+    raw = numpy.frombuffer(bytes(data), dtype=numpy.uint8)
+    n = len(types)
+
+    # messages grouped by type, in log order within each type
+    by_type = numpy.argsort(types, kind='mergesort')
+    counts = numpy.bincount(types, minlength=256)
+    columns = {}
+    times = {}
+    tmsg = numpy.full(n, numpy.nan)
+    idx = 0
+    for type in range(256):
+        if counts[type] == 0:
+            continue
+        rows = by_type[idx:idx+counts[type]]
+        idx += counts[type]
+        (length, name, format, names) = formats[type]
+        ofs = offsets[rows]
+        body = raw[ofs[:, numpy.newaxis] + numpy.arange(3, length)]
+        rec = body.view(format_dtype(format))[:, 0]
+        columns[type] = [convert(rec['f%u' % i], format[i]) for i in range(len(format))]
+        if len(names) > 0 and names[0] == 'TimeUS':
+            tmsg[rows] = timebase + rec['f0'].astype(numpy.float64) * 0.000001
+
+    # other messages get the timestamp of the message before them, or
+    # NaN before the first in the chunk
+    if n > 0:
+        last = numpy.maximum.accumulate(numpy.where(numpy.isnan(tmsg), -1, numpy.arange(n)))
+        tmsg = numpy.where(last >= 0, tmsg[numpy.maximum(last, 0)], numpy.nan)
+    idx = 0
+    for type in range(256):
+        if counts[type] == 0:
+            continue
+        times[type] = tmsg[by_type[idx:idx+counts[type]]]
+        idx += counts[type]
+    return {'first' : start + pos,
+            'next' : start + nxt,
+            'types' : types,
+            'columns' : columns,
+            'times' : times,
+            'last' : tmsg[-1] if n > 0 else numpy.nan}
+
+
+class DFColumns(object):
+    '''the columns of a dataflash log, as load_columns gives them'''
+    def __init__(self):
+        self.types = []
+        self.fields = {}
+        self.columns = {}
+        self.timestamps = {}
+        self.order = None
+        self.flightmodes = []
+        self.params = {}
+        self.mav_type = None
+
+
+def load_columns(filename, progress_callback=None, processes=None, chunk_size=None, zero_time_base=False):
+    '''read a binary dataflash log into columns using processes processes,
+    by default one per CPU. Returns a DFColumns, or None if the log
+    needs reading a message at a time'''
+    mav = DFReader.DFReader_binary(filename, zero_time_base=zero_time_base)
+    clock = mav.clock
+    if clock is None or 'usec' not in type(clock).__name__.lower():
+        return None
+    timebase = clock.timebase
+    initial = clock.timestamp
+
+    f = open(filename, 'rb')
+    size = os.fstat(f.fileno()).st_size
+    if size == 0:
+        f.close()
+        return None
+    index = mp_dfindex.load_index(filename)
+    if index is not None and not index.redefined:
+        formats = index.formats
+        if not all([valid_format(fmt) for fmt in formats.values()]):
+            index = None
+    else:
+        index = None
+    if index is None:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        formats = find_formats(data)
+        data.close()
+    f.close()
+    if formats is None:
+        return None
+    for fmt in formats.values():
+        if len(fmt.columns) > 0 and fmt.columns[0] == 'TimeMS':
+            # DFReader's clock decides message by message on these
+            return None
+    fmts = dict([(t, (f.length, f.name, f.format, f.columns)) for (t, f) in formats.items()])
+
+    if processes is None:
+        processes = cpu_count()
+    if chunk_size is None:
+        chunk_size = max(size // (4 * processes) + 1, 4*1024*1024)
+    if index is not None:
+        # chunks start at the first message at or after each chunk_size
+        offsets = index.records['ofs']
+        bounds = numpy.unique(numpy.searchsorted(offsets, numpy.arange(0, size, chunk_size))).tolist()
+        bounds = [b for b in bounds if b < len(offsets)] + [len(offsets)]
+        work = []
+        for (b0, b1) in zip(bounds[:-1], bounds[1:]):
+            end = int(offsets[b1]) if b1 < len(offsets) else size
+            work.append((filename, fmts, int(offsets[b0]), end, True, timebase,
+                         (mp_dfindex.index_filename(filename), b0, b1 - b0)))
+    else:
+        starts = list(range(0, size, chunk_size))
+        work = [(filename, fmts, s, min(s + chunk_size, size), s == 0, timebase, None) for s in starts]
+    results = []
+    if processes > 1 and len(work) > 1:
+        pool = Pool(processes)
+        for r in pool.imap(parse_chunk, work):
+            results.append(r)
+            if progress_callback:
+                progress_callback(int(100 * len(results) / len(work)))
+        pool.close()
+        pool.join()
+    else:
+        for w in work:
+            results.append(parse_chunk(w))
+            if progress_callback:
+                progress_callback(int(100 * len(results) / len(work)))
+
+    # a chunk that found a different first message to where the one
+    # before it ended is parsed again from there
+    for i in range(1, len(results)):
+        if results[i]['first'] != results[i-1]['next']:
+            (fn, fm, start, end, synced, tb, rec) = work[i]
+            results[i] = parse_chunk((fn, fm, results[i-1]['next'], max(end, results[i-1]['next']), True, tb, None))
+
+    ret = DFColumns()
+    ids = {}
+    for r in results:
+        # types in the order they first appear, as reading the log finds them
+        (present, first) = numpy.unique(r['types'], return_index=True)
+        for mtype in present[numpy.argsort(first)].tolist():
+            if mtype not in ids:
+                ids[mtype] = len(ret.types)
+                ret.types.append(mtype)
+    lookup = numpy.zeros(256, dtype=numpy.uint16)
+    for (mtype, i) in ids.items():
+        lookup[mtype] = i
+    ret.order = numpy.concatenate([lookup[r['types']] for r in results])
+
+    carry = initial
+    for r in results:
+        for mtype in r['times']:
+            t = r['times'][mtype]
+            t[numpy.isnan(t)] = carry
+        if not numpy.isnan(r['last']):
+            carry = r['last']
+    names = [formats[mtype].name for mtype in ret.types]
+    for (mtype, name) in zip(ret.types, names):
+        ret.fields[name] = formats[mtype].columns
+        ret.columns[name] = dict(zip(formats[mtype].columns,
+                                     [numpy.concatenate([r['columns'][mtype][i] for r in results if mtype in r['columns']])
+                                      for i in range(len(formats[mtype].columns))]))
+        ret.timestamps[name] = numpy.concatenate([r['times'][mtype] for r in results if mtype in r['times']])
+    ret.types = names
+
+    # flight modes as mavcolumnlog.build records them, from the
+    # messages that change them
+    first = None
+    last = None
+    for name in names:
+        t = ret.timestamps[name]
+        p = numpy.flatnonzero(ret.order == names.index(name))
+        if first is None or p[0] < first[0]:
+            first = (p[0], t[0])
+        if last is None or p[-1] > last[0]:
+            last = (p[-1], t[-1])
+    if first is not None:
+        ret.flightmodes.append((mav.flightmode, float(first[1]), None))
+        state = [t for t in STATE_TYPES if t in ret.fields]
+        while len(state) > 0:
+            m = mav.recv_match(type=state)
+            if m is None:
+                break
+            if mav.flightmode != ret.flightmodes[-1][0]:
+                (mode, t1, t2) = ret.flightmodes[-1]
+                ret.flightmodes[-1] = (mode, t1, m._timestamp)
+                ret.flightmodes.append((mav.flightmode, m._timestamp, None))
+        (mode, t1, t2) = ret.flightmodes[-1]
+        ret.flightmodes[-1] = (mode, t1, float(last[1]))
+    ret.params = dict(mav.params)
+    ret.mav_type = getattr(mav, 'mav_type', None)
+    return ret
+
+
+if __name__ == "__main__":
+    import time
+    from optparse import OptionParser
+    from pymavlink import mavutil
+    from MAVProxy.modules.lib import mavcolumnlog
+    parser = OptionParser("mp_dfload.py [options] <LOG>")
+    parser.add_option("--processes", type='int', default=None, help="number of processes")
+    parser.add_option("--no-compare", action='store_true', default=False, help="skip reading the log a message at a time")
+    (opts, args) = parser.parse_args()
+    if len(args) < 1:
+        print("Usage: mp_dfload.py [options] <LOG>")
+        raise SystemExit(1)
+    logfile = args[0]
+    t0 = time.time()
+    cols = load_columns(logfile, processes=opts.processes)
+    t1 = time.time()
+    if cols is None:
+        print("log needs reading a message at a time")
+        raise SystemExit(1)
+    print("parallel: %u messages in %.2fs with %u processes" % (
+        len(cols.order), t1-t0, opts.processes or cpu_count()))
+    if not opts.no_compare:
+        t0 = time.time()
+        mlog = mavcolumnlog.mavcolumnlog()
+        mlog.build(mavutil.mavlink_connection(logfile))
+        t1 = time.time()
+        print("message at a time: %u messages in %.2fs" % (mlog._count, t1-t0))
+        differ = []
+        for type in mlog.types():
+            if type not in cols.columns or not numpy.array_equal(mlog.timestamps(type), cols.timestamps[type]):
+                differ.append(type)
+                continue
+            for f in mlog.fields(type):
+                if not numpy.array_equal(mlog.column(type, f), cols.columns[type].get(f, None)):
+                    differ.append("%s.%s" % (type, f))
+        if mlog.flightmode_list() != cols.flightmodes:
+            differ.append('flightmodes')
+        if dict(mlog.params) != cols.params or mlog.mav_type != cols.mav_type:
+            differ.append('params')
+        if not numpy.array_equal(mlog._order, cols.order):
+            differ.append('order')
+        print("%u differences %s" % (len(differ), ' '.join(differ)))
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+'''
+geofence geometry
+
+FenceGeometry answers whether points are inside a fence polygon and
+how far they are from its boundary. The polygon is converted to a
+local flat earth frame in meters and its edges are indexed in a grid,
+so a query only looks at the edges near the point rather than at the
+whole fence, which matters for fences made from KML with thousands of
+vertices.
+
+Run this file directly for a benchmark against a brute force search.
+'''
+
+import math
+from MAVProxy.modules.lib import mp_util
+
+def segment_distance(px, py, x1, y1, x2, y2):
+    '''distance from a point to a line segment'''
+    dx = x2 - x1
+    dy = y2 - y1
+    len2 = dx*dx + dy*dy
+    if len2 == 0:
+        t = 0
+    else:
+        t = ((px - x1)*dx + (py - y1)*dy) / len2
+        t = max(0.0, min(1.0, t))
+    ex = x1 + t*dx - px
+    ey = y1 + t*dy - py
+    return math.sqrt(ex*ex + ey*ey)
+
+
+class FenceGeometry(object):
+    '''inside/outside and distance to boundary tests for a polygon given
+    as a list of (lat, lon) points. cell_edges is the average number of
+    edges per grid cell to aim for'''
+    def __init__(self, polygon, cell_edges=4):
+        points = list(polygon)
+        if len(points) > 1 and tuple(points[0][:2]) == tuple(points[-1][:2]):
+            # drop closing point
+            points = points[:-1]
+        if len(points) < 3:
+            raise ValueError("fence polygon needs at least 3 points")
+        (minlat, minlon, dlat, dlon) = mp_util.polygon_bounds(points)
+        self.lat0 = minlat + dlat/2
+        self.lon0 = minlon + dlon/2
+        self.scale = math.radians(1) * mp_util.radius_of_earth
+        self.coslat = math.cos(math.radians(self.lat0))
+
+        self.edges = []
+        n = len(points)
+        for i in range(n):
+            (x1, y1) = self.local(points[i][0], points[i][1])
+            (x2, y2) = self.local(points[(i+1)%n][0], points[(i+1)%n][1])
+            self.edges.append((x1, y1, x2, y2))
+
+        xs = [e[0] for e in self.edges]
+        ys = [e[1] for e in self.edges]
+        self.minx = min(xs)
+        self.miny = min(ys)
+        self.maxx = max(xs)
+        self.maxy = max(ys)
+        width = max(self.maxx - self.minx, 1.0)
+        height = max(self.maxy - self.miny, 1.0)
+        ncells = max(len(self.edges) // cell_edges, 1)
+        self.cell = max(math.sqrt(width * height / ncells), 1.0)
+        self.ncols = int(width / self.cell) + 1
+        self.nrows = int(height / self.cell) + 1
+
+        # edges touching each cell, and edges spanning each row for the
+        # crossing test
+        self.cells = {}
+        self.rows = [[] for r in range(self.nrows)]
+        for i in range(len(self.edges)):
+            (x1, y1, x2, y2) = self.edges[i]
+            (c1, r1) = self.cell_index(min(x1, x2), min(y1, y2))
+            (c2, r2) = self.cell_index(max(x1, x2), max(y1, y2))
+            for r in range(r1, r2+1):
+                self.rows[r].append(i)
+                for c in self.edge_columns(self.edges[i], r, c1, c2):
+                    self.cells.setdefault((c, r), []).append(i)
+
+    def local(self, lat, lon):
+        '''convert lat/lon to meters east and north of the fence centre'''
+        return ((lon - self.lon0) * self.scale * self.coslat,
+                (lat - self.lat0) * self.scale)
+
+    def cell_index(self, x, y):
+        '''grid cell of a local point, clamped to the grid'''
+        c = int((x - self.minx) / self.cell)
+        r = int((y - self.miny) / self.cell)
+        return (min(max(c, 0), self.ncols-1), min(max(r, 0), self.nrows-1))
+
+    def edge_columns(self, edge, r, c1, c2):
+        '''the columns of row r that an edge passes through'''
+        (x1, y1, x2, y2) = edge
+        if c1 == c2 or y1 == y2:
+            return range(c1, c2+1)
+        # clip the edge to the row band to find its x extent there
+        ylo = self.miny + r * self.cell
+        yhi = ylo + self.cell
+        ta = (ylo - y1) / (y2 - y1)
+        tb = (yhi - y1) / (y2 - y1)
+        ta = max(0.0, min(1.0, ta))
+        tb = max(0.0, min(1.0, tb))
+        xa = x1 + ta * (x2 - x1)
+        xb = x1 + tb * (x2 - x1)
+        ca = self.cell_index(min(xa, xb), ylo)[0]
+        cb = self.cell_index(max(xa, xb), ylo)[0]
+        return range(ca, cb+1)
+
+    def inside_local(self, x, y):
+        if x < self.minx or x > self.maxx or y < self.miny or y > self.maxy:
+            return False
+        r = min(int((y - self.miny) / self.cell), self.nrows-1)
+        inside = False
+        for i in self.rows[r]:
+            (x1, y1, x2, y2) = self.edges[i]
+            if (y1 > y) != (y2 > y):
+                if x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                    inside = not inside
+        return inside
+
+    def inside(self, lat, lon):
+        '''return True if a point is inside the fence'''
+        (x, y) = self.local(lat, lon)
+        return self.inside_local(x, y)
+
+    def distance_local(self, x, y):
+        '''distance to the nearest edge, searching rings of cells outward
+        until no unsearched cell can hold a closer edge'''
+        c = int(math.floor((x - self.minx) / self.cell))
+        r = int(math.floor((y - self.miny) / self.cell))
+        # rings closer than this hold no cells
+        k = max(0, -c, c - (self.ncols-1), -r, r - (self.nrows-1))
+        kmax = max(c, self.ncols-1-c, r, self.nrows-1-r)
+        best = None
+        seen = set()
+        while k <= kmax:
+            for (cc, rr) in self.ring(c, r, k):
+                for i in self.cells.get((cc, rr), []):
+                    if i in seen:
+                        continue
+                    seen.add(i)
+                    d = segment_distance(x, y, *self.edges[i])
+                    if best is None or d < best:
+                        best = d
+            if best is not None and best <= k * self.cell:
+                break
+            k += 1
+        return best
+
+    def ring(self, c, r, k):
+        '''the grid cells at chebyshev distance k from cell (c, r)'''
+        if k == 0:
+            cells = [(c, r)]
+        else:
+            cells = []
+            for cc in range(c-k, c+k+1):
+                cells.append((cc, r-k))
+                cells.append((cc, r+k))
+            for rr in range(r-k+1, r+k):
+                cells.append((c-k, rr))
+                cells.append((c+k, rr))
+        return [(cc, rr) for (cc, rr) in cells
+                if cc >= 0 and cc < self.ncols and rr >= 0 and rr < self.nrows]
+
+    def distance(self, lat, lon):
+        '''distance in meters from a point to the fence boundary'''
+        (x, y) = self.local(lat, lon)
+        return self.distance_local(x, y)
+
+    def breach_distance(self, lat, lon):
+        '''distance in meters to the boundary, positive inside the fence
+        and negative outside it'''
+        (x, y) = self.local(lat, lon)
+        d = self.distance_local(x, y)
+        if self.inside_local(x, y):
+            return d
+        return -d
+
+
+def brute_inside(geom, lat, lon):
+    '''reference crossing test over every edge'''
+    (x, y) = geom.local(lat, lon)
+    inside = False
+    for (x1, y1, x2, y2) in geom.edges:
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+def brute_distance(geom, lat, lon):
+    '''reference distance over every edge'''
+    (x, y) = geom.local(lat, lon)
+    return min([segment_distance(x, y, *e) for e in geom.edges])
+
+
+if __name__ == "__main__":
+    import time, random
+    from optparse import OptionParser
+    parser = OptionParser("mp_geofence.py [options]")
+    parser.add_option("--vertices", type='int', default=5000, help="number of fence vertices")
+    parser.add_option("--points", type='int', default=2000, help="number of test points")
+    (opts, args) = parser.parse_args()
+
+    # a ragged star shaped fence, like a traced boundary from a KML file
+    rnd = random.Random(1)
+    (lat, lon) = (-35.363261, 149.165230)
+    polygon = []
+    for i in range(opts.vertices):
+        bearing = 360.0 * i / opts.vertices
+        radius = 2000 + 800 * math.sin(math.radians(bearing) * 7) + rnd.uniform(-100, 100)
+        polygon.append(mp_util.gps_newpos(lat, lon, bearing, radius))
+    t0 = time.time()
+    geom = FenceGeometry(polygon)
+    t1 = time.time()
+    points = [mp_util.gps_newpos(lat, lon, rnd.uniform(0, 360), rnd.uniform(0, 3500))
+              for i in range(opts.points)]
+    print("%u vertices, %u x %u grid built in %.1fms" % (opts.vertices, geom.ncols, geom.nrows, (t1-t0)*1000))
+
+    t0 = time.time()
+    r1 = [geom.breach_distance(p[0], p[1]) for p in points]
+    t1 = time.time()
+    nbrute = min(opts.points, 200)
+    r2 = [brute_distance(geom, p[0], p[1]) * (1 if brute_inside(geom, p[0], p[1]) else -1)
+          for p in points[:nbrute]]
+    t2 = time.time()
+    errors = len([i for i in range(nbrute) if abs(r1[i] - r2[i]) > 1.0e-6])
+    print("indexed: %.0f points/s" % (opts.points / (t1-t0)))
+    print("brute force: %.0f points/s" % (nbrute / (t2-t1)))
+    print("%u mismatches in %u points" % (errors, nbrute))
@@ -0,0 +1,844 @@
+#!/usr/bin/env python
+'''
+onboard log download
+
+LogDownload fetches a log with LOG_REQUEST_DATA, tracking which 90
+byte blocks have arrived in an IndexBitmap. The whole log is first
+streamed, then the gaps are filled in passes over the file.
+
+The autopilot serves one LOG_REQUEST_DATA at a time and a new request
+replaces the one in progress, so requests for gaps are timed from the
+measured round trip and block rate to arrive as the request before
+them finishes, with an adaptive window of requests outstanding.
+Nearby gaps are merged into one range so each request lasts long
+enough to be followed by the next. Received data is written to the
+file in large contiguous chunks.
+
+The received blocks can be saved to a sidecar file next to the log so
+that an interrupted download, even from an earlier run of MAVProxy,
+only fetches what is missing.
+
+For downloads in the background a LinkBudget measures the traffic on
+the link and limits the rate that log blocks are requested at, so the
+log never starves telemetry, and a LogQueue keeps the logs waiting to
+be downloaded, and a record of those already downloaded, on disk.
+The sha1 of each log is taken as it is written, so recording a finished
+download doesn't read the whole log back in the main loop. A local copy
+only counts as already downloaded once it has been hashed again, in a
+background thread, and found to match.
+
+Run this file directly for a benchmark against the old downloader on
+a simulated lossy link.
+'''
+
+import time, os, json, zlib, base64, hashlib, threading
+from MAVProxy.modules.lib.mp_transfer import IndexBitmap, TransferProgress
+
+BLOCK_SIZE = 90
+
+class LogRequest(object):
+    '''one LOG_REQUEST_DATA range of blocks [first, end). stream is True
+    for a request that runs to the end of the log, when end is the end
+    of the log if known or None'''
+    def __init__(self, first, end, now, start, stream=False):
+        self.first = first
+        self.end = end
+        self.stream = stream
+        self.sent = now
+        self.start = start
+        self.first_arrival = None
+        self.last_arrival = None
+        self.count = 0
+        self.highest = None
+
+    def contains(self, block):
+        return block >= self.first and (self.end is None or block < self.end)
+
+    def arrived(self, block, now):
+        if self.first_arrival is None:
+            self.first_arrival = now
+        self.last_arrival = now
+        self.count += 1
+        if self.highest is None or block > self.highest:
+            self.highest = block
+
+    def served(self):
+        '''True once the last block of the range has arrived'''
+        return self.end is not None and self.highest is not None and self.highest >= self.end - 1
+
+
+class LogDownload(object):
+    '''download of one log into an open file. request(ofs, count) sends a
+    LOG_REQUEST_DATA. size is the log size from LOG_ENTRY, or None if
+    not known, in which case the end is found from a short LOG_DATA'''
+    def __init__(self, lognum, size, fh, request, write_size=65536,
+                 merge=4, max_span=4096, max_window=64):
+        self.lognum = lognum
+        self.fh = fh
+        self.request = request
+        self.write_size = write_size
+        self.merge = merge
+        self.max_span = max_span
+        self.max_window = max_window
+        self.size = None
+        self.nblocks = None
+        self.bitmap = IndexBitmap()
+        self.requests = []
+        if size:
+            self.set_size(size)
+        self.progress = TransferProgress(self.size or 0)
+        self.resumed_bytes = 0
+        self.window = 4.0
+        self.srtt = None
+        self.block_rate = None
+        self.pass_pos = 0
+        self.passes = 0
+        self.request_count = 0
+        self.lost_requests = 0
+        self.lost_in_row = 0
+        self.last_check = None
+        self.check_interval = 0.0
+        self.duplicates = 0
+        self.wbuf = bytearray()
+        self.wbuf_ofs = 0
+        self.writes = 0
+        # sha1 of the log up to offset hashed
+        self.sha1 = hashlib.sha1()
+        self.hashed = 0
+        # blocks per second requests are paced to, None for no limit
+        self.max_rate = None
+        self.tokens = None
+        self.token_time = None
+
+    def set_size(self, size):
+        '''set the log size once known'''
+        self.size = size
+        self.nblocks = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+        self.bitmap.resize(self.nblocks)
+        for r in self.requests:
+            if r.stream:
+                r.end = self.nblocks
+
+    def start(self, now=None):
+        '''start by streaming the log, from the first missing block if
+        resuming with nothing received beyond it'''
+        if now is None:
+            now = time.time()
+        self.progress.reset(now)
+        if self.paced():
+            # a stream can't be paced, so fetch the log in ranges
+            self.check(now)
+            return
+        if self.bitmap.count == 0:
+            self.send_request(0, self.nblocks, now, stream=True)
+            return
+        first = self.bitmap.bits.find(b'\x00')
+        if first != -1 and self.bitmap.bits.rfind(b'\x01') < first:
+            self.send_request(first, self.nblocks, now, stream=True)
+        else:
+            self.check(now)
+
+    def resume(self, bits):
+        '''mark the blocks received by an earlier download, given its bitmap'''
+        self.bitmap.bits[:len(bits)] = bits[:len(self.bitmap.bits)]
+        self.bitmap.count = self.bitmap.bits.count(b'\x01')
+        self.resumed_bytes = self.received_bytes()
+        self.progress.total = max(self.size - self.resumed_bytes, 0)
+
+    def save_resume(self, path, time_utc):
+        '''write the received blocks to a sidecar file. The log must have
+        a known size'''
+        self.flush()
+        self.fh.flush()
+        state = { 'id' : self.lognum,
+                  'size' : self.size,
+                  'time_utc' : time_utc,
+                  'blocks' : base64.b64encode(zlib.compress(bytes(self.bitmap.bits))).decode('ascii') }
+        f = open(path, 'w')
+        json.dump(state, f)
+        f.close()
+
+    def send_request(self, first, end, now, stream=False):
+        if stream:
+            self.request(first * BLOCK_SIZE, 0xFFFFFFFF)
+        else:
+            self.request(first * BLOCK_SIZE, (end - first) * BLOCK_SIZE)
+        start = now + (self.srtt or 0)
+        if len(self.requests) > 0:
+            start = max(start, self.expected_end(self.requests[-1]))
+        self.requests.append(LogRequest(first, end, now, start, stream))
+        self.request_count += 1
+
+    def complete(self):
+        return self.nblocks is not None and self.bitmap.count >= self.nblocks
+
+    def received_bytes(self):
+        '''number of bytes received so far'''
+        if self.size is not None and (self.nblocks - 1) in self.bitmap:
+            return self.bitmap.count * BLOCK_SIZE - (self.nblocks * BLOCK_SIZE - self.size)
+        return self.bitmap.count * BLOCK_SIZE
+
+    def received(self, ofs, count, data, now=None):
+        '''handle a LOG_DATA, returning True when the log is complete'''
+        if now is None:
+            now = time.time()
+        block = ofs // BLOCK_SIZE
+        if count < BLOCK_SIZE and (self.size is None or ofs + count < self.size):
+            # a short block marks the end of the log
+            self.set_size(ofs + count)
+        for r in self.requests:
+            if r.contains(block):
+                r.arrived(block, now)
+                break
+        if count > 0 and (self.nblocks is None or block < self.nblocks):
+            if self.bitmap.add(block):
+                self.write(ofs, data[:count])
+            else:
+                self.duplicates += 1
+        self.progress.update(self.received_bytes() - self.resumed_bytes)
+        if self.complete():
+            self.flush()
+            return True
+        return False
+
+    def write(self, ofs, data):
+        '''buffer data for the file, writing when the buffer is full or
+        the data is not contiguous with it'''
+        if len(self.wbuf) > 0 and ofs != self.wbuf_ofs + len(self.wbuf):
+            self.flush()
+        if len(self.wbuf) == 0:
+            self.wbuf_ofs = ofs
+        self.wbuf.extend(data)
+        if len(self.wbuf) >= self.write_size:
+            self.flush()
+
+    def flush(self):
+        '''write out buffered data'''
+        if len(self.wbuf) == 0:
+            return
+        self.fh.seek(self.wbuf_ofs)
+        self.fh.write(self.wbuf)
+        self.writes += 1
+        if self.wbuf_ofs == self.hashed:
+            self.sha1.update(self.wbuf)
+            self.hashed += len(self.wbuf)
+        self.wbuf = bytearray()
+
+    def hash_catch_up(self, max_bytes=65536):
+        '''hash up to max_bytes of data written ahead of the hash, as it
+        is when gaps are filled or a download is resumed. The file must
+        be open for reading'''
+        if self.size is None or self.hashed >= self.size:
+            return
+        missing = self.bitmap.bits.find(b'\x00', self.hashed // BLOCK_SIZE)
+        if missing == -1:
+            end = self.size
+        else:
+            end = min(missing * BLOCK_SIZE, self.size)
+        if len(self.wbuf) > 0:
+            # buffered data is not in the file yet
+            end = min(end, self.wbuf_ofs)
+        if end <= self.hashed:
+            return
+        self.fh.flush()
+        self.fh.seek(self.hashed)
+        data = self.fh.read(min(end - self.hashed, max_bytes))
+        if not data:
+            return
+        self.sha1.update(data)
+        self.hashed += len(data)
+
+    def digest(self):
+        '''hex sha1 of the complete log, or None if it hasn't all been
+        hashed yet'''
+        if self.size is None or self.hashed != self.size:
+            return None
+        return self.sha1.hexdigest()
+
+    def timeout(self):
+        '''silence after which a request is taken as finished'''
+        if self.srtt is None:
+            return 1.0
+        return min(max(2 * self.srtt, 0.2), 3.0)
+
+    def rate(self):
+        '''blocks per second the vehicle sends, or None if not yet known'''
+        if self.block_rate is not None:
+            return self.block_rate
+        if len(self.requests) > 0:
+            r = self.requests[0]
+            if r.count > 10 and r.last_arrival > r.first_arrival:
+                return (r.count - 1) / (r.last_arrival - r.first_arrival)
+        return None
+
+    def expected_end(self, r):
+        '''expected time the last block of request r arrives, or None'''
+        rate = self.rate()
+        if rate is None or r.end is None:
+            return None
+        if r.highest is None:
+            return r.start + (r.end - r.first) / rate
+        return r.last_arrival + (r.end - 1 - r.highest) / rate
+
+    def request_done(self, r, now):
+        '''update link estimates and the window from a finished request'''
+        if r.first_arrival is None:
+            # the request or all of its replies were lost. Odd losses are
+            # normal on a radio link, several in a row mean it has stalled
+            self.lost_requests += 1
+            self.lost_in_row += 1
+            if self.lost_in_row >= 3:
+                self.window = max(self.window / 2, 1.0)
+            else:
+                self.window = max(self.window - 1, 1.0)
+            return
+        self.lost_in_row = 0
+        rtt = r.first_arrival - r.sent
+        if r.start <= r.sent + (self.srtt or 0):
+            # only requests that found the vehicle idle give the round trip
+            if self.srtt is None:
+                self.srtt = rtt
+            else:
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        if r.count >= 50 and r.last_arrival > r.first_arrival:
+            # short requests are too quick to time
+            rate = (r.count - 1) / (r.last_arrival - r.first_arrival)
+            if self.block_rate is None:
+                self.block_rate = rate
+            else:
+                self.block_rate = 0.75 * self.block_rate + 0.25 * rate
+        self.window = min(self.window + 1, self.max_window)
+
+    def finished(self, r, now):
+        '''return True if request r is no longer being served'''
+        if r.served():
+            return True
+        for r2 in self.requests[self.requests.index(r)+1:]:
+            if r2.first_arrival is not None:
+                # the vehicle has moved on to a later request
+                return True
+        end = self.expected_end(r)
+        last = r.last_arrival
+        if last is None:
+            last = r.start
+        if end is not None:
+            last = max(last, end)
+        return now - last > self.timeout()
+
+    def paced(self):
+        '''True if requests are limited to max_rate. Only a log of known
+        size can be paced, as the end of an unknown one is found by
+        streaming it'''
+        return self.max_rate is not None and self.nblocks is not None
+
+    def next_range(self, limit=None):
+        '''choose the next range of missing blocks from the pass position,
+        returning (first, end, stream) or None at the end of a pass. The
+        range spans at most limit blocks if given'''
+        first = self.bitmap.bits.find(b'\x00', self.pass_pos)
+        if first == -1:
+            if self.nblocks is None:
+                # keep streaming past what we have seen of the log
+                return (len(self.bitmap), None, True)
+            return None
+        span = self.max_span
+        if limit is not None:
+            span = min(span, limit)
+        last = first
+        minimum = self.min_range()
+        for (start, count) in self.bitmap.missing_ranges(first, first + span):
+            if start - last > self.merge and start - first > minimum:
+                break
+            last = start + count
+        return (first, last, False)
+
+    def min_range(self):
+        '''blocks a request should span. Each request replaces the one
+        before it, so a new one is only sent when the last is about to
+        end, and a request must last until the next check, and be long
+        enough that a full window of requests covers a round trip'''
+        rate = self.rate()
+        if rate is None or self.srtt is None:
+            return 0
+        return int(rate * max(2 * self.check_interval, self.srtt / self.max_window))
+
+    def check(self, now=None):
+        '''finish stale requests and send new ones. Requests are sent to
+        arrive as the one before them finishes, with up to window of them
+        outstanding'''
+        if now is None:
+            now = time.time()
+        if self.last_check is not None:
+            self.check_interval = 0.9 * self.check_interval + 0.1 * (now - self.last_check)
+        self.last_check = now
+        while len(self.requests) > 0 and self.finished(self.requests[0], now):
+            self.request_done(self.requests.pop(0), now)
+        self.hash_catch_up()
+        if self.complete():
+            return
+        limit = None
+        if self.paced():
+            # a token bucket holding up to a second of blocks
+            if self.tokens is None:
+                self.tokens = self.max_rate
+            else:
+                self.tokens = min(self.tokens + (now - self.token_time) * self.max_rate,
+                                  self.max_rate)
+            self.token_time = now
+        while len(self.requests) < int(self.window):
+            if len(self.requests) > 0:
+                last = self.requests[-1]
+                end = self.expected_end(last)
+                if last.stream or end is None or end - (self.srtt or 0) > now:
+                    break
+            if self.paced():
+                # wait for enough tokens to make a request worth sending
+                limit = int(self.tokens)
+                if limit < max(1, min(int(self.max_rate / 5), self.nblocks - self.bitmap.count)):
+                    break
+            r = self.next_range(limit)
+            if r is None:
+                if len(self.requests) > 0:
+                    # wait for the pass to finish before starting another
+                    break
+                self.pass_pos = 0
+                self.passes += 1
+                r = self.next_range(limit)
+                if r is None:
+                    break
+            (first, end, stream) = r
+            self.send_request(first, end, now, stream)
+            if end is not None:
+                self.pass_pos = end
+                if self.paced():
+                    self.tokens -= end - first
+
+    def summary(self, now=None):
+        '''one line summary of the download so far'''
+        elapsed = self.progress.elapsed(now)
+        kbs = self.progress.rate(now) / 1024.0
+        eta = self.progress.eta(now)
+        if self.size is None:
+            total = '?'
+        else:
+            total = '%u' % self.size
+        if eta is None:
+            eta = '?'
+        else:
+            eta = '%us' % eta
+        return "log %u %u/%s bytes in %us %.1f kB/s ETA %s (%u requests, %u passes)" % (
+            self.lognum, self.received_bytes(), total, elapsed, kbs, eta,
+            self.request_count, self.passes)
+
+    def report(self, now=None):
+        '''return a progress line if one is due, or None'''
+        if self.progress.report_due(now):
+            return self.summary(now)
+        return None
+
+
+class LinkBudget(object):
+    '''measures the bytes per second on a link, split into log data and
+    other traffic, and sets rate, the blocks per second log data may be
+    requested at. The rate grows while the other traffic keeps the rate
+    it had without log traffic, and halves when it drops, which is taken
+    as the link being full. The total rate seen then is the capacity of
+    the link, and log data is kept to fraction of it'''
+    def __init__(self, fraction=0.5, interval=1.0, initial_rate=20.0,
+                 min_rate=5.0, drop=0.9):
+        self.fraction = fraction
+        self.interval = interval
+        self.min_rate = min_rate
+        self.drop = drop
+        self.rate = initial_rate
+        self.capacity = None
+        self.baseline = None
+        self.other_rate = None
+        self.log_rate = 0.0
+        self.block_bytes = 110.0
+        self.congestions = 0
+        self.last_update = None
+        self.log_bytes = 0
+        self.log_count = 0
+        self.other_bytes = 0
+
+    def packet(self, nbytes, log=False):
+        '''count a received packet'''
+        if log:
+            self.log_bytes += nbytes
+            self.log_count += 1
+        else:
+            self.other_bytes += nbytes
+
+    def limit(self):
+        '''blocks per second of log data the measured capacity allows, or
+        None if the capacity is not yet known'''
+        if self.capacity is None:
+            return None
+        spare = self.capacity * self.fraction
+        if self.baseline is not None:
+            spare = min(spare, self.capacity - self.baseline)
+        return max(spare / self.block_bytes, self.min_rate)
+
+    def update(self, now=None):
+        '''update the measurements and rate, once per interval'''
+        if now is None:
+            now = time.time()
+        if self.last_update is None:
+            self.last_update = now
+            return
+        dt = now - self.last_update
+        if dt < self.interval:
+            return
+        other = self.other_bytes / dt
+        self.log_rate = self.log_bytes / dt
+        total = other + self.log_rate
+        if self.log_count > 0:
+            self.block_bytes = self.log_bytes / float(self.log_count)
+        (self.log_bytes, self.log_count, self.other_bytes) = (0, 0, 0)
+        self.last_update = now
+        if self.other_rate is None:
+            self.other_rate = other
+        else:
+            self.other_rate = 0.5 * self.other_rate + 0.5 * other
+        if self.log_rate == 0:
+            # the other traffic on its own sets the baseline
+            if self.baseline is None:
+                self.baseline = other
+            else:
+                self.baseline = 0.8 * self.baseline + 0.2 * other
+            return
+        if self.baseline is not None and self.other_rate < self.drop * self.baseline:
+            # log data is crowding out other traffic
+            self.congestions += 1
+            self.capacity = total
+            self.rate = max(self.rate / 2, self.min_rate)
+            self.other_rate = None
+            return
+        if self.capacity is not None:
+            # probe for a link that has got faster
+            self.capacity = max(self.capacity * 1.01, total)
+        if self.log_rate >= 0.7 * self.rate * self.block_bytes:
+            # only grow a rate that is being used
+            self.rate *= 1.25
+        limit = self.limit()
+        if limit is not None:
+            self.rate = min(self.rate, limit)
+
+
+def file_sha1(path):
+    '''hex sha1 of a file'''
+    h = hashlib.sha1()
+    f = open(path, 'rb')
+    while True:
+        data = f.read(1024*1024)
+        if not data:
+            break
+        h.update(data)
+    f.close()
+    return h.hexdigest()
+
+
+class LogQueue(object):
+    '''a queue of logs to download, and a record of the logs downloaded
+    with their size and sha1, kept in a JSON file at path. Logs are
+    identified by id, size and time_utc, so a queued log is only
+    downloaded if the vehicle still has it'''
+    def __init__(self, path):
+        self.path = path
+        self.queue = []
+        self.downloaded = {}
+        # (path, mtime, matched) of the local copy of a download last
+        # hashed, by key
+        self.verified = {}
+        # keys of downloads being hashed in the background
+        self.checking = set()
+        # set when a background hash finishes
+        self.checked = False
+        self.load()
+
+    def load(self):
+        try:
+            f = open(self.path)
+            state = json.load(f)
+            f.close()
+            self.queue = state.get('queue', [])
+            self.downloaded = state.get('downloaded', {})
+        except Exception:
+            pass
+
+    def save(self):
+        state = { 'queue' : self.queue,
+                  'downloaded' : self.downloaded }
+        f = open(self.path + '.tmp', 'w')
+        json.dump(state, f, indent=1)
+        f.close()
+        os.rename(self.path + '.tmp', self.path)
+
+    def __len__(self):
+        return len(self.queue)
+
+    def key(self, lognum, size, time_utc):
+        return '%u:%u:%u' % (lognum, size, time_utc)
+
+    def add(self, lognum, size, time_utc, filename):
+        '''queue a log, returning False if it is already queued'''
+        for q in self.queue:
+            if q['id'] == lognum and q['size'] == size and q['time_utc'] == time_utc:
+                return False
+        self.queue.append({ 'id' : lognum, 'size' : size,
+                            'time_utc' : time_utc, 'filename' : filename })
+        return True
+
+    def remove(self, lognum):
+        self.queue = [q for q in self.queue if q['id'] != lognum]
+
+    def clear(self):
+        self.queue = []
+
+    def ordered(self, order='newest'):
+        '''the queue in download order, newest or smallest first'''
+        if order == 'smallest':
+            return sorted(self.queue, key=lambda q: (q['size'], q['id']))
+        return sorted(self.queue, key=lambda q: (-q['time_utc'], -q['id']))
+
+    def matches(self, q, entries):
+        '''True if queued log q is the log of that id in entries'''
+        e = entries.get(q['id'], None)
+        return e is not None and e.size == q['size'] and e.time_utc == q['time_utc']
+
+    def next(self, entries, order='newest'):
+        '''the first queued log to download that the vehicle has, given
+        its LOG_ENTRY messages by id, or None. Logs with a local copy
+        still being checked are left until the check is done'''
+        for q in self.ordered(order):
+            if self.matches(q, entries) and not self.is_checking(q['id'], q['size'], q['time_utc']):
+                return q
+        return None
+
+    def drop_stale(self, entries):
+        '''remove queued logs the vehicle no longer has, returning them'''
+        stale = [q for q in self.queue if not self.matches(q, entries)]
+        self.queue = [q for q in self.queue if self.matches(q, entries)]
+        return stale
+
+    def record(self, lognum, size, time_utc, filename, sha1=None):
+        '''record a completed download. Without the sha1 from the
+        download the file is hashed in a background thread'''
+        key = self.key(lognum, size, time_utc)
+        rec = { 'filename' : os.path.abspath(filename),
+                'mtime' : os.path.getmtime(filename),
+                'sha1' : sha1 }
+        self.downloaded[key] = rec
+        if sha1 is not None:
+            self.verified[key] = (rec['filename'], rec['mtime'], True)
+        else:
+            self.hash_in_background(key, filename, None)
+
+    def hash_in_background(self, key, path, sha1):
+        '''hash a local copy of a download in a thread. With sha1 None
+        the hash is recorded, otherwise it is checked against sha1'''
+        if key in self.checking:
+            return
+        self.checking.add(key)
+        rec = self.downloaded[key]
+        def hash_file():
+            try:
+                h = file_sha1(path)
+                if sha1 is None:
+                    rec['sha1'] = h
+                self.verified[key] = (os.path.abspath(path), rec['mtime'], h == rec['sha1'])
+            except Exception:
+                pass
+            self.checking.discard(key)
+            self.checked = True
+        t = threading.Thread(target=hash_file, name='log_sha1')
+        t.daemon = True
+        t.start()
+
+    def is_checking(self, lognum, size, time_utc):
+        '''True while a local copy of a log is being hashed'''
+        return self.key(lognum, size, time_utc) in self.checking
+
+    def present(self, lognum, size, time_utc, filename):
+        '''return the name of a local copy of a log that matches the
+        recorded size, modification time and sha1, or None. The sha1 is
+        checked in a background thread, so a copy not checked yet gives
+        None and is_checking() is True until the check is done'''
+        key = self.key(lognum, size, time_utc)
+        rec = self.downloaded.get(key, None)
+        if rec is None:
+            return None
+        for f in [filename, rec['filename']]:
+            try:
+                if os.path.getsize(f) != size or os.path.getmtime(f) != rec.get('mtime', None):
+                    continue
+            except OSError:
+                continue
+            v = self.verified.get(key, None)
+            if v is not None and v[:2] == (os.path.abspath(f), rec['mtime']):
+                if v[2]:
+                    return f
+                # a corrupted copy
+                continue
+            if rec.get('sha1', None) is not None:
+                self.hash_in_background(key, f, rec['sha1'])
+            return None
+        return None
+
+
+def load_resume(path, lognum, size, time_utc):
+    '''return the received block bitmap from a sidecar file, or None if
+    there is none or it is for a different log'''
+    try:
+        f = open(path)
+        state = json.load(f)
+        f.close()
+        if (state['id'] != lognum or state['size'] != size or
+            state['time_utc'] != time_utc):
+            return None
+        return bytearray(zlib.decompress(base64.b64decode(state['blocks'])))
+    except Exception:
+        return None
+
+
+class SimulatedLog(object):
+    '''a simulated autopilot serving one LOG_REQUEST_DATA at a time at a
+    fixed block rate over a link with latency and random loss. Time is
+    passed in explicitly so simulations run faster than real time'''
+    def __init__(self, size, latency=0.1, loss=0.05, rate=500, seed=1):
+        import random
+        self.size = size
+        self.latency = latency
+        self.loss = loss
+        self.rate = rate
+        self.random = random.Random(seed)
+        self.pending = []
+        self.ofs = None
+        self.remaining = 0
+        self.next_send = 0
+        self.data = bytearray(BLOCK_SIZE)
+
+    def request(self, ofs, count, now):
+        if self.random.random() < self.loss:
+            return
+        self.pending.append((now + self.latency, ofs, count))
+
+    def run(self, now):
+        '''return the (ofs, count) LOG_DATA messages arriving by now'''
+        ret = []
+        while len(self.pending) > 0 and self.pending[0][0] <= now - self.latency:
+            (t, ofs, count) = self.pending.pop(0)
+            self.ofs = ofs
+            self.remaining = count
+            self.next_send = max(self.next_send, t)
+        while self.ofs is not None and self.next_send <= now - self.latency:
+            count = min(BLOCK_SIZE, self.remaining, max(self.size - self.ofs, 0))
+            if self.random.random() >= self.loss:
+                ret.append((self.ofs, count))
+            self.next_send += 1.0 / self.rate
+            self.ofs += count
+            self.remaining -= count
+            if count < BLOCK_SIZE or self.remaining <= 0:
+                self.ofs = None
+        if self.ofs is None:
+            self.next_send = max(self.next_send, now - self.latency)
+        return ret
+
+
+class NullFile(object):
+    '''a file that discards writes, counting them'''
+    def __init__(self):
+        self.writes = 0
+    def seek(self, ofs):
+        pass
+    def write(self, data):
+        self.writes += 1
+    def flush(self):
+        pass
+    def read(self, count):
+        return b'\0' * count
+
+
+def simulate_legacy(vehicle, step):
+    '''the previous downloader: stream, then after 0.7s of silence send up
+    to 20 gap requests, or a request past the highest block. Returns the
+    simulated time taken and the number of file writes'''
+    now = 0.0
+    received = set()
+    writes = 0
+    last_timestamp = now
+    vehicle.request(0, 0xFFFFFFFF, now)
+    ofs = 0
+    while True:
+        now += step
+        done = False
+        for (mofs, count) in vehicle.run(now):
+            if mofs != ofs:
+                ofs = mofs
+            if count != 0:
+                received.add(mofs // BLOCK_SIZE)
+                writes += 1
+                ofs += count
+            last_timestamp = now
+            if count == 0 or (count < BLOCK_SIZE and len(received) == 1 + (mofs // BLOCK_SIZE)):
+                done = True
+                break
+        if done:
+            return (now, writes)
+        if now - last_timestamp > 0.7 and len(received) > 0:
+            last_timestamp = now
+            highest = max(received)
+            diff = set(range(highest)).difference(received)
+            if len(diff) == 0:
+                vehicle.request((1 + highest) * BLOCK_SIZE, 0xffffffff, now)
+            else:
+                for i in range(20):
+                    start = min(diff)
+                    diff.remove(start)
+                    end = start
+                    while end + 1 in diff:
+                        end += 1
+                        diff.remove(end)
+                    vehicle.request(start * BLOCK_SIZE, (end + 1 - start) * BLOCK_SIZE, now)
+                    if len(diff) == 0:
+                        break
+
+def simulate_download(vehicle, step, size_known=True):
+    '''download with LogDownload, returning the simulated time taken, the
+    number of file writes and the download'''
+    now = 0.0
+    f = NullFile()
+    dl = LogDownload(1, vehicle.size if size_known else None, f,
+                     lambda ofs, count: vehicle.request(ofs, count, now))
+    dl.start(now)
+    while True:
+        now += step
+        for (ofs, count) in vehicle.run(now):
+            if dl.received(ofs, count, vehicle.data, now):
+                return (now, f.writes, dl)
+        dl.check(now)
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser("mp_logdownload.py [options]")
+    parser.add_option("--size", type='float', default=5, help="log size in MB")
+    parser.add_option("--latency", type='float', default=0.1, help="one way latency in seconds")
+    parser.add_option("--rate", type='float', default=500, help="link rate in blocks per second")
+    parser.add_option("--step", type='float', default=0.01, help="simulation step in seconds")
+    parser.add_option("--no-legacy", action='store_true', default=False, help="skip the old downloader")
+    (opts, args) = parser.parse_args()
+
+    size = int(opts.size * 1024 * 1024)
+    print("%.1f MB log, latency %.0fms, %.1f kB/s link" % (opts.size, opts.latency*1000,
+                                                          opts.rate*BLOCK_SIZE/1024.0))
+    print("%6s %20s %20s" % ('loss', 'legacy', 'windowed'))
+    for loss in [0.0, 0.01, 0.05, 0.1]:
+        if opts.no_legacy:
+            legacy = '-'
+        else:
+            (t1, w1) = simulate_legacy(SimulatedLog(size, opts.latency, loss, opts.rate), opts.step)
+            legacy = '%.0fs %uw' % (t1, w1)
+        (t2, w2, dl) = simulate_download(SimulatedLog(size, opts.latency, loss, opts.rate), opts.step)
+        print("%5.0f%% %20s %20s" % (loss*100, legacy, '%.0fs %uw' % (t2, w2)))
@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+'''
+mission transfer engine
+
+MissionDownload fetches a list of items indexed by sequence number
+(waypoints, fence points or rally points) by keeping a window of
+requests outstanding, sized from the measured round trip time, and
+re-requesting gaps alongside new items so that a single lost item
+does not stall the transfer. MissionUpload answers the vehicle's
+requests during an upload from a list of items built up front, and
+tracks progress, repeated requests and stalls. MissionCache keeps
+downloaded missions on disk by vehicle and mission hash.
+
+Run this file directly for a benchmark against a simulated lossy link.
+'''
+
+import time, copy, os, json, glob, zlib, struct
+from pymavlink import mavutil
+from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib.mp_transfer import IndexBitmap, AdaptiveWindow, TransferProgress
+
+# frames where x and y of a MISSION_ITEM_INT are latitude and longitude * 1e7
+global_frames = set([mavutil.mavlink.MAV_FRAME_GLOBAL,
+                     mavutil.mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT,
+                     mavutil.mavlink.MAV_FRAME_GLOBAL_TERRAIN_ALT,
+                     getattr(mavutil.mavlink, 'MAV_FRAME_GLOBAL_INT', 5),
+                     getattr(mavutil.mavlink, 'MAV_FRAME_GLOBAL_RELATIVE_ALT_INT', 6),
+                     getattr(mavutil.mavlink, 'MAV_FRAME_GLOBAL_TERRAIN_ALT_INT', 11)])
+
+def item_from_int(m):
+    '''convert a MISSION_ITEM_INT to the equivalent MISSION_ITEM'''
+    if m.frame in global_frames:
+        scale = 1.0e-7
+    else:
+        scale = 1.0e-4
+    return mavutil.mavlink.MAVLink_mission_item_message(m.target_system, m.target_component,
+                                                        m.seq, m.frame, m.command,
+                                                        m.current, m.autocontinue,
+                                                        m.param1, m.param2, m.param3, m.param4,
+                                                        m.x*scale, m.y*scale, m.z)
+
+def item_to_int(w):
+    '''convert a MISSION_ITEM to the equivalent MISSION_ITEM_INT'''
+    if w.get_type() == 'MISSION_ITEM_INT':
+        return w
+    if w.frame in global_frames:
+        scale = 1.0e7
+    else:
+        scale = 1.0e4
+    return mavutil.mavlink.MAVLink_mission_item_int_message(w.target_system, w.target_component,
+                                                            w.seq, w.frame, w.command,
+                                                            w.current, w.autocontinue,
+                                                            w.param1, w.param2, w.param3, w.param4,
+                                                            int(round(w.x*scale)), int(round(w.y*scale)), w.z)
+
+def supports_mission_int(master):
+    '''return True if the vehicle has said it handles MISSION_ITEM_INT'''
+    if not hasattr(master.mav, 'mission_request_int_send'):
+        return False
+    m = master.messages.get('AUTOPILOT_VERSION', None)
+    if m is None:
+        return False
+    bit = getattr(mavutil.mavlink, 'MAV_PROTOCOL_CAPABILITY_MISSION_INT', 4)
+    return (m.capabilities & bit) != 0
+
+
+class MissionDownload(object):
+    '''pipelined download of count items.
+
+    request is called as request(seq) to ask the vehicle for an item,
+    and each reply should be passed to received(). check() should be
+    called regularly to send new requests and re-request lost ones'''
+    def __init__(self, count, request, name='items', maximum=16, stall_timeout=10.0):
+        self.count = count
+        self.request = request
+        self.name = name
+        self.stall_timeout = stall_timeout
+        self.bitmap = IndexBitmap(count)
+        self.items = [None] * count
+        self.window = AdaptiveWindow(initial=4, maximum=maximum)
+        self.progress = TransferProgress(count)
+        self.last_progress = time.time()
+        self.duplicates = 0
+
+    def received(self, seq, item, now=None):
+        '''record an item, returning True if it is new'''
+        if now is None:
+            now = time.time()
+        if seq < 0 or seq >= self.count:
+            return False
+        self.window.received(seq, now)
+        if not self.bitmap.add(seq):
+            self.duplicates += 1
+            return False
+        self.items[seq] = item
+        self.progress.update(self.bitmap.count)
+        self.last_progress = now
+        return True
+
+    def complete(self):
+        return self.bitmap.complete()
+
+    def failed(self, now=None):
+        '''return True if nothing has arrived for stall_timeout seconds'''
+        if now is None:
+            now = time.time()
+        return not self.complete() and now - self.last_progress > self.stall_timeout
+
+    def check(self, now=None):
+        '''expire lost requests and fill the window, lowest sequence first,
+        so gaps are re-requested alongside requests for new items'''
+        if now is None:
+            now = time.time()
+        self.window.expire(now)
+        for seq in self.bitmap.missing():
+            if not self.window.can_send():
+                break
+            if seq in self.window.outstanding:
+                continue
+            self.window.sent(seq, now)
+            self.request(seq)
+
+    def report(self, now=None):
+        '''return a progress line if one is due, otherwise None'''
+        if self.complete() or not self.progress.report_due(now):
+            return None
+        eta = self.progress.eta(now)
+        if eta is None:
+            eta = 0
+        return "Have %u of %u %s (%.1f/s, ETA %.0fs)" % (
+            self.bitmap.count, self.count, self.name, self.progress.rate(now), eta)
+
+    def summary(self, now=None):
+        '''one line summary of the transfer'''
+        return "%u/%u %s in %.1fs (%.1f/s, %u resent)" % (
+            self.bitmap.count, self.count, self.name, self.progress.elapsed(now),
+            self.progress.rate(now), self.window.lost_count)
+
+    def __str__(self):
+        return "%s %s" % (self.summary(), str(self.window))
+
+
+def build_upload_items(items, target_system, target_component, use_int=False):
+    '''build the messages for an upload up front, addressed to the
+    target and converted to MISSION_ITEM_INT if use_int is set'''
+    ret = []
+    for w in items:
+        w = copy.copy(w)
+        w.target_system = target_system
+        w.target_component = target_component
+        if use_int:
+            w = item_to_int(w)
+        ret.append(w)
+    return ret
+
+
+class MissionUpload(object):
+    '''answer a vehicle's requests for items during an upload.
+
+    items is the list of messages for sequence numbers first onwards.
+    send is called as send(msg) to answer a request, and restart() is
+    called to resend the count if the vehicle never starts requesting.
+    The upload is finished when finished is True, and result is then the
+    MAV_MISSION_RESULT from the vehicle, or None on timeout. If every
+    item was requested and sent but the final ack never came, the
+    vehicle has the whole mission, so result is MAV_MISSION_ACCEPTED with
+    ack_lost True. opaque_id is the mission id from the final ack, or 0
+    if the vehicle has none'''
+    def __init__(self, items, send, restart, first=0, name='items',
+                 stall_timeout=2.0, retries=3):
+        self.items = items
+        self.send = send
+        self.restart = restart
+        self.first = first
+        self.name = name
+        self.stall_timeout = stall_timeout
+        self.retries = retries
+        self.requested = IndexBitmap(len(items))
+        self.progress = TransferProgress(len(items))
+        self.last_activity = time.time()
+        self.last_seq = None
+        self.duplicates = 0
+        self.stalls = 0
+        self.finished = False
+        self.result = None
+        self.ack_lost = False
+        self.opaque_id = 0
+
+    def handle_request(self, seq, now=None):
+        '''send the item for a request, returning False if seq is out of range'''
+        if now is None:
+            now = time.time()
+        idx = seq - self.first
+        if idx < 0 or idx >= len(self.items):
+            return False
+        if not self.requested.add(idx):
+            # our reply was lost, or the request was repeated
+            self.duplicates += 1
+        self.progress.update(self.requested.count)
+        self.last_activity = now
+        self.last_seq = seq
+        self.stalls = 0
+        self.send(self.items[idx])
+        return True
+
+    def handle_ack(self, m):
+        '''handle a MISSION_ACK, returning True if it finishes the upload'''
+        if m.type == mavutil.mavlink.MAV_MISSION_ACCEPTED and not self.requested.complete():
+            # an ack for an earlier operation such as a clear
+            return False
+        self.finished = True
+        self.result = m.type
+        self.opaque_id = getattr(m, 'opaque_id', 0)
+        return True
+
+    def check(self, now=None):
+        '''resend after a stall, finishing the upload after too many'''
+        if now is None:
+            now = time.time()
+        if self.finished or now - self.last_activity < self.stall_timeout:
+            return
+        self.stalls += 1
+        self.last_activity = now
+        if self.stalls > self.retries:
+            self.finished = True
+            if self.requested.complete():
+                self.result = mavutil.mavlink.MAV_MISSION_ACCEPTED
+                self.ack_lost = True
+            else:
+                self.result = None
+        elif self.last_seq is None:
+            self.restart()
+        else:
+            self.send(self.items[self.last_seq - self.first])
+
+    def report(self, now=None):
+        '''return a progress line if one is due, otherwise None'''
+        if self.finished or not self.progress.report_due(now):
+            return None
+        eta = self.progress.eta(now)
+        if eta is None:
+            eta = 0
+        return "Sent %u of %u %s (%.1f/s, ETA %.0fs)" % (
+            self.requested.count, len(self.items), self.name, self.progress.rate(now), eta)
+
+    def summary(self, now=None):
+        '''one line summary of the upload'''
+        ret = "%u/%u %s in %.1fs (%.1f/s, %u repeated, %u stalls)" % (
+            self.requested.count, len(self.items), self.name, self.progress.elapsed(now),
+            self.progress.rate(now), self.duplicates, self.stalls)
+        if self.ack_lost:
+            ret += ", complete, ACK not received"
+        return ret
+
+    def result_name(self):
+        '''printable name for the result'''
+        if self.result is None:
+            return 'TIMEOUT'
+        try:
+            return mavutil.mavlink.enums['MAV_MISSION_RESULT'][self.result].name
+        except Exception:
+            return str(self.result)
+
+
+def float32(v):
+    '''a value as the vehicle holds it in a MISSION_ITEM float'''
+    return struct.unpack('<f', struct.pack('<f', v))[0]
+
+def normalise_fields(fields):
+    '''mission item fields with the floats rounded to float32, so items
+    we uploaded from doubles compare equal to the same items downloaded'''
+    return [float32(v) if isinstance(v, float) else v for v in fields]
+
+def item_fields(w):
+    '''the fields of a mission item that define the mission. The
+    sequence number is implied by position and current is left out as
+    it changes as the mission is flown'''
+    return normalise_fields([w.frame, w.command, w.autocontinue,
+                             float(w.param1), float(w.param2), float(w.param3), float(w.param4),
+                             float(w.x), float(w.y), float(w.z)])
+
+def fields_equal(a, b):
+    '''compare normalised item fields. x and y may have come through
+    MISSION_ITEM_INT as 1e-7 degree integers, so they are equal within
+    that step plus a float32 step'''
+    if len(a) != len(b):
+        return False
+    for i in range(len(a)):
+        if i in (7, 8) and isinstance(a[i], float) and isinstance(b[i], float):
+            if abs(a[i] - b[i]) > 1.5e-7 + abs(a[i]) * 2**-23:
+                return False
+        elif a[i] != b[i]:
+            return False
+    return True
+
+def mission_crc(items):
+    '''CRC32 of the defining fields of a list of mission items'''
+    crc = 0
+    for w in items:
+        crc = zlib.crc32(struct.pack('<BHB7f', *item_fields(w)), crc)
+    return crc & 0xFFFFFFFF
+
+
+class MissionCache(object):
+    '''an on-disk cache of missions, one file per vehicle and mission
+    hash, where the hash is the item count plus a CRC of the items'''
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key, count, crc):
+        return os.path.join(self.directory, key, "%u-%08x.json" % (count, crc))
+
+    def save(self, key, items, opaque_id=0):
+        '''save a list of mission items for a vehicle'''
+        crc = mission_crc(items)
+        path = self.path(key, len(items), crc)
+        mp_util.mkdir_p(os.path.dirname(path))
+        tmp = path + '.tmp'
+        try:
+            f = open(tmp, mode='w')
+            json.dump({'count' : len(items),
+                       'crc' : crc,
+                       'opaque_id' : opaque_id,
+                       'items' : [item_fields(w) for w in items]}, f)
+            f.close()
+            os.rename(tmp, path)
+        except Exception as e:
+            print("Failed to save mission cache: %s" % e)
+
+    def candidates(self, key, count):
+        '''return the cached missions for a vehicle with count items,
+        most recently used first'''
+        paths = glob.glob(os.path.join(self.directory, key, "%u-*.json" % count))
+        paths.sort(key=lambda p: os.path.getmtime(p), reverse=True)
+        ret = []
+        for p in paths:
+            try:
+                f = open(p, mode='r')
+                entry = json.load(f)
+                f.close()
+            except Exception:
+                continue
+            if entry.get('count', None) != count or len(entry.get('items', [])) != count:
+                continue
+            entry['path'] = p
+            ret.append(entry)
+        return ret
+
+    def matches(self, entry, items):
+        '''return True if a cached mission agrees with a dictionary of
+        mission items by sequence number'''
+        for seq in items:
+            if not fields_equal(normalise_fields(entry['items'][seq]), item_fields(items[seq])):
+                return False
+        return True
+
+    def load(self, entry, target_system, target_component):
+        '''return the list of MISSION_ITEM messages for a cached mission'''
+        try:
+            # mark as recently used
+            os.utime(entry['path'], None)
+        except Exception:
+            pass
+        ret = []
+        for i in range(len(entry['items'])):
+            (frame, command, autocontinue, p1, p2, p3, p4, x, y, z) = entry['items'][i]
+            ret.append(mavutil.mavlink.MAVLink_mission_item_message(target_system, target_component,
+                                                                    i, frame, command, 0, autocontinue,
+                                                                    p1, p2, p3, p4, x, y, z))
+        return ret
+
+
+def simulate_download(count, link, windowed, step=0.01):
+    '''simulate a mission download of count items, either with the
+    legacy scheme of requesting the next 5 items after each in-order
+    reply and re-requesting after 2s of silence, or with a
+    MissionDownload. Returns the simulated time taken'''
+    clock = [0.0]
+    if windowed:
+        dl = MissionDownload(count, lambda seq: link.send(seq, clock[0]))
+        dl.last_progress = 0.0
+        dl.progress.reset(0.0)
+        while not dl.complete():
+            dl.check(clock[0])
+            clock[0] += step
+            for seq in link.receive(clock[0]):
+                dl.received(seq, seq, clock[0])
+        return clock[0]
+
+    received = IndexBitmap(count)
+    requested = {}
+    next_seq = [0]
+    last_recv = [0.0]
+    last_idle = [0.0]
+    def send_requests(now):
+        for seq in range(next_seq[0], min(next_seq[0]+5, count)):
+            if seq in requested and now - requested[seq] < 2:
+                continue
+            requested[seq] = now
+            link.send(seq, now)
+    send_requests(0.0)
+    while not received.complete():
+        now = clock[0] = clock[0] + step
+        for seq in link.receive(now):
+            if not received.add(seq):
+                continue
+            last_recv[0] = now
+            while next_seq[0] in received:
+                next_seq[0] += 1
+            send_requests(now)
+        if now - last_idle[0] >= 0.5:
+            last_idle[0] = now
+            if now - last_recv[0] >= 2:
+                send_requests(now)
+    return clock[0]
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    from MAVProxy.modules.lib.mp_transfer import LossyLink
+    parser = OptionParser("mp_mission.py [options]")
+    parser.add_option("--count", type='int', default=500, help="number of mission items")
+    parser.add_option("--latency", type='float', default=0.1, help="one way latency in seconds")
+    parser.add_option("--rate", type='float', default=100, help="link rate in items per second")
+    (opts, args) = parser.parse_args()
+
+    print("%u items, latency %.0fms, %.0f items/s" % (opts.count, opts.latency*1000, opts.rate))
+    print("%6s %10s %10s" % ('loss', 'legacy', 'windowed'))
+    for loss in [0.0, 0.01, 0.05, 0.1, 0.2]:
+        t1 = simulate_download(opts.count, LossyLink(opts.latency, loss, opts.rate), False)
+        t2 = simulate_download(opts.count, LossyLink(opts.latency, loss, opts.rate), True)
+        print("%5.0f%% %9.1fs %9.1fs" % (loss*100, t1, t2))
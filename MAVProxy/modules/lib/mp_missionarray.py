@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+'''
+numpy backed mission representation for bulk edits
+
+MissionArray holds the positions of a mission as arrays so that moves,
+rotations and altitude changes of many waypoints are done in one
+operation, and keeps the original positions so that only the ranges
+of items that actually changed need to be sent to the vehicle.
+
+The geodesy functions here are array versions of the ones in mp_util.
+'''
+
+import numpy
+from pymavlink import mavutil
+from MAVProxy.modules.lib import mp_util
+
+def gps_distance(lat1, lon1, lat2, lon2):
+    '''array version of mp_util.gps_distance'''
+    lat1 = numpy.radians(lat1)
+    lat2 = numpy.radians(lat2)
+    lon1 = numpy.radians(lon1)
+    lon2 = numpy.radians(lon2)
+    dLat = lat2 - lat1
+    dLon = lon2 - lon1
+    a = numpy.sin(0.5*dLat)**2 + numpy.sin(0.5*dLon)**2 * numpy.cos(lat1) * numpy.cos(lat2)
+    c = 2.0 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1.0-a))
+    return mp_util.radius_of_earth * c
+
+def gps_bearing(lat1, lon1, lat2, lon2):
+    '''array version of mp_util.gps_bearing'''
+    lat1 = numpy.radians(lat1)
+    lat2 = numpy.radians(lat2)
+    lon1 = numpy.radians(lon1)
+    lon2 = numpy.radians(lon2)
+    dLon = lon2 - lon1
+    y = numpy.sin(dLon) * numpy.cos(lat2)
+    x = numpy.cos(lat1)*numpy.sin(lat2) - numpy.sin(lat1)*numpy.cos(lat2)*numpy.cos(dLon)
+    return numpy.degrees(numpy.arctan2(y, x)) % 360.0
+
+def gps_newpos(lat, lon, bearing, distance):
+    '''array version of mp_util.gps_newpos'''
+    lat1 = numpy.radians(lat)
+    lon1 = numpy.radians(lon)
+    brng = numpy.radians(bearing)
+    dr = numpy.asarray(distance) / mp_util.radius_of_earth
+    lat2 = numpy.arcsin(numpy.sin(lat1)*numpy.cos(dr) +
+                        numpy.cos(lat1)*numpy.sin(dr)*numpy.cos(brng))
+    lon2 = lon1 + numpy.arctan2(numpy.sin(brng)*numpy.sin(dr)*numpy.cos(lat1),
+                                numpy.cos(dr)-numpy.sin(lat1)*numpy.sin(lat2))
+    return (numpy.degrees(lat2), ((numpy.degrees(lon2) + 180.0) % 360.0) - 180.0)
+
+
+class MissionArray(object):
+    '''the positions of the items of a MAVWPLoader as arrays'''
+    def __init__(self, wploader):
+        self.wploader = wploader
+        count = wploader.count()
+        items = [wploader.wp(i) for i in range(count)]
+        self.lat = numpy.array([w.x for w in items], dtype=float)
+        self.lon = numpy.array([w.y for w in items], dtype=float)
+        self.alt = numpy.array([w.z for w in items], dtype=float)
+        self.frame = numpy.array([w.frame for w in items], dtype=int)
+        self.location = numpy.array([wploader.is_location_command(w.command) for w in items], dtype=bool)
+        self.lat0 = self.lat.copy()
+        self.lon0 = self.lon.copy()
+        self.alt0 = self.alt.copy()
+
+    def __len__(self):
+        return len(self.lat)
+
+    def select(self, start, end):
+        '''mask of the location items from start to end inclusive'''
+        mask = numpy.zeros(len(self.lat), dtype=bool)
+        mask[start:end+1] = True
+        return mask & self.location
+
+    def translate(self, mask, bearing, distance):
+        '''move the selected items distance meters along bearing'''
+        (self.lat[mask], self.lon[mask]) = gps_newpos(self.lat[mask], self.lon[mask], bearing, distance)
+
+    def rotate(self, mask, lat, lon, angle):
+        '''rotate the selected items by angle degrees clockwise about lat, lon'''
+        d = gps_distance(lat, lon, self.lat[mask], self.lon[mask])
+        b = gps_bearing(lat, lon, self.lat[mask], self.lon[mask])
+        (self.lat[mask], self.lon[mask]) = gps_newpos(lat, lon, b+angle, d)
+
+    def set_alt(self, mask, alt):
+        '''set the altitude of the selected items'''
+        self.alt[mask] = alt
+
+    def scale_alt(self, mask, scale, offset=0.0):
+        '''scale the altitude of the selected items and add an offset'''
+        self.alt[mask] = self.alt[mask] * scale + offset
+
+    def terrain_adjust(self, mask, get_elevation):
+        '''keep the selected items at the same height above the ground as
+        at their original positions. Items in the terrain frame already
+        are. get_elevation(lat, lon) returns the ground height or None'''
+        mask = mask & (self.frame != mavutil.mavlink.MAV_FRAME_GLOBAL_TERRAIN_ALT)
+        for i in numpy.flatnonzero(mask):
+            alt1 = get_elevation(self.lat[i], self.lon[i])
+            alt2 = get_elevation(self.lat0[i], self.lon0[i])
+            if alt1 is not None and alt2 is not None:
+                self.alt[i] += alt1 - alt2
+
+    def terrain_alt(self, mask, agl, get_elevation, home_elevation):
+        '''set the selected items to agl meters above the ground, allowing
+        for the frame of each item. Returns the number of items skipped
+        for lack of elevation data'''
+        terrain = mask & (self.frame == mavutil.mavlink.MAV_FRAME_GLOBAL_TERRAIN_ALT)
+        self.alt[terrain] = agl
+        missing = 0
+        for i in numpy.flatnonzero(mask & ~terrain):
+            ground = get_elevation(self.lat[i], self.lon[i])
+            if ground is None:
+                missing += 1
+                continue
+            if self.frame[i] == mavutil.mavlink.MAV_FRAME_GLOBAL:
+                self.alt[i] = ground + agl
+            else:
+                self.alt[i] = ground - home_elevation + agl
+        return missing
+
+    def changed(self):
+        '''mask of the items that differ from the mission we started with'''
+        return ((self.lat != self.lat0) |
+                (self.lon != self.lon0) |
+                (self.alt != self.alt0))
+
+    def changed_ranges(self):
+        '''list of (first, last) runs of changed items'''
+        changed = numpy.concatenate(([False], self.changed(), [False])).astype(int)
+        edges = numpy.flatnonzero(numpy.diff(changed))
+        return [(int(edges[i]), int(edges[i+1])-1) for i in range(0, len(edges), 2)]
+
+    def apply(self):
+        '''write the changed items back to the loader, returning the list
+        of (first, last) ranges that changed'''
+        ranges = self.changed_ranges()
+        for (first, last) in ranges:
+            for i in range(first, last+1):
+                w = self.wploader.wp(i)
+                w.x = float(self.lat[i])
+                w.y = float(self.lon[i])
+                w.z = float(self.alt[i])
+                self.wploader.set(w, i)
+        self.lat0 = self.lat.copy()
+        self.lon0 = self.lon.copy()
+        self.alt0 = self.alt.copy()
+        return ranges
+
+
+if __name__ == "__main__":
+    import time
+    from pymavlink import mavwp
+    from optparse import OptionParser
+    parser = OptionParser("mp_missionarray.py [options]")
+    parser.add_option("--count", type='int', default=2000, help="number of waypoints")
+    (opts, args) = parser.parse_args()
+
+    loader = mavwp.MAVWPLoader()
+    for i in range(opts.count):
+        loader.add(mavutil.mavlink.MAVLink_mission_item_message(0, 0, i, 3, 16, 0, 1, 0, 0, 0, 0,
+                                                                -35.3+(i//50)*0.0002,
+                                                                149.1+(i%50)*0.0002, 100))
+    t0 = time.time()
+    for i in range(1, loader.count()):
+        w = loader.wp(i)
+        (lat, lon) = mp_util.gps_newpos(w.x, w.y, 45, 100)
+        d = mp_util.gps_distance(-35.3, 149.1, lat, lon)
+        b = mp_util.gps_bearing(-35.3, 149.1, lat, lon)
+        (lat, lon) = mp_util.gps_newpos(-35.3, 149.1, b+30, d)
+    t1 = time.time()
+    marr = MissionArray(loader)
+    mask = marr.select(1, len(marr)-1)
+    marr.translate(mask, 45, 100)
+    marr.rotate(mask, -35.3, 149.1, 30)
+    ranges = marr.changed_ranges()
+    t2 = time.time()
+    print("%u waypoints: per item %.1fms, array %.1fms, changed %s" % (
+        opts.count, (t1-t0)*1000, (t2-t1)*1000, ranges))
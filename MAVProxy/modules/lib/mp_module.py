@@ -38,6 +38,11 @@ class MPModule(object):
     def mavlink_packet(self, packet):
         pass
 
+    # A module may also define mavlink_packets(self, packets). If it
+    # does, it receives a list of all packets parsed from one read of
+    # the master link in a single call, instead of mavlink_packet()
+    # being called once per packet.
+
     #
     # Methods for subclass use
     #
@@ -103,6 +108,17 @@ class MPModule(object):
     def param_set(self, name, value, retries=3):
         self.mpstate.functions.param_set(name, value, retries)
 
+    def send_command_long(self, command, params, callback=None,
+                          target_system=None, target_component=None,
+                          retries=None, timeout=1.0):
+        '''send a COMMAND_LONG via the command manager, which retries it
+        until a matching COMMAND_ACK arrives'''
+        return self.mpstate.command_manager.send(command, params,
+                                                 target_system=target_system,
+                                                 target_component=target_component,
+                                                 callback=callback,
+                                                 retries=retries, timeout=timeout)
+
     def add_command(self, name, callback, description, completions=None):
         self.mpstate.command_map[name] = (callback, description)
         if completions is not None:
@@ -111,6 +127,20 @@ class MPModule(object):
     def add_completion_function(self, name, callback):
         self.mpstate.completion_functions[name] = callback
 
+    def add_select_fd(self, fd, callback, args=None):
+        '''ask the main loop to call callback(args) when fd is readable.
+        fd can be a file descriptor or any object with a fileno() method.
+        This avoids polling non-blocking sockets from idle_task'''
+        if hasattr(fd, 'fileno'):
+            fd = fd.fileno()
+        self.mpstate.select_extra[fd] = (callback, args)
+
+    def remove_select_fd(self, fd):
+        '''remove a file descriptor added with add_select_fd'''
+        if hasattr(fd, 'fileno'):
+            fd = fd.fileno()
+        self.mpstate.select_extra.pop(fd, None)
+
     def dist_string(self, val_meters):
         '''return a distance as a string'''
         if self.settings.dist_unit == 'nm':
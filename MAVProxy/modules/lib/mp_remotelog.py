@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+'''
+dataflash log streaming receiver
+
+RemoteLogReceiver handles the REMOTE_LOG_DATA_BLOCK messages ArduPilot
+streams its dataflash log in. Every block received is ACKed, and blocks
+skipped over in the sequence are NACKed until they arrive or are
+abandoned. ACKs and NACKs wait in queues ordered by when they are due,
+and the earliest due of either is sent first, so sending them costs the
+same however many blocks are missing. Blocks are collected in a buffer that
+is written to the log file in large chunks, with the gaps left by
+missing blocks filled when they arrive.
+
+Run this file directly for a benchmark against the old list based
+bookkeeping at full rate with 5% loss.
+'''
+
+import time
+from collections import deque
+
+ACK = 1
+NACK = 0
+
+class RemoteLogReceiver(object):
+    '''receive a streamed dataflash log into an open file.
+    send_status(seqno, status) sends a REMOTE_LOG_BLOCK_STATUS ACK or
+    NACK. Missing blocks are NACKed every nack_interval seconds and
+    abandoned when max_behind blocks behind the newest or after max_age
+    seconds'''
+    def __init__(self, fh, send_status, block_size=200, write_size=65536,
+                 nack_interval=0.1, max_behind=200, max_age=60, max_per_call=10,
+                 flush_interval=1.0):
+        self.fh = fh
+        self.send_status = send_status
+        self.block_size = block_size
+        self.write_size = write_size
+        self.nack_interval = nack_interval
+        self.max_behind = max_behind
+        self.max_age = max_age
+        self.max_per_call = max_per_call
+        self.flush_interval = flush_interval
+        self.last_seqno = 0
+        # missing block -> time it was found missing
+        self.missing = {}
+        # (time due, block) of blocks to ACK, of missing blocks to NACK
+        # and of those to NACK again, each in time order
+        self.acks = deque()
+        self.acking = set()
+        self.nacks = deque()
+        self.renacks = deque()
+        self.missing_found = 0
+        self.abandoned = 0
+        self.received_bytes = 0
+        self.wbuf = bytearray()
+        self.wbuf_ofs = 0
+        self.writes = 0
+        self.last_flush = time.time()
+
+    def received(self, seqno, data, now=None):
+        '''handle a block of data'''
+        if now is None:
+            now = time.time()
+        self.write(seqno * self.block_size, data)
+        self.received_bytes += len(data)
+        if seqno in self.missing:
+            del self.missing[seqno]
+            self.missing_found += 1
+            self.ack(seqno, now)
+            return
+        if seqno in self.acking:
+            # already acking this one; we probably sent multiple nacks
+            # and received it multiple times
+            return
+        self.ack(seqno, now)
+        if seqno - self.last_seqno > 1:
+            # NACK the blocks skipped over, except those that would be
+            # abandoned straight away
+            for block in range(max(self.last_seqno+1, seqno - self.max_behind), seqno):
+                if block not in self.missing and block not in self.acking:
+                    self.missing[block] = now
+                    self.nacks.append((now, block))
+            self.abandoned += max(seqno - self.max_behind - (self.last_seqno+1), 0)
+        if seqno > self.last_seqno:
+            self.last_seqno = seqno
+
+    def ack(self, seqno, now):
+        self.acks.append((now, seqno))
+        self.acking.add(seqno)
+
+    def next_nack(self, queue, now):
+        '''drop NACKs no longer needed from the front of a queue,
+        returning the time the first is due or None'''
+        while len(queue) > 0:
+            (due, block) = queue[0]
+            if block not in self.missing:
+                # we've received this block now
+                queue.popleft()
+            elif self.last_seqno - block > self.max_behind or now - self.missing[block] > self.max_age:
+                # give up on a block well behind the newest, or too old
+                queue.popleft()
+                del self.missing[block]
+                self.abandoned += 1
+            else:
+                return due
+        return None
+
+    def send_acks_and_nacks(self, now=None):
+        '''send up to max_per_call of the ACKs and NACKs that are due,
+        earliest first, returning the number sent'''
+        if now is None:
+            now = time.time()
+        sent = 0
+        while sent < self.max_per_call:
+            best = None
+            if len(self.acks) > 0:
+                best = (self.acks[0][0], self.acks)
+            for queue in (self.nacks, self.renacks):
+                due = self.next_nack(queue, now)
+                if due is not None and due <= now and (best is None or due < best[0]):
+                    best = (due, queue)
+            if best is None:
+                break
+            (due, block) = best[1].popleft()
+            if best[1] is self.acks:
+                self.acking.discard(block)
+                self.send_status(block, ACK)
+            else:
+                self.send_status(block, NACK)
+                self.renacks.append((now + self.nack_interval, block))
+            sent += 1
+        return sent
+
+    def write(self, ofs, data):
+        '''buffer data for the file. A block after the buffer extends it,
+        leaving a gap for any blocks missing in between, and a block
+        before it is written directly'''
+        if ofs < self.wbuf_ofs:
+            # a retransmitted block from before the buffer
+            self.fh.seek(ofs)
+            self.fh.write(data)
+            self.writes += 1
+            return
+        end = self.wbuf_ofs + len(self.wbuf)
+        if len(self.wbuf) == 0 or ofs - end > self.write_size:
+            # start a new buffer at the first block, or after a jump
+            self.flush()
+            self.wbuf_ofs = ofs
+            end = ofs
+        if ofs >= end:
+            self.wbuf.extend(bytearray(ofs - end))
+            self.wbuf.extend(data)
+        else:
+            pos = ofs - self.wbuf_ofs
+            self.wbuf[pos:pos+len(data)] = data
+        if len(self.wbuf) >= self.write_size:
+            self.flush()
+
+    def flush(self):
+        '''write out buffered data. Later blocks start a new buffer after
+        it, earlier ones are written directly'''
+        if len(self.wbuf) == 0:
+            return
+        self.fh.seek(self.wbuf_ofs)
+        self.fh.write(self.wbuf)
+        self.writes += 1
+        self.wbuf_ofs += len(self.wbuf)
+        self.wbuf = bytearray()
+
+    def flush_due(self, now=None):
+        '''flush if nothing has been written for flush_interval seconds,
+        returning True if flushed'''
+        if now is None:
+            now = time.time()
+        if now - self.last_flush < self.flush_interval:
+            return False
+        self.flush()
+        self.fh.flush()
+        self.last_flush = now
+        return True
+
+    def contiguous_end(self):
+        '''offset in the log before which every block has arrived or
+        been abandoned'''
+        if len(self.missing) > 0:
+            return min(self.missing) * self.block_size
+        return (self.last_seqno + 1) * self.block_size
+
+
+class LegacyReceiver(object):
+    '''the previous bookkeeping: a list of ACKs and NACKs walked and
+    deleted from in place, and a seek and write of each block'''
+    def __init__(self, fh, send_status):
+        self.fh = fh
+        self.send_status = send_status
+        self.last_seqno = 0
+        self.missing = {}
+        self.acking_blocks = {}
+        self.blocks_to_ack_and_nack = []
+        self.missing_found = 0
+        self.abandoned = 0
+
+    def received(self, seqno, data, now):
+        data = ''.join(str(chr(x)) for x in data)
+        self.fh.seek(len(data) * seqno)
+        self.fh.write(data)
+        if seqno in self.missing:
+            del self.missing[seqno]
+            self.missing_found += 1
+            self.blocks_to_ack_and_nack.append([None, seqno, 1, now, None])
+            self.acking_blocks[seqno] = 1
+            return
+        if seqno not in self.acking_blocks:
+            self.blocks_to_ack_and_nack.append([None, seqno, 1, now, None])
+            self.acking_blocks[seqno] = 1
+            if seqno - self.last_seqno > 1:
+                for block in range(self.last_seqno+1, seqno):
+                    if block not in self.missing and block not in self.acking_blocks:
+                        self.missing[block] = 1
+                        self.blocks_to_ack_and_nack.append([None, block, 0, now, None])
+        if self.last_seqno < seqno:
+            self.last_seqno = seqno
+
+    def send_acks_and_nacks(self, now):
+        blocks_sent = 0
+        i = 0
+        while i < len(self.blocks_to_ack_and_nack) and blocks_sent < 10:
+            stuff = self.blocks_to_ack_and_nack[i]
+            [master, block, status, first_sent, last_sent] = stuff
+            if status == 1:
+                self.send_status(block, ACK)
+                blocks_sent += 1
+                del self.acking_blocks[block]
+                del self.blocks_to_ack_and_nack[i]
+                continue
+            if block not in self.missing:
+                del self.blocks_to_ack_and_nack[i]
+                continue
+            if (self.last_seqno - block > 200) or (now - first_sent > 60):
+                del self.blocks_to_ack_and_nack[i]
+                del self.missing[block]
+                self.abandoned += 1
+                continue
+            i += 1
+            if last_sent is not None and now - last_sent < 0.1:
+                continue
+            self.send_status(block, NACK)
+            blocks_sent += 1
+            stuff[4] = now
+
+
+class CountingFile(object):
+    '''a file that discards writes, counting them'''
+    def __init__(self):
+        self.writes = 0
+    def seek(self, ofs):
+        pass
+    def write(self, data):
+        self.writes += 1
+    def flush(self):
+        pass
+
+
+def simulate(receiver_class, nblocks, loss=0.05, rate=500, latency=0.1, step=0.01, seed=1):
+    '''stream nblocks blocks at rate blocks per second over a link with
+    loss and latency, retransmitting NACKed blocks. Returns the time
+    spent in the receiver, the receiver and its file'''
+    import random
+    rnd = random.Random(seed)
+    data = [0x55] * 200
+    f = CountingFile()
+    pending = []
+    def send_status(seqno, status):
+        if status == NACK and rnd.random() >= loss:
+            pending.append((now + 2*latency, seqno))
+    r = receiver_class(f, send_status)
+    now = 0.0
+    seqno = 0
+    spent = 0.0
+    while now < nblocks / float(rate) + 60:
+        now += step
+        arrivals = []
+        for i in range(int(rate * step)):
+            if seqno < nblocks:
+                arrivals.append(seqno)
+                seqno += 1
+        while len(pending) > 0 and pending[0][0] <= now:
+            arrivals.append(pending.pop(0)[1])
+        t0 = time.time()
+        for s in arrivals:
+            if rnd.random() >= loss:
+                if receiver_class is LegacyReceiver:
+                    r.received(s, data, now)
+                else:
+                    r.received(s, bytearray(data), now)
+        r.send_acks_and_nacks(now)
+        spent += time.time() - t0
+        if seqno >= nblocks and len(pending) == 0 and len(r.missing) == 0:
+            break
+    return (spent, r, f)
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser("mp_remotelog.py [options]")
+    parser.add_option("--blocks", type='int', default=30000, help="number of blocks")
+    parser.add_option("--loss", type='float', default=0.05, help="loss rate")
+    parser.add_option("--rate", type='float', default=500, help="blocks per second")
+    (opts, args) = parser.parse_args()
+
+    for (name, cls) in [('legacy', LegacyReceiver), ('deque', RemoteLogReceiver)]:
+        (spent, r, f) = simulate(cls, opts.blocks, opts.loss, opts.rate)
+        print("%-8s %6.0f blocks/s processed, %u writes, %u recovered, %u abandoned" % (
+            name, opts.blocks / spent, f.writes, r.missing_found, r.abandoned))
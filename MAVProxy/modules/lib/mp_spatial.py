@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+'''
+spatial index of map objects
+
+SpatialIndex buckets (lat, lon) points into cells of roughly equal
+size in meters, so the nearest object to a position is found by
+looking at the cells around it rather than at every object. It is
+used for waypoints, rally points and fence points, where missions can
+have thousands of items.
+
+Run this file directly for a benchmark against a linear scan.
+'''
+
+import math
+from MAVProxy.modules.lib import mp_util
+
+class SpatialIndex(object):
+    '''nearest neighbour lookup of keyed (lat, lon) points. cell_size
+    is the bucket size in meters'''
+    def __init__(self, cell_size=200.0):
+        self.cell_size = cell_size
+        self.clear()
+
+    def clear(self):
+        '''remove all points'''
+        self.cells = {}
+        self.points = {}
+        self.dlat = None
+        self.dlon = None
+        self.coslat = None
+        self.bounds = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def cell(self, lat, lon):
+        return (int(math.floor(lat / self.dlat)), int(math.floor(lon / self.dlon)))
+
+    def add(self, key, lat, lon):
+        '''add a point, replacing any point with the same key'''
+        if key in self.points:
+            self.remove(key)
+        if self.dlat is None:
+            # cells are sized for the latitude of the first point
+            self.coslat = max(math.cos(math.radians(lat)), 0.01)
+            self.dlat = math.degrees(self.cell_size / mp_util.radius_of_earth)
+            self.dlon = self.dlat / self.coslat
+        c = self.cell(lat, lon)
+        self.cells.setdefault(c, []).append(key)
+        self.points[key] = (lat, lon)
+        if self.bounds is None:
+            self.bounds = [c[0], c[0], c[1], c[1]]
+        else:
+            self.bounds = [min(self.bounds[0], c[0]), max(self.bounds[1], c[0]),
+                           min(self.bounds[2], c[1]), max(self.bounds[3], c[1])]
+
+    def remove(self, key):
+        '''remove a point'''
+        (lat, lon) = self.points.pop(key)
+        c = self.cell(lat, lon)
+        self.cells[c].remove(key)
+        if len(self.cells[c]) == 0:
+            del self.cells[c]
+
+    def position(self, key):
+        '''return (lat, lon) of a point'''
+        return self.points[key]
+
+    def nearest(self, lat, lon, max_distance=None, match=None):
+        '''return (key, distance) of the nearest point, or (None, None).
+        If match is given only keys for which match(key) is true are
+        considered'''
+        if len(self.points) == 0:
+            return (None, None)
+        (r, c) = self.cell(lat, lon)
+        (rmin, rmax, cmin, cmax) = self.bounds
+        # a ring of cells k away is at least this many meters per ring
+        # from the query point
+        ring_size = self.cell_size * min(1.0, math.cos(math.radians(lat)) / self.coslat) * 0.99
+        k = max(0, rmin - r, r - rmax, cmin - c, c - cmax)
+        kmax = max(r - rmin, rmax - r, c - cmin, cmax - c)
+        best = (None, None)
+        while k <= kmax:
+            if best[1] is not None and best[1] <= (k-1) * ring_size:
+                break
+            if max_distance is not None and (k-1) * ring_size > max_distance:
+                break
+            if 8*k > len(self.cells):
+                # sparse points, quicker to look at every occupied cell
+                # than at the empty cells of the remaining rings
+                for key in self.points:
+                    if match is not None and not match(key):
+                        continue
+                    (plat, plon) = self.points[key]
+                    d = mp_util.gps_distance(lat, lon, plat, plon)
+                    if best[1] is None or d < best[1]:
+                        best = (key, d)
+                break
+            for cell in self.ring(r, c, k):
+                for key in self.cells.get(cell, []):
+                    if match is not None and not match(key):
+                        continue
+                    (plat, plon) = self.points[key]
+                    d = mp_util.gps_distance(lat, lon, plat, plon)
+                    if best[1] is None or d < best[1]:
+                        best = (key, d)
+            k += 1
+        if max_distance is not None and best[1] is not None and best[1] > max_distance:
+            return (None, None)
+        return best
+
+    def ring(self, r, c, k):
+        '''cells at chebyshev distance k from cell (r, c)'''
+        if k == 0:
+            return [(r, c)]
+        ret = []
+        for cc in range(c-k, c+k+1):
+            ret.append((r-k, cc))
+            ret.append((r+k, cc))
+        for rr in range(r-k+1, r+k):
+            ret.append((rr, c-k))
+            ret.append((rr, c+k))
+        return ret
+
+    def within(self, lat, lon, radius):
+        '''return a list of (key, distance) of points within radius
+        meters, nearest first'''
+        if len(self.points) == 0:
+            return []
+        (r, c) = self.cell(lat, lon)
+        ring_size = self.cell_size * min(1.0, math.cos(math.radians(lat)) / self.coslat) * 0.99
+        n = int(radius / ring_size) + 1
+        (rmin, rmax, cmin, cmax) = self.bounds
+        ret = []
+        for rr in range(max(r-n, rmin), min(r+n, rmax)+1):
+            for cc in range(max(c-n, cmin), min(c+n, cmax)+1):
+                for key in self.cells.get((rr, cc), []):
+                    (plat, plon) = self.points[key]
+                    d = mp_util.gps_distance(lat, lon, plat, plon)
+                    if d <= radius:
+                        ret.append((key, d))
+        ret.sort(key=lambda x: x[1])
+        return ret
+
+
+if __name__ == "__main__":
+    import time, random
+    from optparse import OptionParser
+    parser = OptionParser("mp_spatial.py [options]")
+    parser.add_option("--count", type='int', default=5000, help="number of points")
+    parser.add_option("--queries", type='int', default=2000, help="number of queries")
+    (opts, args) = parser.parse_args()
+
+    rnd = random.Random(1)
+    (lat, lon) = (-35.363261, 149.165230)
+    points = [mp_util.gps_newpos(lat, lon, rnd.uniform(0, 360), rnd.uniform(0, 10000))
+              for i in range(opts.count)]
+    queries = [mp_util.gps_newpos(lat, lon, rnd.uniform(0, 360), rnd.uniform(0, 12000))
+               for i in range(opts.queries)]
+    t0 = time.time()
+    index = SpatialIndex()
+    for i in range(len(points)):
+        index.add(i, points[i][0], points[i][1])
+    t1 = time.time()
+    r1 = [index.nearest(q[0], q[1]) for q in queries]
+    t2 = time.time()
+    nlinear = min(opts.queries, 200)
+    r2 = [min([(mp_util.gps_distance(q[0], q[1], p[0], p[1]), i) for (i, p) in enumerate(points)])
+          for q in queries[:nlinear]]
+    t3 = time.time()
+    errors = len([i for i in range(nlinear) if abs(r1[i][1] - r2[i][0]) > 1.0e-6])
+    print("%u points indexed in %.1fms" % (opts.count, (t1-t0)*1000))
+    print("indexed: %.0f queries/s" % (opts.queries / (t2-t1)))
+    print("linear: %.0f queries/s" % (nlinear / (t3-t2)))
+    print("%u mismatches in %u queries" % (errors, nlinear))
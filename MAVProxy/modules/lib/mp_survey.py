@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+'''
+survey grid generation
+
+Generates a lawnmower path covering a polygon, with lanes spaced from
+the camera footprint and sidelap, and optionally points along each
+lane at the photo interval so that altitudes can follow the terrain.
+The polygon is handled in a local flat earth frame, which is accurate
+enough for areas a vehicle can survey in one flight.
+'''
+
+import math
+import numpy
+from MAVProxy.modules.lib import mp_util
+
+def camera_footprint(alt, hfov, vfov):
+    '''return (width, length) in meters of the ground seen by a downward
+    camera at alt meters, with hfov across track and vfov along track'''
+    width = 2 * alt * math.tan(math.radians(hfov) / 2)
+    length = 2 * alt * math.tan(math.radians(vfov) / 2)
+    return (width, length)
+
+def longest_edge_bearing(polygon):
+    '''bearing in degrees of the longest edge of a polygon, which gives
+    the fewest turns when used as the lane direction'''
+    best = (0, 0)
+    for i in range(len(polygon)):
+        (lat1, lon1) = polygon[i]
+        (lat2, lon2) = polygon[(i+1) % len(polygon)]
+        d = mp_util.gps_distance(lat1, lon1, lat2, lon2)
+        if d > best[0]:
+            best = (d, mp_util.gps_bearing(lat1, lon1, lat2, lon2))
+    return best[1]
+
+def survey_grid(polygon, lane_spacing, bearing, point_spacing=None):
+    '''return (lat, lon) arrays of a lawnmower path over polygon, a list
+    of (lat, lon) tuples. Lanes run along bearing, lane_spacing meters
+    apart. If point_spacing is given, points are added along each lane
+    at that spacing, otherwise only the lane ends are returned'''
+    poly = numpy.array(polygon, dtype=float)
+    if len(poly) > 1 and (poly[0] == poly[-1]).all():
+        # drop closing point
+        poly = poly[:-1]
+    lat0 = poly[:,0].mean()
+    lon0 = poly[:,1].mean()
+    scale = math.radians(1) * mp_util.radius_of_earth
+    coslat = math.cos(math.radians(lat0))
+    x = (poly[:,1] - lon0) * scale * coslat
+    y = (poly[:,0] - lat0) * scale
+
+    # rotate so lanes run along u at constant v. The rotation is its own inverse
+    s = math.sin(math.radians(bearing))
+    c = math.cos(math.radians(bearing))
+    u = x*s + y*c
+    v = x*c - y*s
+
+    # the edges of the polygon
+    u1 = u
+    v1 = v
+    u2 = numpy.roll(u, -1)
+    v2 = numpy.roll(v, -1)
+
+    nlanes = int(math.floor((v.max() - v.min()) / lane_spacing)) + 1
+    margin = ((v.max() - v.min()) - (nlanes-1) * lane_spacing) / 2
+    lanes = v.min() + margin + numpy.arange(nlanes) * lane_spacing
+
+    # crossing point of every lane with every edge at once
+    V = lanes[:,numpy.newaxis]
+    crosses = ((v1 <= V) & (V < v2)) | ((v2 <= V) & (V < v1))
+    dv = numpy.where(v2 != v1, v2 - v1, 1.0)
+    U = u1 + (V - v1) * (u2 - u1) / dv
+
+    pu = []
+    pv = []
+    reverse = False
+    for i in range(nlanes):
+        ucross = numpy.sort(U[i][crosses[i]])
+        segments = [(ucross[j], ucross[j+1]) for j in range(0, len(ucross)-1, 2)]
+        if reverse:
+            segments = [(b, a) for (a, b) in reversed(segments)]
+        reverse = not reverse
+        for (a, b) in segments:
+            if point_spacing is None:
+                pts = numpy.array([a, b])
+            else:
+                n = max(int(math.ceil(abs(b - a) / point_spacing)), 1)
+                pts = numpy.linspace(a, b, n+1)
+            pu.append(pts)
+            pv.append(numpy.ones(len(pts)) * lanes[i])
+    if len(pu) == 0:
+        return (numpy.array([]), numpy.array([]))
+    pu = numpy.concatenate(pu)
+    pv = numpy.concatenate(pv)
+    x = pu*s + pv*c
+    y = pu*c - pv*s
+    return (lat0 + y / scale, lon0 + x / (scale * coslat))
+
+def ground_heights(lat, lon, get_elevation, resolution=1.0/1200):
+    '''ground height at each point, interpolated between the corners of
+    the terrain cell of the given resolution in degrees it is in, so each
+    corner is looked up only once. The default resolution is the SRTM3
+    grid, so the heights match looking each point up. Points with a
+    corner without data are NaN'''
+    pos = numpy.column_stack((lat, lon)) / resolution
+    base = numpy.floor(pos)
+    frac = pos - base
+    base = base.astype(numpy.int64)
+    corners = numpy.concatenate([base + [i, j] for i in (0, 1) for j in (0, 1)])
+    (unique, inverse) = numpy.unique(corners, axis=0, return_inverse=True)
+    heights = numpy.empty(len(unique))
+    for i in range(len(unique)):
+        h = get_elevation(unique[i][0] * resolution, unique[i][1] * resolution)
+        if h is None:
+            h = numpy.nan
+        heights[i] = h
+    (h00, h01, h10, h11) = heights[numpy.ravel(inverse)].reshape(4, -1)
+    (flat, flon) = (frac[:, 0], frac[:, 1])
+    return (h00 * (1 - flat) * (1 - flon) + h01 * (1 - flat) * flon +
+            h10 * flat * (1 - flon) + h11 * flat * flon)
+
+if __name__ == "__main__":
+    import time
+    from optparse import OptionParser
+    parser = OptionParser("mp_survey.py [options]")
+    parser.add_option("--size", type='float', default=3000, help="side of square area in meters")
+    parser.add_option("--alt", type='float', default=60, help="altitude in meters")
+    parser.add_option("--spacing", type='float', default=20, help="point spacing in meters")
+    (opts, args) = parser.parse_args()
+
+    (lat, lon) = (-35.363261, 149.165230)
+    polygon = [(lat, lon),
+               mp_util.gps_newpos(lat, lon, 0, opts.size),
+               mp_util.gps_newpos(lat, lon, 45, opts.size*math.sqrt(2)),
+               mp_util.gps_newpos(lat, lon, 90, opts.size)]
+    (width, length) = camera_footprint(opts.alt, 60, 45)
+    t0 = time.time()
+    (plat, plon) = survey_grid(polygon, width*0.7, longest_edge_bearing(polygon), opts.spacing)
+    t1 = time.time()
+    h = ground_heights(plat, plon, lambda lat, lon: 500 + lat + lon)
+    t2 = time.time()
+    print("%u points, grid %.1fms, ground heights %.1fms" % (len(plat), (t1-t0)*1000, (t2-t1)*1000))
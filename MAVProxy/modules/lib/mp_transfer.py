@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+'''
+helpers for pipelined transfers over a MAVLink link
+
+IndexBitmap records which items of a transfer have arrived,
+AdaptiveWindow sizes the number of outstanding requests from the
+measured round trip time and loss, and TransferProgress reports rate
+and ETA. LossyLink is a simple simulated link used for benchmarking.
+
+Run this file directly for benchmarks of fetches and acknowledged
+writes against a simulated lossy link.
+'''
+
+import time, random
+
+class IndexBitmap(object):
+    '''a set of received indices, stored one byte per index'''
+    def __init__(self, size=0):
+        self.bits = bytearray(size)
+        self.count = 0
+
+    def __len__(self):
+        return len(self.bits)
+
+    def __contains__(self, idx):
+        return idx >= 0 and idx < len(self.bits) and self.bits[idx] != 0
+
+    def resize(self, size):
+        '''grow the bitmap to hold size indices'''
+        if size > len(self.bits):
+            self.bits.extend(bytearray(size - len(self.bits)))
+
+    def add(self, idx):
+        '''mark an index as received, returning True if it is new'''
+        if idx >= len(self.bits):
+            self.resize(idx+1)
+        if self.bits[idx]:
+            return False
+        self.bits[idx] = 1
+        self.count += 1
+        return True
+
+    def complete(self):
+        return self.count == len(self.bits)
+
+    def missing(self, start=0, end=None):
+        '''generate missing indices in [start, end)'''
+        if end is None or end > len(self.bits):
+            end = len(self.bits)
+        idx = self.bits.find(b'\x00', start, end)
+        while idx != -1:
+            yield idx
+            idx = self.bits.find(b'\x00', idx+1, end)
+
+    def missing_ranges(self, start=0, end=None):
+        '''generate (first, count) tuples of runs of missing indices'''
+        if end is None or end > len(self.bits):
+            end = len(self.bits)
+        idx = self.bits.find(b'\x00', start, end)
+        while idx != -1:
+            last = self.bits.find(b'\x01', idx, end)
+            if last == -1:
+                last = end
+            yield (idx, last - idx)
+            idx = self.bits.find(b'\x00', last, end)
+
+
+class AdaptiveWindow(object):
+    '''a window of outstanding requests which grows as replies arrive and
+    halves when most of it is lost, with a retransmit timeout derived
+    from the smoothed round trip time'''
+    def __init__(self, initial=4, minimum=1, maximum=64,
+                 initial_timeout=1.0, min_timeout=0.05, max_timeout=5.0):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.initial_timeout = initial_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.reset()
+
+    def reset(self):
+        '''forget all outstanding requests and statistics'''
+        self.window = float(self.initial)
+        self.ssthresh = float(self.maximum)
+        self.outstanding = {}
+        self.resent = set()
+        self.srtt = None
+        self.rttvar = 0.0
+        self.sent_count = 0
+        self.lost_count = 0
+
+    def timeout(self):
+        '''current retransmit timeout'''
+        if self.srtt is None:
+            return self.initial_timeout
+        rto = self.srtt + 4 * self.rttvar
+        return min(max(rto, self.min_timeout), self.max_timeout)
+
+    def can_send(self):
+        return len(self.outstanding) < int(self.window)
+
+    def sent(self, key, now=None):
+        '''record that a request for key has been sent'''
+        if now is None:
+            now = time.time()
+        self.outstanding[key] = now
+        self.sent_count += 1
+
+    def received(self, key, now=None):
+        '''record a reply for key, returning the round trip time or None
+        if the key was not outstanding or was retransmitted'''
+        if now is None:
+            now = time.time()
+        tsent = self.outstanding.pop(key, None)
+        if tsent is None:
+            return None
+        if self.window < self.ssthresh:
+            self.window += 1.0
+        else:
+            self.window += 1.0 / self.window
+        self.window = min(self.window, self.maximum)
+        if key in self.resent:
+            # can't tell which request this is a reply to
+            self.resent.discard(key)
+            return None
+        rtt = now - tsent
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        return rtt
+
+    def expire(self, now=None):
+        '''remove and return the keys whose requests have timed out'''
+        if now is None:
+            now = time.time()
+        timeout = self.timeout()
+        lost = [k for (k, t) in self.outstanding.items() if now - t > timeout]
+        if len(lost) == 0:
+            return lost
+        # random loss on a radio link is normal and is handled by
+        # re-requesting, so only shrink the window when most of it was
+        # lost at once, which means the link is stalled or congested
+        fraction = len(lost) / float(len(self.outstanding))
+        for k in lost:
+            self.outstanding.pop(k)
+            self.resent.add(k)
+        self.lost_count += len(lost)
+        if fraction >= 0.5:
+            self.ssthresh = max(self.window / 2, self.minimum)
+            self.window = self.ssthresh
+        return lost
+
+    def loss_rate(self):
+        if self.sent_count == 0:
+            return 0.0
+        return self.lost_count / float(self.sent_count)
+
+    def __str__(self):
+        srtt = self.srtt
+        if srtt is None:
+            srtt = 0
+        return "window=%.1f outstanding=%u rtt=%.0fms timeout=%.0fms loss=%.1f%%" % (
+            self.window, len(self.outstanding), srtt*1000, self.timeout()*1000,
+            self.loss_rate()*100)
+
+
+class TransferProgress(object):
+    '''rate and ETA reporting for a transfer of total items'''
+    def __init__(self, total=0, interval=5.0):
+        self.total = total
+        self.interval = interval
+        self.reset()
+
+    def reset(self, now=None):
+        if now is None:
+            now = time.time()
+        self.start_time = now
+        self.last_report = now
+        self.done = 0
+
+    def update(self, done):
+        self.done = done
+
+    def elapsed(self, now=None):
+        if now is None:
+            now = time.time()
+        return now - self.start_time
+
+    def rate(self, now=None):
+        '''items per second so far'''
+        elapsed = self.elapsed(now)
+        if elapsed <= 0:
+            return 0.0
+        return self.done / elapsed
+
+    def eta(self, now=None):
+        '''estimated seconds to completion, or None if unknown'''
+        rate = self.rate(now)
+        if rate <= 0 or self.total == 0:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    def report_due(self, now=None):
+        '''return True at most once every interval seconds'''
+        if now is None:
+            now = time.time()
+        if now - self.last_report < self.interval:
+            return False
+        self.last_report = now
+        return True
+
+
+class LossyLink(object):
+    '''a simulated link with a fixed one way latency, random loss in each
+    direction and a limited rate of replies. Time is passed in explicitly
+    so simulations can run faster than real time'''
+    def __init__(self, latency=0.1, loss=0.1, rate=200, seed=1):
+        self.latency = latency
+        self.loss = loss
+        self.rate = rate
+        self.random = random.Random(seed)
+        self.in_flight = []
+        self.next_reply = 0
+
+    def send(self, key, now):
+        '''send a request for key, which may or may not be answered'''
+        if self.random.random() < self.loss:
+            return
+        arrive = max(now + 2*self.latency, self.next_reply)
+        self.next_reply = arrive + 1.0 / self.rate
+        if self.random.random() < self.loss:
+            return
+        self.in_flight.append((arrive, key))
+
+    def stream(self, keys, now):
+        '''send replies for keys unrequested, as a vehicle does for a full list'''
+        t = max(now + self.latency, self.next_reply)
+        for k in keys:
+            if self.random.random() >= self.loss:
+                self.in_flight.append((t, k))
+            t += 1.0 / self.rate
+        self.next_reply = t
+
+    def receive(self, now):
+        '''return the keys whose replies have arrived by now'''
+        ret = [k for (t, k) in self.in_flight if t <= now]
+        if ret:
+            self.in_flight = [(t, k) for (t, k) in self.in_flight if t > now]
+        return ret
+
+
+def simulate_fetch(count, link, windowed, step=0.01):
+    '''simulate fetching count items that the vehicle first streams
+    unrequested, recovering losses either with the legacy fixed rate of
+    10 requests per second after 1s of silence, or with an AdaptiveWindow.
+    Returns the simulated time taken'''
+    now = 0.0
+    bitmap = IndexBitmap(count)
+    window = AdaptiveWindow()
+    link.stream(range(count), now)
+    last_recv = now
+    last_legacy = now
+    while not bitmap.complete():
+        now += step
+        received = link.receive(now)
+        for idx in received:
+            bitmap.add(idx)
+            window.received(idx, now)
+        if received:
+            last_recv = now
+        if windowed:
+            window.expire(now)
+            if now - last_recv < window.timeout() and window.sent_count == 0:
+                # the initial stream is still arriving
+                continue
+            for idx in bitmap.missing():
+                if not window.can_send():
+                    break
+                if idx in window.outstanding:
+                    continue
+                link.send(idx, now)
+                window.sent(idx, now)
+        elif now - last_legacy >= 1.0 and now - last_recv >= 1.0:
+            last_legacy = now
+            for idx in list(bitmap.missing())[:10]:
+                link.send(idx, now)
+    return now
+
+
+def simulate_writes(count, link, windowed, step=0.01, retries=3):
+    '''simulate writing count items that are each acknowledged, either one
+    at a time waiting up to 1s for each acknowledgement, or with an
+    AdaptiveWindow. Returns the simulated time taken and the number of
+    failed writes'''
+    now = 0.0
+    queue = list(range(count))
+    queue.reverse()
+    attempts = {}
+    acked = IndexBitmap(count)
+    failed = 0
+    window = AdaptiveWindow(maximum=10)
+    if not windowed:
+        window = AdaptiveWindow(initial=1, maximum=1, initial_timeout=1.0,
+                                min_timeout=1.0, max_timeout=1.0)
+    while len(queue) > 0 or len(window.outstanding) > 0:
+        now += step
+        for idx in link.receive(now):
+            if idx in window.outstanding:
+                window.received(idx, now)
+                acked.add(idx)
+        for idx in window.expire(now):
+            if attempts[idx] >= retries:
+                failed += 1
+            else:
+                queue.append(idx)
+        while len(queue) > 0 and window.can_send():
+            idx = queue.pop()
+            attempts[idx] = attempts.get(idx, 0) + 1
+            link.send(idx, now)
+            window.sent(idx, now)
+    return (now, failed)
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser("mp_transfer.py [options]")
+    parser.add_option("--count", type='int', default=1000, help="number of items")
+    parser.add_option("--latency", type='float', default=0.1, help="one way latency in seconds")
+    parser.add_option("--rate", type='float', default=200, help="link rate in items per second")
+    (opts, args) = parser.parse_args()
+
+    print("%u items, latency %.0fms, %.0f items/s" % (opts.count, opts.latency*1000, opts.rate))
+    print("%6s %10s %10s" % ('loss', 'legacy', 'windowed'))
+    for loss in [0.0, 0.01, 0.05, 0.1, 0.2]:
+        t1 = simulate_fetch(opts.count, LossyLink(opts.latency, loss, opts.rate), False)
+        t2 = simulate_fetch(opts.count, LossyLink(opts.latency, loss, opts.rate), True)
+        print("%5.0f%% %9.1fs %9.1fs" % (loss*100, t1, t2))
+
+    print("")
+    print("acknowledged writes, time (failures)")
+    print("%6s %14s %14s" % ('loss', 'sequential', 'windowed'))
+    for loss in [0.0, 0.01, 0.05, 0.1, 0.2]:
+        (t1, f1) = simulate_writes(opts.count, LossyLink(opts.latency, loss, opts.rate), False)
+        (t2, f2) = simulate_writes(opts.count, LossyLink(opts.latency, loss, opts.rate), True)
+        print("%5.0f%% %9.1fs (%u) %9.1fs (%u)" % (loss*100, t1, f1, t2, f2))
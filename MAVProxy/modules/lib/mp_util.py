@@ -239,6 +239,15 @@ def dot_mavproxy(name=None):
         return dir
     return os.path.join(dir, name)
 
+def vehicle_key(sysid, m):
+    '''return a string identifying a vehicle from its system id and the
+    board UID and firmware version in an AUTOPILOT_VERSION message'''
+    uid = "%x" % m.uid
+    if m.uid == 0 and getattr(m, 'uid2', None) is not None:
+        uid = ''.join(["%02x" % b for b in bytearray(m.uid2)])
+    fwhash = ''.join(["%02x" % b for b in bytearray(m.flight_custom_version)])
+    return "%u-%s-%08x-%s" % (sysid, uid, m.flight_sw_version, fwhash)
+
 def download_url(url):
     '''download a URL and return the content'''
     import urllib2
@@ -7,10 +7,6 @@ import socket, errno
 from pymavlink import mavutil
 from MAVProxy.modules.lib import mp_module
 
-import socket, errno
-from pymavlink import mavutil
-from MAVProxy.modules.lib import mp_module
-
 class DGPSModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(DGPSModule, self).__init__(mpstate, "DGPS", "DGPS injection support for SBP/RTCP/UBC")
@@ -21,6 +17,8 @@ class DGPSModule(mp_module.MPModule):
         mavutil.set_close_on_exec(self.port.fileno())
         self.port.setblocking(0)
         self.inject_seq_nr = 0
+        # the main loop calls us when a packet arrives
+        self.add_select_fd(self.port, self.port_read)
         print("DGPS: Listening for RTCM packets on UDP://%s:%s" % ("127.0.0.1", self.portnum))
     
     def send_rtcm_msg(self, data):
@@ -72,19 +70,25 @@ class DGPSModule(mp_module.MPModule):
 
 
 
-    def idle_task(self):
-        '''called in idle time'''
-        try:
-            data = self.port.recv(1024) # Attempt to read up to 1024 bytes.
-        except socket.error as e:
-            if e.errno in [ errno.EAGAIN, errno.EWOULDBLOCK ]:
-                return
-            raise
-        try:
-            self.send_rtcm_msg(data)
+    def port_read(self, args):
+        '''called from the main select loop when the port is readable'''
+        while True:
+            try:
+                data = self.port.recv(1024) # Attempt to read up to 1024 bytes.
+            except socket.error as e:
+                if e.errno in [ errno.EAGAIN, errno.EWOULDBLOCK ]:
+                    return
+                raise
+            try:
+                self.send_rtcm_msg(data)
+
+            except Exception as e:
+                print("DGPS: GPS Inject Failed:", e)
 
-        except Exception as e:
-            print("DGPS: GPS Inject Failed:", e)
+    def unload(self):
+        '''unload module'''
+        self.remove_select_fd(self.port)
+        self.port.close()
 
 def init(mpstate):
     '''initialise module'''
@@ -51,21 +51,28 @@ class GPSInputModule(mp_module.MPModule):
         self.port.bind((self.ip, self.portnum))
         self.port.setblocking(0)
         mavutil.set_close_on_exec(self.port.fileno())
+        self.add_select_fd(self.port, self.port_read)
         print("Listening for GPS Input packets on UDP://%s:%s" % (self.ip, self.portnum))
 
 
-    def idle_task(self):
-        '''called in idle time'''
-        
-        try:
-            datagram = self.port.recvfrom(self.BUFFER_SIZE)
-            data = json.loads(datagram[0])
-            
-        except socket.error as e:
-            if e.errno in [ errno.EAGAIN, errno.EWOULDBLOCK ]:
-                return
-            raise
-        
+    def port_read(self, args):
+        '''called from the main select loop when the port is readable'''
+        while True:
+            try:
+                datagram = self.port.recvfrom(self.BUFFER_SIZE)
+                data = json.loads(datagram[0])
+
+            except socket.error as e:
+                if e.errno in [ errno.EAGAIN, errno.EWOULDBLOCK ]:
+                    return
+                raise
+            except ValueError as e:
+                print("GPS Input: bad packet:", e)
+                continue
+            self.send_gps_input(data)
+
+    def send_gps_input(self, data):
+        '''send a GPS_INPUT message from a decoded json packet'''
         for key in data.keys():
             self.data[key] = data[key]
         
@@ -100,6 +107,7 @@ class GPSInputModule(mp_module.MPModule):
             print("Usage: port <number>")
             return
         
+        self.remove_select_fd(self.port)
         self.port.close()
         self.portnum = int(args[0])
         self.port = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -107,8 +115,14 @@ class GPSInputModule(mp_module.MPModule):
         self.port.bind((self.ip, self.portnum))
         self.port.setblocking(0)
         mavutil.set_close_on_exec(self.port.fileno())
+        self.add_select_fd(self.port, self.port_read)
         print("Listening for GPS INPUT packets on UDP://%s:%s" % (self.ip, self.portnum))
 
+    def unload(self):
+        '''unload module'''
+        self.remove_select_fd(self.port)
+        self.port.close()
+
 
 def init(mpstate):
     '''initialise module'''
@@ -95,18 +95,10 @@ class ArmModule(mp_module.MPModule):
             p2 = 0
             if len(args) == 2 and args[1] == 'force':
                 p2 = 2989
-            self.master.mav.command_long_send(
-                self.target_system,  # target_system
-                self.target_component,
-                mavutil.mavlink.MAV_CMD_COMPONENT_ARM_DISARM, # command
-                0, # confirmation
-                1, # param1 (1 to indicate arm)
-                p2, # param2  (all other params meaningless)
-                0, # param3
-                0, # param4
-                0, # param5
-                0, # param6
-                0) # param7
+            self.send_command_long(
+                mavutil.mavlink.MAV_CMD_COMPONENT_ARM_DISARM,
+                [1,   # param1 (1 to indicate arm)
+                 p2]) # param2 (all other params meaningless)
             return
 
         if args[0] == "safetyon":
@@ -128,18 +120,11 @@ class ArmModule(mp_module.MPModule):
         p2 = 0
         if len(args) == 1 and args[0] == 'force':
             p2 = 21196
-        self.master.mav.command_long_send(
-            self.target_system,  # target_system
-            0,
-            mavutil.mavlink.MAV_CMD_COMPONENT_ARM_DISARM, # command
-            0, # confirmation
-            0, # param1 (0 to indicate disarm)
-            p2, # param2 (all other params meaningless)
-            0, # param3
-            0, # param4
-            0, # param5
-            0, # param6
-            0) # param7
+        self.send_command_long(
+            mavutil.mavlink.MAV_CMD_COMPONENT_ARM_DISARM,
+            [0,   # param1 (0 to indicate disarm)
+             p2], # param2 (all other params meaningless)
+            target_component=0)
 
     def all_checks_enabled(self):
         ''' returns true if the UAV is skipping any arming checks'''
@@ -26,6 +26,7 @@ class CmdlongModule(mp_module.MPModule):
         self.add_command('command_int', self.cmd_command_int, "execute mavlink command_int",
                          self.cmd_long_commands())
         self.add_command('engine', self.cmd_engine, "engine")
+        self.add_command('cmdstatus', self.cmd_cmdstatus, "show in-flight commands and command statistics")
 
     def cmd_long_commands(self):
         atts = dir(mavutil.mavlink)
@@ -335,13 +336,11 @@ class CmdlongModule(mp_module.MPModule):
             return
 
         floating_args = [ float(x) for x in args[1:] ]
-        while len(floating_args) < 7:
-            floating_args.append(float(0))
-        self.master.mav.command_long_send(self.settings.target_system,
-                                          self.settings.target_component,
-                                          command,
-                                          0,
-                                          *floating_args)
+        self.send_command_long(command, floating_args)
+
+    def cmd_cmdstatus(self, args):
+        '''show command transaction status'''
+        self.mpstate.command_manager.show()
 
     def cmd_command_int(self, args):
         '''execute supplied command_int'''
@@ -23,6 +23,8 @@ import errno
 from MAVProxy.modules.lib import mp_module
 import time
 from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib import mp_remotelog
+from MAVProxy.modules.lib import mp_dfindex
 
 
 class dataflash_logger(mp_module.MPModule):
@@ -35,6 +37,8 @@ class dataflash_logger(mp_module.MPModule):
             "logging of mavlink dataflash messages"
         )
         self.sender = None
+        self.receiver = None
+        self.indexer = None
         self.stopped = False
         self.time_last_start_packet_sent = 0
         self.time_last_stop_packet_sent = 0
@@ -65,6 +69,7 @@ class dataflash_logger(mp_module.MPModule):
         elif args[0] == "stop":
             self.sender = None
             self.stopped = True
+            self.close_log()
         elif args[0] == "start":
             self.stopped = False
         elif args[0] == "set":
@@ -97,24 +102,62 @@ class dataflash_logger(mp_module.MPModule):
         '''open a new dataflash log, reset state'''
         filename = self.new_log_filepath()
 
-        self.last_seqno = 0
+        self.close_log()
         self.logfile = open(filename, 'w+b')
+        self.receiver = mp_remotelog.RemoteLogReceiver(self.logfile,
+                                                       self.send_block_status)
+        # index the log as it arrives, so it can be opened without a scan
+        self.indexer = mp_dfindex.DFIndexer(open(mp_dfindex.index_filename(filename), 'wb'))
         print("DFLogger: logging started (%s)" % (filename))
         self.prev_cnt = 0
         self.download = 0
         self.prev_download = 0
         self.last_idle_status_printed_time = time.time()
         self.last_status_time = time.time()
-        self.missing_blocks = {}
-        self.acking_blocks = {}
-        self.blocks_to_ack_and_nack = []
-        self.missing_found = 0
-        self.abandoned = 0
         self.dropped = 0
 
+    def flush_log(self):
+        '''write out buffered log data'''
+        if self.receiver is not None:
+            self.receiver.flush()
+            self.logfile.flush()
+            self.update_index()
+
+    def close_log(self):
+        '''write out buffered log data and finish the index of the log'''
+        self.flush_log()
+        if self.indexer is not None:
+            self.indexer.close()
+            self.indexer = None
+
+    def update_index(self):
+        '''index the log up to the first block still missing'''
+        if self.indexer is None:
+            return
+        end = self.receiver.contiguous_end()
+        if end <= self.indexer.end():
+            return
+        self.logfile.seek(self.indexer.end())
+        self.indexer.feed(self.logfile.read(end - self.indexer.end()))
+        self.indexer.flush()
+
+    def send_block_status(self, seqno, status):
+        '''ACK or NACK a block'''
+        if status == mp_remotelog.ACK:
+            mavstatus = mavutil.mavlink.MAV_REMOTE_LOG_DATA_BLOCK_ACK
+        else:
+            if self.log_settings.verbose:
+                print("DFLogger: Asking for block (%d)" % (seqno,))
+            mavstatus = mavutil.mavlink.MAV_REMOTE_LOG_DATA_BLOCK_NACK
+        (target_sys, target_comp) = self.sender
+        self.master.mav.remote_log_block_status_send(target_sys,
+                                                     target_comp,
+                                                     seqno,
+                                                     mavstatus)
+
     def status(self):
         '''returns information about module'''
-        if self.download is None:
+        if self.receiver is None:
             return "Not started"
 
         transferred = self.download - self.prev_download
@@ -127,10 +170,10 @@ class dataflash_logger(mp_module.MPModule):
                "Abandoned:%(abandoned)d" %
                {"interval": interval,
                 "rate": transferred/(interval*1000),
-                "block_cnt": self.last_seqno,
-                "missing": len(self.missing_blocks),
-                "fixed": self.missing_found,
-                "abandoned": self.abandoned,
+                "block_cnt": self.receiver.last_seqno,
+                "missing": len(self.receiver.missing),
+                "fixed": self.receiver.missing_found,
+                "abandoned": self.receiver.abandoned,
                 "state": "Inactive" if self.stopped else "Active"})
 
     def idle_print_status(self):
@@ -142,61 +185,9 @@ class dataflash_logger(mp_module.MPModule):
 
     def idle_send_acks_and_nacks(self):
         '''Send packets to UAV in idle loop'''
-        max_blocks_to_send = 10
-        blocks_sent = 0
-        i = 0
-        now = time.time()
-        while (i < len(self.blocks_to_ack_and_nack) and
-               blocks_sent < max_blocks_to_send):
-            # print("ACKLIST: %s" %
-            # ([x[1] for x in self.blocks_to_ack_and_nack],))
-            stuff = self.blocks_to_ack_and_nack[i]
-
-            [master, block, status, first_sent, last_sent] = stuff
-            if status == 1:
-                # print("DFLogger: ACKing block (%d)" % (block,))
-                mavstatus = mavutil.mavlink.MAV_REMOTE_LOG_DATA_BLOCK_ACK
-                (target_sys, target_comp) = self.sender
-                self.master.mav.remote_log_block_status_send(target_sys,
-                                                             target_comp,
-                                                             block,
-                                                             mavstatus)
-                blocks_sent += 1
-                del self.acking_blocks[block]
-                del self.blocks_to_ack_and_nack[i]
-                continue
-
-            if block not in self.missing_blocks:
-                # we've received this block now
-                del self.blocks_to_ack_and_nack[i]
-                continue
-
-            # give up on packet if we have seen one with a much higher
-            # number (or after 60 seconds):
-            if (self.last_seqno - block > 200) or (now - first_sent > 60):
-                if self.log_settings.verbose:
-                    print("DFLogger: Abandoning block (%d)" % (block,))
-                del self.blocks_to_ack_and_nack[i]
-                del self.missing_blocks[block]
-                self.abandoned += 1
-                continue
-
-            i += 1
-            # only send each nack every-so-often:
-            if last_sent is not None:
-                if now - last_sent < 0.1:
-                    continue
-
-            if self.log_settings.verbose:
-                print("DFLogger: Asking for block (%d)" % (block,))
-            mavstatus = mavutil.mavlink.MAV_REMOTE_LOG_DATA_BLOCK_NACK
-            (target_sys, target_comp) = self.sender
-            self.master.mav.remote_log_block_status_send(target_sys,
-                                                         target_comp,
-                                                         block,
-                                                         mavstatus)
-            blocks_sent += 1
-            stuff[4] = now
+        self.receiver.send_acks_and_nacks()
+        if self.receiver.flush_due():
+            self.update_index()
 
     def idle_task_started(self):
         '''called in idle task only when logging is started'''
@@ -260,32 +251,6 @@ class dataflash_logger(mp_module.MPModule):
                 return False
         return True
 
-    def do_ack_block(self, seqno):
-        if seqno in self.acking_blocks:
-            # already acking this one; we probably sent
-            # multiple nacks and received this one
-            # multiple times
-            return
-
-        now = time.time()
-
-        # ACK the block we just got:
-        self.blocks_to_ack_and_nack.append([self.master, seqno, 1, now, None])
-        self.acking_blocks[seqno] = 1
-
-        # NACK any blocks we haven't seen and should have:
-        if(seqno - self.last_seqno > 1):
-            for block in range(self.last_seqno+1, seqno):
-                if block not in self.missing_blocks and \
-                   block not in self.acking_blocks:
-                    self.missing_blocks[block] = 1
-                    if self.log_settings.verbose:
-                        print("DFLogger: setting %d for nacking" % (block,))
-                    self.blocks_to_ack_and_nack.append(
-                        [self.master, block, 0, now, None]
-                    )
-        # print("\nmissed blocks: ",self.missing_blocks)
-
     def mavlink_packet(self, m):
         '''handle mavlink packets'''
         if m.get_type() == 'REMOTE_LOG_DATA_BLOCK':
@@ -309,29 +274,16 @@ class dataflash_logger(mp_module.MPModule):
                 return
 
             if self.sender is not None:
-                size = len(m.data)
-                data = ''.join(str(chr(x)) for x in m.data[:size])
-                ofs = size*(m.seqno)
-                self.logfile.seek(ofs)
-                self.logfile.write(data)
-
-                if m.seqno in self.missing_blocks:
-                    if self.log_settings.verbose:
-                        print("DFLogger: Got missing block: %d" % (m.seqno,))
-                    del self.missing_blocks[m.seqno]
-                    self.missing_found += 1
-                    self.blocks_to_ack_and_nack.append(
-                        [self.master, m.seqno, 1, time.time(), None]
-                    )
-                    self.acking_blocks[m.seqno] = 1
-                    # print("DFLogger: missing: %s" %
-                    # (str(self.missing_blocks),))
-                else:
-                    self.do_ack_block(m.seqno)
-                    if self.last_seqno < m.seqno:
-                        self.last_seqno = m.seqno
-                self.download += size
+                data = bytearray(m.data)
+                if self.log_settings.verbose and m.seqno in self.receiver.missing:
+                    print("DFLogger: Got missing block: %d" % (m.seqno,))
+                self.receiver.received(m.seqno, data)
+                self.download += len(data)
+
 
+    def unload(self):
+        '''write out buffered log data on exit'''
+        self.close_log()
 
 def init(mpstate):
     '''initialise module'''
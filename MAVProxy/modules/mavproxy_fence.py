@@ -5,6 +5,9 @@ import os, time, platform
 from pymavlink import mavwp, mavutil
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_mission
+from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib import mp_geofence
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import *
 
@@ -19,10 +22,26 @@ class FenceModule(mp_module.MPModule):
         self.healthy = True
         self.add_command('fence', self.cmd_fence,
                          "geo-fence management",
-                         ["<draw|list|clear|enable|disable|move|remove>",
-                          "<load|save> (FILENAME)"])
+                         ["<draw|list|clear|enable|disable|move|remove|status>",
+                          "<load|save> (FILENAME)",
+                          "set (FENCESETTING)"])
+
+        self.fence_settings = mp_settings.MPSettings(
+            [('margin', float, 30.0),
+             ('adsb', bool, True)])
+        self.add_completion_function('(FENCESETTING)', self.fence_settings.completion)
+
+        # polygon geometry for breach distance checks, rebuilt when the
+        # fence changes
+        self.geometry = None
+        self.geometry_change = None
+        self.breach_distance = None
+        self.breach_state = None
+        self.adsb_inside = set()
 
         self.have_list = False
+        self.fence_download = None
+        self.fence_save_filename = None
 
         if self.continue_mode and self.logdir is not None:
             fencetxt = os.path.join(self.logdir, 'fence.txt')
@@ -49,6 +68,12 @@ class FenceModule(mp_module.MPModule):
 
     def idle_task(self):
         '''called on idle'''
+        if self.fence_download is not None:
+            if self.fence_download.failed():
+                self.console.error("Fence download failed: %s" % self.fence_download.summary())
+                self.fence_download = None
+            else:
+                self.fence_download.check()
         if self.module('console') is not None and not self.menu_added_console:
             self.menu_added_console = True
             self.module('console').add_menu(self.menu)
@@ -56,11 +81,98 @@ class FenceModule(mp_module.MPModule):
             self.menu_added_map = True
             self.module('map').add_menu(self.menu)
 
+    def update_geometry(self):
+        '''rebuild the fence geometry if the fence has changed'''
+        if self.geometry_change == self.fenceloader.last_change:
+            return
+        self.geometry_change = self.fenceloader.last_change
+        self.geometry = None
+        self.adsb_inside = set()
+        if self.fenceloader.count() < 4:
+            self.clear_breach_status()
+            return
+        try:
+            self.geometry = mp_geofence.FenceGeometry(self.fenceloader.polygon())
+        except ValueError as msg:
+            self.console.error("Bad fence polygon: %s" % msg)
+            self.clear_breach_status()
+
+    def clear_breach_status(self):
+        '''remove the breach distance display'''
+        if self.breach_state is not None:
+            self.console.set_status('FenceDist', '', row=0)
+            if self.mpstate.map:
+                self.mpstate.map.remove_object('FenceAlert')
+        self.breach_distance = None
+        self.breach_state = None
+
+    def check_vehicle(self, lat, lon):
+        '''update the distance to breach of the fence polygon for the
+        vehicle, with console status, voice and map alerts'''
+        d = self.geometry.breach_distance(lat, lon)
+        if d <= 0:
+            state = 'outside'
+            fg = 'red'
+        elif d <= self.fence_settings.margin:
+            state = 'near'
+            fg = 'orange'
+        else:
+            state = 'inside'
+            fg = 'green'
+        self.console.set_status('FenceDist', 'FenceDist %.0fm' % d, row=0, fg=fg)
+        if state != self.breach_state:
+            if state == 'outside':
+                self.say("outside fence")
+            elif state == 'near':
+                self.say("approaching fence")
+            elif self.breach_state is not None:
+                self.say("inside fence")
+            if state == 'inside' and self.mpstate.map:
+                self.mpstate.map.remove_object('FenceAlert')
+        self.breach_state = state
+        self.breach_distance = d
+
+        if state != 'inside' and self.mpstate.map:
+            # a circle around the vehicle touching the fence where the breach is
+            from MAVProxy.modules.mavproxy_map import mp_slipmap
+            self.mpstate.map.add_object(mp_slipmap.SlipCircle('FenceAlert', 3, (lat, lon),
+                                                              max(abs(d), 1), (255, 0, 0),
+                                                              linewidth=2))
+
+    def check_adsb(self, m):
+        '''note ADS-B vehicles entering or leaving the fence'''
+        id = m.ICAO_address
+        inside = self.geometry.inside(m.lat*1.0e-7, m.lon*1.0e-7)
+        if inside and id not in self.adsb_inside:
+            self.adsb_inside.add(id)
+            callsign = m.callsign
+            if not isinstance(callsign, str):
+                callsign = callsign.decode('ascii', 'ignore')
+            callsign = callsign.strip('\0 ')
+            if callsign == '':
+                callsign = str(id)
+            self.say("aircraft %s inside fence" % callsign)
+        elif not inside and id in self.adsb_inside:
+            self.adsb_inside.discard(id)
+
     def mavlink_packet(self, m):
         '''handle and incoming mavlink packet'''
-        if m.get_type() == "FENCE_STATUS":
+        if m.get_type() in ['GLOBAL_POSITION_INT', 'ADSB_VEHICLE']:
+            self.update_geometry()
+        if m.get_type() == 'GLOBAL_POSITION_INT' and self.geometry is not None:
+            if m.lat != 0 or m.lon != 0:
+                self.check_vehicle(m.lat*1.0e-7, m.lon*1.0e-7)
+        elif m.get_type() == 'ADSB_VEHICLE' and self.geometry is not None and self.fence_settings.adsb:
+            self.check_adsb(m)
+        elif m.get_type() == "FENCE_STATUS":
             self.last_fence_breach = m.breach_time
             self.last_fence_status = m.breach_status
+        elif m.get_type() == "FENCE_POINT" and self.fence_download is not None:
+            if self.fence_download.received(m.idx, m):
+                if self.fence_download.complete():
+                    self.fence_download_complete()
+                else:
+                    self.fence_download.check()
         elif m.get_type() in ['SYS_STATUS']:
             bits = mavutil.mavlink.MAV_SYS_STATUS_GEOFENCE
 
@@ -192,9 +304,26 @@ class FenceModule(mp_module.MPModule):
             print("Drawing fence on map")
         elif args[0] == "clear":
             self.param_set('FENCE_TOTAL', 0, 3)
+        elif args[0] == "status":
+            self.fence_status()
+        elif args[0] == "set":
+            self.fence_settings.command(args[1:])
         else:
             self.print_usage()
 
+    def fence_status(self):
+        '''show the fence polygon checks'''
+        self.update_geometry()
+        if self.geometry is None:
+            print("No fence polygon")
+            return
+        print("Fence polygon of %u edges, %u x %u grid" % (len(self.geometry.edges),
+                                                           self.geometry.ncols, self.geometry.nrows))
+        if self.breach_distance is not None:
+            print("Vehicle %s, %.1fm from boundary" % (self.breach_state, abs(self.breach_distance)))
+        if len(self.adsb_inside) > 0:
+            print("ADS-B aircraft inside: %s" % ' '.join([str(id) for id in sorted(self.adsb_inside)]))
+
     def load_fence(self, filename):
         '''load fence points from a file'''
         try:
@@ -267,6 +396,11 @@ class FenceModule(mp_module.MPModule):
         self.send_fence()
         self.have_list = True
 
+    def send_fence_request(self, i):
+        '''request one fence point'''
+        self.master.mav.fence_fetch_point_send(self.target_system,
+                                               self.target_component, i)
+
     def list_fence(self, filename):
         '''list fence points, optionally saving to a file'''
         self.fenceloader.clear()
@@ -274,12 +408,18 @@ class FenceModule(mp_module.MPModule):
         if count == 0:
             print("No geo-fence points")
             return
-        for i in range(int(count)):
-            p = self.fetch_fence_point(i)
-            if p is None:
-                return
-            self.fenceloader.add(p)
+        self.fence_save_filename = filename
+        self.fence_download = mp_mission.MissionDownload(int(count), self.send_fence_request,
+                                                         name='fence points')
+        self.fence_download.check()
 
+    def fence_download_complete(self):
+        '''finish a fence download, saving or showing the points'''
+        for p in self.fence_download.items:
+            self.fenceloader.add(p)
+        self.console.writeln("Downloaded %s" % self.fence_download.summary())
+        self.fence_download = None
+        filename = self.fence_save_filename
         if filename is not None:
             try:
                 self.fenceloader.save(filename.strip('"'))
@@ -298,7 +438,7 @@ class FenceModule(mp_module.MPModule):
         self.have_list = True
 
     def print_usage(self):
-        print("usage: fence <enable|disable|list|load|save|clear|draw|move|remove>")
+        print("usage: fence <enable|disable|list|load|save|clear|draw|move|remove|status|set>")
 
 def init(mpstate):
     '''initialise module'''
@@ -50,8 +50,8 @@ class GraphModule(mp_module.MPModule):
             g.close()
         self.graphs = []
 
-    def mavlink_packet(self, msg):
-        '''handle an incoming mavlink packet'''
+    def mavlink_packets(self, msgs):
+        '''handle a batch of incoming mavlink packets'''
 
         # check for any closed graphs
         for i in range(len(self.graphs) - 1, -1, -1):
@@ -61,7 +61,7 @@ class GraphModule(mp_module.MPModule):
 
         # add data to the rest
         for g in self.graphs:
-            g.add_mavlink_packet(msg)
+            g.add_mavlink_packets(msgs)
 
 
 def init(mpstate):
@@ -84,6 +84,8 @@ class Graph():
         print("Adding graph: %s" % self.fields)
 
         self.values = [None] * len(self.fields)
+        # the latest message of each type, as it was at each message of a batch
+        self.messages = dict(state.master.messages)
         self.livegraph = live_graph.LiveGraph(self.fields,
                                               timespan=state.timespan,
                                               tickresolution=state.tickresolution,
@@ -101,15 +103,28 @@ class Graph():
             self.livegraph.close()
         self.livegraph = None
 
-    def add_mavlink_packet(self, msg):
-        '''add data to the graph'''
-        mtype = msg.get_type()
-        if mtype not in self.msg_types:
+    def add_mavlink_packets(self, msgs):
+        '''add data to the graph for a batch of packets, evaluating each
+        field for every message of its types and sending all the rows
+        to the graph at once'''
+        batch_types = set([msg.get_type() for msg in msgs])
+        if self.msg_types.isdisjoint(batch_types):
             return
-        for i in range(len(self.fields)):
-            if mtype not in self.field_types[i]:
+        # take up messages from elsewhere, except those the batch replays
+        for (k, v) in self.state.master.messages.items():
+            if k not in batch_types:
+                self.messages[k] = v
+        rows = []
+        for msg in msgs:
+            mtype = msg.get_type()
+            self.messages[mtype] = msg
+            if mtype not in self.msg_types:
                 continue
-            f = self.fields[i]
-            self.values[i] = mavutil.evaluate_expression(f, self.state.master.messages)
+            for i in range(len(self.fields)):
+                if mtype not in self.field_types[i]:
+                    continue
+                f = self.fields[i]
+                self.values[i] = mavutil.evaluate_expression(f, self.messages)
+            rows.append(self.values[:])
         if self.livegraph is not None:
-            self.livegraph.add_values(self.values)
+            self.livegraph.add_values_list(rows)
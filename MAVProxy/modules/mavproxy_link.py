@@ -36,6 +36,8 @@ class LinkModule(mp_module.MPModule):
         self.add_completion_function('(LINKS)', self.complete_links)
         self.add_completion_function('(LINK)', self.complete_links)
         self.last_altitude_announce = 0.0
+        # packets waiting to be delivered to modules with a mavlink_packets() hook
+        self.packet_batch = []
 
         self.menu_added_console = False
         if mp_util.has_wxpython:
@@ -57,6 +59,8 @@ class LinkModule(mp_module.MPModule):
             self.menu_add.items = [ MPMenuItem(p, p, '# link add %s' % p) for p in self.complete_serial_ports('') ]
             self.menu_rm.items = [ MPMenuItem(p, p, '# link remove %s' % p) for p in self.complete_links('') ]
             self.module('console').add_menu(self.menu)
+        # catch any packets that arrived outside of process_master()
+        self.flush_packet_batch()
         for m in self.mpstate.mav_master:
             m.source_system = self.settings.source_system
             m.mav.srcSystem = m.source_system
@@ -525,7 +529,8 @@ class LinkModule(mp_module.MPModule):
             if self.mpstate.settings.shownoise and mavutil.all_printable(m.data):
                 self.mpstate.console.write(str(m.data), bg='red')
         elif mtype in [ "COMMAND_ACK", "MISSION_ACK" ]:
-            self.mpstate.console.writeln("Got MAVLink msg: %s" % m)
+            if mtype != "COMMAND_ACK" or self.mpstate.command_manager.handle_ack(m) is None:
+                self.mpstate.console.writeln("Got MAVLink msg: %s" % m)
 
             if mtype == "COMMAND_ACK" and m.command == mavutil.mavlink.MAV_CMD_PREFLIGHT_CALIBRATION:
                 if m.result == mavutil.mavlink.MAV_RESULT_ACCEPTED:
@@ -556,8 +561,12 @@ class LinkModule(mp_module.MPModule):
                     for r in self.mpstate.mav_outputs:
                         r.write(m.get_msgbuf())
 
-            # pass to modules
+            # pass to modules. Modules with a mavlink_packets() hook get
+            # the packet later as part of a batch
+            self.packet_batch.append(m)
             for (mod,pm) in self.mpstate.modules:
+                if hasattr(mod, 'mavlink_packets'):
+                    continue
                 if not hasattr(mod, 'mavlink_packet'):
                     continue
                 try:
@@ -570,6 +579,26 @@ class LinkModule(mp_module.MPModule):
                         traceback.print_exception(exc_type, exc_value, exc_traceback,
                                                   limit=2, file=sys.stdout)
 
+    def flush_packet_batch(self):
+        '''deliver the packets collected since the last flush to modules
+        with a mavlink_packets() hook, one call per module'''
+        if len(self.packet_batch) == 0:
+            return
+        batch = self.packet_batch
+        self.packet_batch = []
+        for (mod,pm) in self.mpstate.modules:
+            if not hasattr(mod, 'mavlink_packets'):
+                continue
+            try:
+                mod.mavlink_packets(batch)
+            except Exception as msg:
+                if self.mpstate.settings.moddebug == 1:
+                    print(msg)
+                elif self.mpstate.settings.moddebug > 1:
+                    exc_type, exc_value, exc_traceback = sys.exc_info()
+                    traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                              limit=2, file=sys.stdout)
+
 def init(mpstate):
     '''initialise module'''
     return LinkModule(mpstate)
@@ -4,27 +4,44 @@
 import time, os
 
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib import mp_logdownload
+from MAVProxy.modules.lib.mp_settings import MPSetting
 
 class LogModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(LogModule, self).__init__(mpstate, "log", "log transfer")
-        self.add_command('log', self.cmd_log, "log file handling", ['<download|status|erase|resume|cancel|list>'])
+        self.add_command('log', self.cmd_log, "log file handling",
+                         ['<download|status|erase|resume|cancel|list>',
+                          'queue <clear>',
+                          'set (LOGSETTING)'])
+        self.log_settings = mp_settings.MPSettings(
+            [MPSetting('order', str, 'newest', choice=['newest', 'smallest']),
+             MPSetting('budget', float, 0.5, range=(0.05, 1.0)),
+             ('throttle', bool, True)])
+        self.add_completion_function('(LOGSETTING)', self.log_settings.completion)
+        # logs waiting to be downloaded in the background, kept across runs
+        self.queue = mp_logdownload.LogQueue(mp_util.dot_mavproxy('logqueue.json'))
+        self.budget = mp_logdownload.LinkBudget()
         self.reset()
+        if len(self.queue) > 0:
+            print("%u logs queued for download, use log list to continue" % len(self.queue))
 
     def reset(self):
-        self.download_set = set()
+        self.download = None
         self.download_file = None
         self.download_lognum = None
         self.download_filename = None
-        self.download_start = None
-        self.download_last_timestamp = None
-        self.download_ofs = 0
-        self.retries = 0
+        self.download_entry = None
+        self.download_saved = 0
+        self.download_background = False
         self.entries = {}
-        self.download_queue = []
+        self.entries_complete = False
 
     def mavlink_packet(self, m):
         '''handle an incoming mavlink packet'''
+        self.budget.packet(len(m.get_msgbuf()), m.get_type() == 'LOG_DATA')
         if m.get_type() == 'LOG_ENTRY':
             self.handle_log_entry(m)
         elif m.get_type() == 'LOG_DATA':
@@ -38,127 +55,209 @@ class LogModule(mp_module.MPModule):
             tstring = time.ctime(m.time_utc)
         self.entries[m.id] = m
         print("Log %u  numLogs %u lastLog %u size %u %s" % (m.id, m.num_logs, m.last_log_num, m.size, tstring))
+        if not self.entries_complete and len(self.entries) >= m.num_logs:
+            self.entries_complete = True
+            self.log_list_complete()
 
+    def log_list_complete(self):
+        '''continue queued downloads once the log list is in'''
+        if len(self.queue) == 0:
+            return
+        for q in self.queue.drop_stale(self.entries):
+            print("Log %u is no longer on the vehicle, removed from queue" % q['id'])
+        self.save_queue()
+        if self.download is None:
+            self.log_download_next()
+
+    def save_queue(self):
+        try:
+            self.queue.save()
+        except Exception as msg:
+            print("Unable to save log queue - %s" % msg)
 
     def handle_log_data(self, m):
         '''handling incoming log data'''
-        if self.download_file is None:
+        if self.download is None:
             return
-        # lose some data
-        # import random
-        # if random.uniform(0,1) < 0.05:
-        #    print('dropping ', str(m))
-        #    return
-        if m.ofs != self.download_ofs:
-            self.download_file.seek(m.ofs)
-            self.download_ofs = m.ofs
-        if m.count != 0:
-            s = bytearray(m.data[:m.count])
-            self.download_file.write(s)
-            self.download_set.add(m.ofs // 90)
-            self.download_ofs += m.count
-        self.download_last_timestamp = time.time()
-        if m.count == 0 or (m.count < 90 and len(self.download_set) == 1 + (m.ofs // 90)):
-            dt = time.time() - self.download_start
-            self.download_file.close()
-            size = os.path.getsize(self.download_filename)
-            speed = size / (1000.0 * dt)
-            print("Finished downloading %s (%u bytes %u seconds, %.1f kbyte/sec %u retries)" % (
-                self.download_filename,
-                size,
-                dt, speed,
-                self.retries))
-            self.download_file = None
-            self.download_filename = None
-            self.download_set = set()
-            self.master.mav.log_request_end_send(self.target_system,
-                                                 self.target_component)
-            if len(self.download_queue):
-                self.log_download_next()
+        if self.download.received(m.ofs, m.count, m.data):
+            self.log_download_complete()
+        else:
+            self.download.check()
+
+    def resume_filename(self, filename):
+        '''sidecar file recording the blocks received for a log file'''
+        return filename + '.resume'
 
-    def handle_log_data_missing(self):
-        '''handling missing incoming log data'''
-        if len(self.download_set) == 0:
+    def save_resume(self):
+        '''save the progress of the download so it can be resumed'''
+        if self.download is None or self.download_entry is None:
             return
-        highest = max(self.download_set)
-        diff = set(range(highest)).difference(self.download_set)
-        if len(diff) == 0:
-            self.master.mav.log_request_data_send(self.target_system,
-                                                       self.target_component,
-                                                       self.download_lognum, (1 + highest) * 90, 0xffffffff)
-            self.retries += 1
-        else:
-            num_requests = 0
-            while num_requests < 20:
-                start = min(diff)
-                diff.remove(start)
-                end = start
-                while end + 1 in diff:
-                    end += 1
-                    diff.remove(end)
-                self.master.mav.log_request_data_send(self.target_system,
-                                                           self.target_component,
-                                                           self.download_lognum, start * 90, (end + 1 - start) * 90)
-                num_requests += 1
-                self.retries += 1
-                if len(diff) == 0:
-                    break
+        try:
+            self.download.save_resume(self.resume_filename(self.download_filename),
+                                      self.download_entry.time_utc)
+        except Exception as msg:
+            print("Unable to save download state - %s" % msg)
+        self.download_saved = time.time()
 
+    def log_download_complete(self):
+        '''finish a log download and start the next queued one'''
+        self.download_file.close()
+        if os.path.exists(self.resume_filename(self.download_filename)):
+            os.unlink(self.resume_filename(self.download_filename))
+        entry = self.download_entry
+        if entry is not None:
+            self.queue.record(entry.id, entry.size, entry.time_utc, self.download_filename,
+                              self.download.digest())
+            self.queue.remove(entry.id)
+            self.save_queue()
+        if self.download_background:
+            self.console.set_status('LogDownload', '', row=3)
+        size = os.path.getsize(self.download_filename)
+        print("Finished downloading %s (%u bytes %u seconds, %.1f kbyte/sec %u requests)" % (
+            self.download_filename,
+            size,
+            self.download.progress.elapsed(),
+            self.download.progress.rate() / 1024.0,
+            self.download.request_count))
+        self.download = None
+        self.download_file = None
+        self.download_filename = None
+        self.download_entry = None
+        self.download_background = False
+        self.master.mav.log_request_end_send(self.target_system,
+                                             self.target_component)
+        self.log_download_next()
+
+    def send_log_request(self, ofs, count):
+        '''request a range of the log being downloaded'''
+        self.master.mav.log_request_data_send(self.target_system,
+                                              self.target_component,
+                                              self.download_lognum, ofs, count)
 
     def log_status(self):
         '''show download status'''
-        if self.download_filename is None:
+        if self.download is None:
             print("No download")
-            return
-        dt = time.time() - self.download_start
-        speed = os.path.getsize(self.download_filename) / (1000.0 * dt)
-        m = self.entries.get(self.download_lognum, None)
-        if m is None:
-            size = 0
         else:
-            size = m.size
-        highest = max(self.download_set)
-        diff = set(range(highest)).difference(self.download_set)
-        print("Downloading %s - %u/%u bytes %.1f kbyte/s (%u retries %u missing)" % (self.download_filename,
-                                                                                     os.path.getsize(self.download_filename),
-                                                                                     size,
-                                                                                     speed,
-                                                                                     self.retries,
-                                                                                     len(diff)))
+            print("Downloading %s - %s" % (self.download_filename, self.download.summary()))
+        if len(self.queue) > 0:
+            print("%u logs queued" % len(self.queue))
+        if self.download is not None and self.download.paced():
+            print("Throttled to %.0f blocks/s, link %.1f kB/s other traffic, %.1f kB/s log" % (
+                self.download.max_rate,
+                (self.budget.other_rate or 0) / 1024.0,
+                self.budget.log_rate / 1024.0))
+
+    def log_queue(self):
+        '''show the download queue in download order'''
+        for q in self.queue.ordered(self.log_settings.order):
+            if q['time_utc'] == 0:
+                tstring = ''
+            else:
+                tstring = time.ctime(q['time_utc'])
+            print("Log %u size %u %s -> %s" % (q['id'], q['size'], tstring, q['filename']))
+        print("%u logs queued" % len(self.queue))
 
     def log_download_next(self):
-        latest = self.download_queue.pop()
-        filename = self.default_log_filename(latest)
-        self.log_download(latest, filename)
+        '''start the next queued download the vehicle has a LOG_ENTRY for'''
+        while True:
+            q = self.queue.next(self.entries, self.log_settings.order)
+            if q is None:
+                return
+            local = self.queue.present(q['id'], q['size'], q['time_utc'], q['filename'])
+            if local is not None:
+                print("Log %u already downloaded as %s" % (q['id'], local))
+                self.queue.remove(q['id'])
+                self.save_queue()
+            elif not self.queue.is_checking(q['id'], q['size'], q['time_utc']):
+                break
+        self.log_download(q['id'], q['filename'], background=True)
 
     def log_download_all(self):
+        '''queue every log not already downloaded'''
         if len(self.entries.keys()) == 0:
             print("Please use log list first")
             return
-        self.download_queue = sorted(self.entries, key=lambda id: self.entries[id].time_utc)
-        self.log_download_next()
+        queued = 0
+        present = 0
+        for id in sorted(self.entries):
+            e = self.entries[id]
+            if e.size == 0:
+                continue
+            filename = self.default_log_filename(id)
+            local = self.queue.present(id, e.size, e.time_utc, filename)
+            if local is not None:
+                print("Log %u already downloaded as %s" % (id, local))
+                present += 1
+                continue
+            if self.queue.is_checking(id, e.size, e.time_utc):
+                print("Log %u checking local copy" % id)
+            if self.queue.add(id, e.size, e.time_utc, filename):
+                queued += 1
+        self.save_queue()
+        print("Queued %u logs, %u already downloaded, %u in queue" % (queued, present, len(self.queue)))
+        if self.download is None:
+            self.log_download_next()
 
-    def log_download(self, log_num, filename):
-        '''download a log file'''
-        print("Downloading log %u as %s" % (log_num, filename))
+    def log_download(self, log_num, filename, background=False):
+        '''download a log file. Background downloads are throttled to the
+        link budget'''
+        if self.download is not None:
+            # put aside the current download, which resumes from its
+            # sidecar when next started
+            self.save_resume()
+            self.download_file.close()
+            self.download = None
+        entry = self.entries.get(log_num, None)
+        bits = None
+        if entry is not None and entry.size > 0 and os.path.exists(filename):
+            bits = mp_logdownload.load_resume(self.resume_filename(filename),
+                                              log_num, entry.size, entry.time_utc)
+        if entry is None or entry.size == 0:
+            # without a LOG_ENTRY we can't tell if a partial file is of this log
+            if os.path.exists(self.resume_filename(filename)):
+                print("Use log list first to resume %s" % filename)
+            entry = None
         self.download_lognum = log_num
-        self.download_file = open(filename, "wb")
-        self.master.mav.log_request_data_send(self.target_system,
-                                                   self.target_component,
-                                                   log_num, 0, 0xFFFFFFFF)
         self.download_filename = filename
-        self.download_set = set()
-        self.download_start = time.time()
-        self.download_last_timestamp = time.time()
-        self.download_ofs = 0
-        self.retries = 0
+        self.download_entry = entry
+        self.download_background = background
+        if bits is not None:
+            self.download_file = open(filename, "r+b")
+        else:
+            # readable too, for hashing data written out of order
+            self.download_file = open(filename, "w+b")
+        self.download = mp_logdownload.LogDownload(log_num, entry and entry.size, self.download_file,
+                                                   self.send_log_request)
+        if bits is not None:
+            self.download.resume(bits)
+            print("Resuming log %u as %s from %u bytes" % (log_num, filename, self.download.resumed_bytes))
+        else:
+            print("Downloading log %u as %s" % (log_num, filename))
+        self.download_saved = time.time()
+        self.throttle()
+        self.download.start()
+        if self.download.complete():
+            self.log_download_complete()
+
+    def throttle(self):
+        '''limit background downloads to the log traffic the link budget
+        allows'''
+        self.budget.fraction = self.log_settings.budget
+        self.budget.update()
+        if self.download is None:
+            return
+        if self.download_background and self.log_settings.throttle:
+            self.download.max_rate = self.budget.rate
+        else:
+            self.download.max_rate = None
 
     def default_log_filename(self, log_num):
         return "log%u.bin" % log_num
 
     def cmd_log(self, args):
         '''log commands'''
-        usage = "usage: log <list|download|erase|resume|status|cancel>"
+        usage = "usage: log <list|download|erase|resume|status|cancel|queue|set>"
         if len(args) < 1:
             print(usage)
             return
@@ -167,7 +266,8 @@ class LogModule(mp_module.MPModule):
             self.log_status()
         elif args[0] == "list":
             print("Requesting log list")
-            self.download_set = set()
+            self.entries = {}
+            self.entries_complete = False
             self.master.mav.log_request_list_send(self.target_system,
                                                        self.target_component,
                                                        0, 0xffff)
@@ -181,10 +281,24 @@ class LogModule(mp_module.MPModule):
                                                       self.target_component)
 
         elif args[0] == "cancel":
+            if self.download is not None:
+                self.download.flush()
+                self.save_resume()
             if self.download_file is not None:
                 self.download_file.close()
+            self.queue.clear()
+            self.save_queue()
             self.reset()
 
+        elif args[0] == "queue":
+            if len(args) > 1 and args[1] == "clear":
+                self.queue.clear()
+                self.save_queue()
+            self.log_queue()
+
+        elif args[0] == "set":
+            self.log_settings.command(args[1:])
+
         elif args[0] == "download":
             if len(args) < 2:
                 print("usage: log download <lognumber> <filename>")
@@ -210,9 +324,28 @@ class LogModule(mp_module.MPModule):
 
     def idle_task(self):
         '''handle missing log data'''
-        if self.download_last_timestamp is not None and time.time() - self.download_last_timestamp > 0.7:
-            self.download_last_timestamp = time.time()
-            self.handle_log_data_missing()
+        self.throttle()
+        if self.download is None and self.queue.checked:
+            # queued logs may have been waiting for a local copy to be checked
+            self.queue.checked = False
+            self.log_download_next()
+        if self.download is not None:
+            self.download.check()
+            msg = self.download.report()
+            if msg is not None and self.download_background:
+                self.console.set_status('LogDownload', 'Log %u %u%%' % (
+                    self.download_lognum,
+                    100 * self.download.received_bytes() // max(self.download.size or 0, 1)), row=3)
+            elif msg is not None:
+                print(msg)
+            if time.time() - self.download_saved > 10:
+                self.save_resume()
+
+    def unload(self):
+        '''save download progress on exit'''
+        if self.download is not None:
+            self.save_resume()
+            self.download_file.close()
 
 def init(mpstate):
     '''initialise module'''
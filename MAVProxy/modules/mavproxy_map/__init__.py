@@ -12,6 +12,7 @@ from MAVProxy.modules.mavproxy_map import mp_elevation
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_settings
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_spatial
 from MAVProxy.modules.lib.mp_menu import *
 from pymavlink import mavutil
 
@@ -34,6 +35,8 @@ class MapModule(mp_module.MPModule):
         self.icon_counter = 0
         self.click_position = None
         self.click_time = 0
+        self.spatial = mp_spatial.SpatialIndex()
+        self.spatial_changes = None
         self.draw_line = None
         self.draw_callback = None
         self.have_global_position = False
@@ -115,6 +118,10 @@ class MapModule(mp_module.MPModule):
         msg += "Decimal: %.6f %.6f\n" % (pos[0], pos[1])
         msg += "DMS:     %s %s\n" % (dms[0], dms[1])
         msg += "Grid:    %s\n" % mp_util.latlon_to_grid(pos)
+        (key, distance) = self.spatial_index().nearest(pos[0], pos[1])
+        if key is not None:
+            msg += "Nearest: %s %u (%.0fm)\n" % ({'wp' : 'WP', 'rally' : 'Rally', 'fence' : 'Fence'}[key[0]],
+                                                  key[1], distance)
         if self.logdir:
             logf = open(os.path.join(self.logdir, "positions.txt"), "a")
             logf.write("Position: %.6f %.6f at %s\n" % (pos[0], pos[1], time.ctime()))
@@ -227,21 +234,39 @@ class MapModule(mp_module.MPModule):
                                                                linewidth=2, colour=(0,255,0), popup_menu=popup))
 
 
+    def spatial_index(self):
+        '''return the index of waypoint, rally point and fence point
+        positions, rebuilt when any of them have changed. Keys are
+        (kind, number) as used by the wp, rally and fence commands'''
+        wploader = self.module('wp').wploader
+        rallyloader = self.module('rally').rallyloader
+        fenceloader = self.module('fence').fenceloader
+        changes = (wploader.last_change, rallyloader.last_change, fenceloader.last_change)
+        if changes == self.spatial_changes:
+            return self.spatial
+        self.spatial_changes = changes
+        self.spatial.clear()
+        for i in range(wploader.count()):
+            w = wploader.wp(i)
+            if wploader.is_location_command(w.command) and (w.x != 0 or w.y != 0):
+                self.spatial.add(('wp', i), w.x, w.y)
+        for i in range(rallyloader.rally_count()):
+            rp = rallyloader.rally_point(i)
+            self.spatial.add(('rally', i+1), rp.lat*1.0e-7, rp.lng*1.0e-7)
+        # the last fence point closes the polygon
+        for i in range(1, fenceloader.count()-1):
+            p = fenceloader.point(i)
+            self.spatial.add(('fence', i), p.lat, p.lng)
+        return self.spatial
+
     def closest_waypoint(self, latlon):
         '''find closest waypoint to a position'''
         (lat, lon) = latlon
-        best_distance = -1
-        closest = -1
-        for i in range(self.module('wp').wploader.count()):
-            w = self.module('wp').wploader.wp(i)
-            distance = mp_util.gps_distance(lat, lon, w.x, w.y)
-            if best_distance == -1 or distance < best_distance:
-                best_distance = distance
-                closest = i
-        if best_distance < 20:
-            return closest
-        else:
+        (key, distance) = self.spatial_index().nearest(lat, lon, max_distance=20,
+                                                       match=lambda key: key[0] == 'wp')
+        if key is None:
             return -1
+        return key[1]
 
     def remove_rally(self, key):
         '''remove a rally point'''
@@ -640,15 +665,12 @@ class MapModule(mp_module.MPModule):
 
                 #draw a line between rally point and nearest landing point
                 nearest_land_wp = None
-                nearest_distance = 10000000.0
-                for j in range(self.module('wp').wploader.count()):
-                    w = self.module('wp').wploader.wp(j)
-                    if (w.command == 21): #if landing waypoint
-                        #get distance between rally point and this waypoint
-                        dis = mp_util.gps_distance(w.x, w.y, rp.lat*1.0e-7, rp.lng*1.0e-7)
-                        if (dis < nearest_distance):
-                            nearest_land_wp = w
-                            nearest_distance = dis
+                wploader = self.module('wp').wploader
+                (key, nearest_distance) = self.spatial_index().nearest(
+                    rp.lat*1.0e-7, rp.lng*1.0e-7,
+                    match=lambda key: key[0] == 'wp' and wploader.wp(key[1]).command == mavutil.mavlink.MAV_CMD_NAV_LAND)
+                if key is not None:
+                    nearest_land_wp = wploader.wp(key[1])
 
                 if nearest_land_wp is not None:
                     points = []
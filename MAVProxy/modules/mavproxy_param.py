@@ -1,16 +1,279 @@
 #!/usr/bin/env python
 '''param command handling'''
 
-import time, os, fnmatch
+import time, os, fnmatch, json, random, re, math, bisect
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 from pymavlink import mavutil, mavparm
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_transfer
 
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib.mp_settings import MPSetting
+
+class ParamCache:
+    '''an on-disk cache of each vehicle's parameters, keyed by system id,
+    board UID and firmware version from AUTOPILOT_VERSION'''
+    def __init__(self, directory):
+        self.directory = directory
+
+    def key(self, sysid, m):
+        '''return a cache key for an AUTOPILOT_VERSION message'''
+        return mp_util.vehicle_key(sysid, m)
+
+    def path(self, key):
+        return os.path.join(self.directory, "%s.json" % key)
+
+    def load(self, key):
+        '''return a list of (name, value) in index order, or None'''
+        try:
+            f = open(self.path(key), mode='r')
+            params = json.load(f)
+            f.close()
+        except Exception:
+            return None
+        return [(str(name), value) for (name, value) in params]
+
+    def save(self, key, params):
+        '''save a list of (name, value) in index order'''
+        mp_util.mkdir_p(self.directory)
+        tmp = self.path(key) + '.tmp'
+        try:
+            f = open(tmp, mode='w')
+            json.dump(params, f)
+            f.close()
+            os.rename(tmp, self.path(key))
+        except Exception as e:
+            print("Failed to save parameter cache: %s" % e)
+
+
+class ParamHelpIndex:
+    '''parameter documentation compiled from a vehicle XML file into a
+    table of metadata by parameter name plus a keyword index. The
+    compiled form is pickled next to the XML and only rebuilt when the
+    XML changes'''
+    version = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = None
+        self.params = {}
+        self.words = {}
+        self.vocabulary = []
+
+    def index_path(self):
+        return self.path + '.pickle'
+
+    def update(self):
+        '''make sure the index matches the XML file'''
+        st = os.stat(self.path)
+        stamp = (st.st_mtime, st.st_size)
+        if stamp == self.stamp:
+            return
+        if not self.load(stamp):
+            self.build()
+            self.stamp = stamp
+            self.save()
+
+    def load(self, stamp):
+        '''load the pickled index if it was built from this version of the XML'''
+        try:
+            f = open(self.index_path(), mode='rb')
+            data = pickle.load(f)
+            f.close()
+        except Exception:
+            return False
+        if data.get('version', None) != self.version or data.get('stamp', None) != stamp:
+            return False
+        self.params = data['params']
+        self.words = data['words']
+        self.vocabulary = sorted(self.words.keys())
+        self.stamp = stamp
+        return True
+
+    def save(self):
+        try:
+            f = open(self.index_path(), mode='wb')
+            pickle.dump({ 'version' : self.version,
+                          'stamp' : self.stamp,
+                          'params' : self.params,
+                          'words' : self.words }, f, 2)
+            f.close()
+        except Exception as e:
+            print("Failed to save %s: %s" % (self.index_path(), e))
+
+    def build(self):
+        '''parse the XML into the metadata table and keyword index'''
+        try:
+            import xml.etree.cElementTree as ElementTree
+        except ImportError:
+            import xml.etree.ElementTree as ElementTree
+        root = ElementTree.parse(self.path).getroot()
+        self.params = {}
+        for p in root.findall('vehicles/parameters/param'):
+            self.add(p.get('name').split(':')[1], p)
+        for p in root.findall('libraries/parameters/param'):
+            self.add(p.get('name'), p)
+        words = {}
+        for name in self.params:
+            for word in set(self.tokens(self.text(name))):
+                if not word in words:
+                    words[word] = []
+                words[word].append(name)
+        self.words = words
+        self.vocabulary = sorted(words.keys())
+
+    def text(self, name):
+        '''lower case text of a parameter's name and documentation'''
+        help = self.params[name]
+        text = [name, help['humanName'] or '', help['documentation'] or '']
+        for (n, v) in help['fields'] + help['values']:
+            text.append(v)
+        return ' '.join(text).lower()
+
+    def tokens(self, text):
+        '''split lower case text into the words of the keyword index,
+        taking the parts of names like MOT_THR_MAX as separate words'''
+        return re.findall('[a-z0-9]+', text)
+
+    def prefixed(self, prefix):
+        '''return the set of parameters with a word starting with prefix'''
+        ret = set()
+        i = bisect.bisect_left(self.vocabulary, prefix)
+        while i < len(self.vocabulary) and self.vocabulary[i].startswith(prefix):
+            ret.update(self.words[self.vocabulary[i]])
+            i += 1
+        return ret
+
+    def add(self, name, p):
+        '''add one param element to the metadata table'''
+        fields = []
+        values = []
+        for child in p:
+            if child.tag == 'field':
+                fields.append((child.get('name'), (child.text or '').strip()))
+            elif child.tag == 'values':
+                for v in child:
+                    values.append((v.get('code'), (v.text or '').strip()))
+        self.params[name] = { 'humanName' : p.get('humanName'),
+                              'documentation' : p.get('documentation'),
+                              'fields' : fields,
+                              'values' : values }
+
+    def get(self, name):
+        '''return the metadata for a parameter, or None'''
+        return self.params.get(name, None)
+
+    def search(self, keyword):
+        '''return the set of parameters whose documentation contains
+        keyword. Each word of keyword narrows the parameters down to
+        those with a word starting with it, then the whole keyword is
+        looked for in their text, so phrases and units like "m/s" match.
+        If that finds nothing, all the text is searched, so a keyword
+        starting part way into a word like "eed" still matches'''
+        keyword = keyword.lower()
+        ret = None
+        for word in set(self.tokens(keyword)):
+            found = self.prefixed(word)
+            if ret is None:
+                ret = found
+            else:
+                ret &= found
+            if len(ret) == 0:
+                break
+        if ret is not None:
+            ret = set([name for name in ret if keyword in self.text(name)])
+            if len(ret) > 0:
+                return ret
+        return set([name for name in self.params if keyword in self.text(name)])
+
+    def summary(self, name):
+        '''return a short string giving the range and units of a parameter'''
+        help = self.get(name)
+        if help is None:
+            return None
+        ret = []
+        for (n, v) in help['fields']:
+            if n in ['Range', 'Units', 'Increment']:
+                ret.append("%s: %s" % (n, v))
+        if len(help['values']) and len(help['values']) <= 8:
+            ret.append("Values: " + ", ".join(["%s=%s" % (c, v) for (c, v) in help['values']]))
+        return "  ".join(ret)
+
+
+class ParamSetBatch:
+    '''a batch of parameter writes, sent with a window of outstanding
+    PARAM_SETs. Each write is verified by the PARAM_VALUE the vehicle
+    echoes back, and only unacknowledged writes are resent'''
+    def __init__(self, params, old_values, send, retries=3):
+        self.send = send
+        self.queue = [name for (name, value) in params]
+        self.queue.reverse()
+        self.values = dict(params)
+        self.old_values = old_values
+        self.retries = retries
+        self.attempts = {}
+        self.window = mp_transfer.AdaptiveWindow(maximum=10)
+        self.progress = mp_transfer.TransferProgress(len(params))
+        self.changed = 0
+        self.failed = []
+
+    def complete(self):
+        return len(self.queue) == 0 and len(self.window.outstanding) == 0
+
+    def handle_param_value(self, param_id, value):
+        '''check a PARAM_VALUE against an outstanding write'''
+        if not param_id in self.window.outstanding:
+            return
+        self.window.received(param_id)
+        wanted = self.values[param_id]
+        if math.fabs(value - wanted) > 1.0e-6 * max(1.0, math.fabs(wanted)):
+            # this may be a value from a fetch or a periodic resend rather
+            # than the echo of our write, so resend until out of retries
+            if self.attempts[param_id] < self.retries:
+                self.queue.append(param_id)
+                return
+            # the vehicle didn't take the value, perhaps out of range
+            print("Failed to set %s to %f, vehicle has %f" % (param_id, wanted, value))
+            self.failed.append(param_id)
+        else:
+            old_value = self.old_values.get(param_id, None)
+            if old_value is not None:
+                print("changed %s from %f to %f" % (param_id, old_value, value))
+            else:
+                print("set %s to %f" % (param_id, value))
+            self.changed += 1
+        self.progress.update(self.changed + len(self.failed))
+
+    def check(self, master):
+        '''resend lost writes and keep the window full'''
+        now = time.time()
+        for name in self.window.expire(now):
+            if self.attempts[name] >= self.retries:
+                print("timeout setting %s to %f" % (name, self.values[name]))
+                self.failed.append(name)
+                self.progress.update(self.changed + len(self.failed))
+            else:
+                self.queue.append(name)
+        while len(self.queue) > 0 and self.window.can_send():
+            name = self.queue.pop()
+            self.send(master, name, self.values[name])
+            self.attempts[name] = self.attempts.get(name, 0) + 1
+            self.window.sent(name, now)
+        if self.progress.report_due(now) and not self.complete():
+            print("Set %u/%u parameters (%.0f/s)" % (self.progress.done, self.progress.total,
+                                                     self.progress.rate(now)))
+
 
 class ParamState:
     '''this class is separated to make it possible to use the parameter
        functions on a secondary connection'''
-    def __init__(self, mav_param, logdir, vehicle_name, parm_file):
+    def __init__(self, mav_param, logdir, vehicle_name, parm_file, target=None):
+        # (sysid, compid) of the vehicle, or None for the target of the link
+        self.target = target
+        self.last_param_value = 0
         self.mav_param_set = set()
         self.mav_param_count = 0
         self.param_period = mavutil.periodic_event(1)
@@ -19,55 +282,308 @@ class ParamState:
         self.logdir = logdir
         self.vehicle_name = vehicle_name
         self.parm_file = parm_file
-        self.fetch_set = None
         self.xml_filepath = None
+        self.help_index = None
+        # ParamSetBatch in progress
+        self.param_writer = None
+        # received indices, outstanding PARAM_REQUEST_READs and rate for
+        # the current fetch. The vehicle queues only a few requests, so
+        # keep the window small
+        self.fetch_bitmap = mp_transfer.IndexBitmap()
+        self.fetch_window = mp_transfer.AdaptiveWindow(maximum=20)
+        self.fetch_progress = mp_transfer.TransferProgress()
+        # parameter name for each index, as needed for the cache
+        self.param_names = {}
+        # optional ParamCache, and the state of checking it against the vehicle
+        self.cache = None
+        self.cache_key = None
+        self.cache_state = None
+        self.cache_params = None
+        self.cache_samples = set()
+        self.cache_deadline = 0
+        self.cache_dirty = False
+        self.cache_period = mavutil.periodic_event(0.1)
+
+    def target_ids(self, master):
+        '''return the (sysid, compid) this parameter set belongs to'''
+        if self.target is None:
+            return (master.target_system, master.target_component)
+        return self.target
+
+    def send_fetch_all(self, master):
+        '''send a PARAM_REQUEST_LIST'''
+        if self.target is None:
+            master.param_fetch_all()
+        else:
+            master.mav.param_request_list_send(self.target[0], self.target[1])
+
+    def send_fetch_one(self, master, name_or_index):
+        '''send a PARAM_REQUEST_READ for a name or index'''
+        if self.target is None:
+            master.param_fetch_one(name_or_index)
+        elif isinstance(name_or_index, str):
+            master.mav.param_request_read_send(self.target[0], self.target[1], name_or_index, -1)
+        else:
+            master.mav.param_request_read_send(self.target[0], self.target[1], '', name_or_index)
+
+    def send_set(self, master, name, value):
+        '''send a PARAM_SET'''
+        if self.target is None:
+            master.param_set_send(name, value)
+        else:
+            master.mav.param_set_send(self.target[0], self.target[1], name, value,
+                                      mavutil.mavlink.MAV_PARAM_TYPE_REAL32)
+
+    def fetch_all(self, master):
+        '''request all parameters, starting a new fetch'''
+        self.send_fetch_all(master)
+        self.mav_param_set = set()
+        self.fetch_bitmap = mp_transfer.IndexBitmap()
+        self.fetch_window.reset()
+        self.fetch_progress.reset()
+
+    def cache_check(self, master):
+        '''see if the cached parameters for this vehicle are still
+        valid. Returns True while the check is in progress'''
+        if self.cache is None or self.cache_state == 'done':
+            return False
+        now = time.time()
+        if self.cache_state is None:
+            if len(self.mav_param_set) != 0:
+                self.cache_state = 'done'
+                return False
+            # we need the board UID and firmware version
+            (sysid, compid) = self.target_ids(master)
+            master.mav.command_long_send(sysid, compid,
+                                         mavutil.mavlink.MAV_CMD_REQUEST_AUTOPILOT_CAPABILITIES,
+                                         0, 1, 0, 0, 0, 0, 0, 0)
+            self.cache_state = 'identify'
+            self.cache_deadline = now + 2
+            return True
+        if self.cache_state == 'identify':
+            if self.cache_key is not None:
+                self.cache_params = self.cache.load(self.cache_key)
+                if self.cache_params is None or len(self.cache_params) == 0:
+                    self.cache_state = 'done'
+                    return False
+                # sample a few parameters to see if the vehicle has changed
+                count = len(self.cache_params)
+                self.cache_samples = set([0, count-1])
+                self.cache_samples.update(random.sample(range(count), min(count, 5)))
+                for idx in self.cache_samples:
+                    self.send_fetch_one(master, idx)
+                self.cache_state = 'verify'
+                self.cache_deadline = now + 3
+                return True
+            if now > self.cache_deadline:
+                self.cache_state = 'done'
+                return False
+            return True
+        if self.cache_state == 'verify':
+            if len(self.cache_samples) == 0:
+                self.cache_state = 'done'
+                self.cache_apply()
+                return False
+            if now > self.cache_deadline:
+                print("No reply checking parameter cache")
+                self.cache_state = 'done'
+                self.fetch_all(master)
+            return True
+        return False
+
+    def cache_verify(self, master, m, param_id):
+        '''check a PARAM_VALUE against the cache while verifying it'''
+        if not m.param_index in self.cache_samples:
+            return
+        self.cache_samples.discard(m.param_index)
+        (name, value) = self.cache_params[m.param_index]
+        if m.param_count != len(self.cache_params) or name != param_id or value != m.param_value:
+            print("Parameters have changed since they were cached")
+            self.cache_state = 'done'
+            self.cache_params = None
+            self.fetch_all(master)
+
+    def cache_apply(self):
+        '''use the verified cached parameters'''
+        self.mav_param_count = len(self.cache_params)
+        self.fetch_bitmap = mp_transfer.IndexBitmap(self.mav_param_count)
+        for idx in range(self.mav_param_count):
+            (name, value) = self.cache_params[idx]
+            self.mav_param[name] = value
+            self.param_names[idx] = name
+            self.mav_param_set.add(idx)
+            self.fetch_bitmap.add(idx)
+        self.cache_params = None
+        print("Loaded %u parameters from cache" % self.mav_param_count)
+        if self.logdir is not None:
+            self.mav_param.save(os.path.join(self.logdir, self.parm_file), '*', verbose=True)
+
+    def cache_save(self):
+        '''save the full set of parameters to the cache'''
+        self.cache_dirty = False
+        if self.cache is None or self.cache_key is None:
+            return
+        params = []
+        for idx in range(self.mav_param_count):
+            name = self.param_names.get(idx, None)
+            if name is None or not name in self.mav_param:
+                return
+            params.append((name, self.mav_param[name]))
+        self.cache.save(self.cache_key, params)
 
     def handle_mavlink_packet(self, master, m):
         '''handle an incoming mavlink packet'''
+        if (m.get_type() == 'AUTOPILOT_VERSION' and self.cache is not None and
+            m.get_srcSystem() == self.target_ids(master)[0]):
+            self.cache_key = self.cache.key(m.get_srcSystem(), m)
         if m.get_type() == 'PARAM_VALUE':
             param_id = "%.16s" % m.param_id
+            self.last_param_value = time.time()
             # Note: the xml specifies param_index is a uint16, so -1 in that field will show as 65535
             # We accept both -1 and 65535 as 'unknown index' to future proof us against someday having that
             # xml fixed.
-            if self.fetch_set is not None:
-                self.fetch_set.discard(m.param_index)
+            if m.param_count != -1:
+                self.mav_param_count = m.param_count
+                self.fetch_bitmap.resize(m.param_count)
+            if self.param_writer is not None:
+                self.param_writer.handle_param_value(str(param_id), m.param_value)
+            if m.param_index != -1 and m.param_index != 65535:
+                self.fetch_window.received(m.param_index)
+                self.fetch_bitmap.add(m.param_index)
+                self.param_names[m.param_index] = str(param_id)
+                if self.cache_state == 'verify':
+                    self.cache_verify(master, m, str(param_id))
+                    return
             if m.param_index != -1 and m.param_index != 65535 and m.param_index not in self.mav_param_set:
                 added_new_parameter = True
                 self.mav_param_set.add(m.param_index)
             else:
                 added_new_parameter = False
-            if m.param_count != -1:
-                self.mav_param_count = m.param_count
             self.mav_param[str(param_id)] = m.param_value
             if param_id in self.fetch_one and self.fetch_one[param_id] > 0:
                 self.fetch_one[param_id] -= 1
                 print("%s = %.7f" % (param_id, m.param_value))
+            if added_new_parameter:
+                self.fetch_progress.update(len(self.mav_param_set))
+                self.fetch_progress.total = self.mav_param_count
             if added_new_parameter and len(self.mav_param_set) == m.param_count:
-                print("Received %u parameters" % m.param_count)
+                print("Received %u parameters (%.1fs, %.0f/s)" % (m.param_count,
+                                                                  self.fetch_progress.elapsed(),
+                                                                  self.fetch_progress.rate()))
                 if self.logdir is not None:
                     self.mav_param.save(os.path.join(self.logdir, self.parm_file), '*', verbose=True)
-                    self.fetch_set = None
-            if self.fetch_set is not None and len(self.fetch_set) == 0:
-                self.fetch_check(master, force=True)
+                self.cache_save()
+            elif not added_new_parameter and len(self.mav_param_set) == self.mav_param_count:
+                # a parameter changed after the fetch completed
+                self.cache_dirty = True
+            elif added_new_parameter and self.fetch_progress.report_due():
+                print("Received %u/%u parameters (%.0f/s)" % (len(self.mav_param_set),
+                                                              self.mav_param_count,
+                                                              self.fetch_progress.rate()))
 
     def fetch_check(self, master, force=False):
-        '''check for missing parameters periodically'''
-        if self.param_period.trigger() or force:
-            if master is None:
-                return
-            if len(self.mav_param_set) == 0:
-                master.param_fetch_all()
-            elif self.mav_param_count != 0 and len(self.mav_param_set) != self.mav_param_count:
-                if master.time_since('PARAM_VALUE') >= 1 or force:
-                    diff = set(range(self.mav_param_count)).difference(self.mav_param_set)
-                    count = 0
-                    while len(diff) > 0 and count < 10:
-                        idx = diff.pop()
-                        master.param_fetch_one(idx)
-                        if self.fetch_set is None:
-                            self.fetch_set = set()
-                        self.fetch_set.add(idx)
-                        count += 1
+        '''check for missing parameters, keeping a window of re-requests
+        for them in flight once the vehicle has finished streaming'''
+        if master is None:
+            return
+        if self.param_writer is not None:
+            self.param_writer_check(master)
+        if self.cache_check(master):
+            return
+        if self.cache_dirty and self.cache_period.trigger():
+            self.cache_save()
+        if len(self.mav_param_set) == 0:
+            if self.param_period.trigger() or force:
+                self.fetch_all(master)
+            return
+        if self.mav_param_count == 0 or len(self.mav_param_set) == self.mav_param_count:
+            return
+        now = time.time()
+        self.fetch_window.expire(now)
+        if (self.fetch_window.sent_count == 0 and not force and
+            now - self.last_param_value < self.fetch_window.timeout()):
+            # the vehicle is still streaming the full list
+            return
+        if not self.fetch_window.can_send():
+            return
+        for idx in self.fetch_bitmap.missing():
+            if not self.fetch_window.can_send():
+                break
+            if idx in self.fetch_window.outstanding:
+                continue
+            self.send_fetch_one(master, idx)
+            self.fetch_window.sent(idx, now)
+
+    def param_writer_check(self, master):
+        '''progress any bulk parameter write'''
+        w = self.param_writer
+        w.check(master)
+        if w.complete():
+            print("Set %u parameters, %u failed (%.1fs, %.0f/s)" % (w.changed, len(w.failed),
+                                                                     w.progress.elapsed(),
+                                                                     w.progress.rate()))
+            self.param_writer = None
+
+    def param_set_bulk(self, params):
+        '''start writing a list of (name, value) to the vehicle'''
+        if len(params) == 0:
+            return
+        old_values = {}
+        if self.param_writer is not None:
+            # fold any writes still in progress into the new batch
+            old = self.param_writer
+            names = set([name for (name, value) in params])
+            for name in old.queue + list(old.window.outstanding.keys()):
+                if not name in names:
+                    names.add(name)
+                    params.append((name, old.values[name]))
+            old_values.update(old.old_values)
+        for (name, value) in params:
+            if name in self.mav_param:
+                old_values[name] = self.mav_param[name]
+        self.param_writer = ParamSetBatch(params, old_values, self.send_set)
+
+    def param_load(self, filename, wildcard, check=True):
+        '''load parameters from a file, writing the changed ones to the vehicle'''
+        try:
+            f = open(filename, mode='r')
+        except Exception as e:
+            print("Failed to open file '%s': %s" % (filename, str(e)))
+            return
+        params = []
+        unchanged = 0
+        for line in f:
+            # strip comments, which may be at the end of a line
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            a = line.replace(',',' ').split()
+            if len(a) != 2:
+                print("Invalid line: %s" % line)
+                continue
+            name = a[0].upper()
+            # some parameters should not be loaded from files
+            if name in self.mav_param.exclude_load:
+                continue
+            if not fnmatch.fnmatch(name, wildcard.upper()):
+                continue
+            if a[1].lower().startswith('0x'):
+                value = float(int(a[1][2:], 16))
+            else:
+                value = float(a[1])
+            if check:
+                if not name in self.mav_param:
+                    print("Unknown parameter %s" % name)
+                    continue
+                if math.fabs(self.mav_param[name] - value) <= self.mav_param.mindelta:
+                    unchanged += 1
+                    continue
+            params.append((name, value))
+        f.close()
+        print("Loaded %u parameters from %s, %u to set, %u unchanged" % (len(params) + unchanged,
+                                                                       filename, len(params),
+                                                                       unchanged))
+        self.param_set_bulk(params)
 
     def param_help_download(self):
         '''download XML files for parameters'''
@@ -91,35 +607,34 @@ class ParamState:
     def param_use_xml_filepath(self, filepath):
         self.xml_filepath = filepath
 
-    def param_help_tree(self):
-        '''return a "help tree", a map between a parameter and its metadata.  May return None if help is not available'''
+    def param_help_index(self, quiet=False):
+        '''return the ParamHelpIndex for this vehicle, or None if help is not available'''
         if self.xml_filepath is not None:
-            print("param: using xml_filepath=%s" % self.xml_filepath)
+            if not quiet:
+                print("param: using xml_filepath=%s" % self.xml_filepath)
             path = self.xml_filepath
         else:
             if self.vehicle_name is None:
-                print("Unknown vehicle type")
+                if not quiet:
+                    print("Unknown vehicle type")
                 return None
             path = mp_util.dot_mavproxy("%s.xml" % self.vehicle_name)
             if not os.path.exists(path):
-                print("Please run 'param download' first (vehicle_name=%s)" % self.vehicle_name)
+                if not quiet:
+                    print("Please run 'param download' first (vehicle_name=%s)" % self.vehicle_name)
                 return None
         if not os.path.exists(path):
-            print("Param XML (%s) does not exist" % path)
+            if not quiet:
+                print("Param XML (%s) does not exist" % path)
             return None
-        xml = open(path).read()
-        from lxml import objectify
-        objectify.enable_recursive_str()
-        tree = objectify.fromstring(xml)
-        htree = {}
-        for p in tree.vehicles.parameters.param:
-            n = p.get('name').split(':')[1]
-            htree[n] = p
-        for lib in tree.libraries.parameters:
-            for p in lib.param:
-                n = p.get('name')
-                htree[n] = p
-        return htree
+        if self.help_index is None or self.help_index.path != path:
+            self.help_index = ParamHelpIndex(path)
+        try:
+            self.help_index.update()
+        except Exception as e:
+            print("Failed to read %s: %s" % (path, e))
+            return None
+        return self.help_index
 
     def param_set_xml_filepath(self, args):
         self.xml_filepath = args[0]
@@ -130,16 +645,14 @@ class ParamState:
             print("Usage: param apropos keyword")
             return
 
-        htree = self.param_help_tree()
-        if htree is None:
+        index = self.param_help_index()
+        if index is None:
             return
 
-        contains = {}
+        contains = set()
         for keyword in args:
-            for param in htree.keys():
-                if str(htree[param]).find(keyword) != -1:
-                    contains[param] = True
-        for param in contains.keys():
+            contains.update(index.search(keyword))
+        for param in sorted(contains):
             print("%s" % (param,))
 
     def param_help(self, args):
@@ -148,38 +661,25 @@ class ParamState:
             print("Usage: param help PARAMETER_NAME")
             return
 
-        htree = self.param_help_tree()
-        if htree is None:
+        index = self.param_help_index()
+        if index is None:
             return
 
         for h in args:
             h = h.upper()
-            if h in htree:
-                help = htree[h]
-                print("%s: %s\n" % (h, help.get('humanName')))
-                print(help.get('documentation'))
-                try:
-                    print("\n")
-                    for f in help.field:
-                        print("%s : %s" % (f.get('name'), str(f)))
-                except Exception as e:
-                    pass
-                try:
-                    # The entry "values" has been blatted by a cython
-                    # function at this point, so we instead get the
-                    # "values" by offset rather than name.
-                    children = help.getchildren()
-                    vchild = children[0]
-                    values = vchild.getchildren()
-                    if len(values):
-                        print("\nValues: ")
-                        for v in values:
-                            print("\t%s : %s" % (v.get('code'), str(v)))
-                except Exception as e:
-                    print("Caught exception %s" % repr(e))
-                    pass
-            else:
+            help = index.get(h)
+            if help is None:
                 print("Parameter '%s' not found in documentation" % h)
+                continue
+            print("%s: %s\n" % (h, help['humanName']))
+            print(help['documentation'])
+            print("\n")
+            for (name, value) in help['fields']:
+                print("%s : %s" % (name, value))
+            if len(help['values']):
+                print("\nValues: ")
+                for (code, value) in help['values']:
+                    print("\t%s : %s" % (code, value))
 
     def handle_command(self, master, mpstate, args):
         '''handle parameter commands'''
@@ -190,22 +690,21 @@ class ParamState:
             return
         if args[0] == "fetch":
             if len(args) == 1:
-                master.param_fetch_all()
-                self.mav_param_set = set()
+                self.fetch_all(master)
                 print("Requested parameter list")
             else:
                 found = False
                 pname = args[1].upper()
                 for p in self.mav_param.keys():
                     if fnmatch.fnmatch(p, pname):
-                        master.param_fetch_one(p)
+                        self.send_fetch_one(master, p)
                         if p not in self.fetch_one:
                             self.fetch_one[p] = 0
                         self.fetch_one[p] += 1
                         found = True
                         print("Requested parameter %s" % p)
                 if not found and args[1].find('*') == -1:
-                    master.param_fetch_one(pname)
+                    self.send_fetch_one(master, pname)
                     if pname not in self.fetch_one:
                         self.fetch_one[pname] = 0
                     self.fetch_one[pname] += 1
@@ -244,6 +743,11 @@ class ParamState:
                 return
             if len(args) == 2:
                 self.mav_param.show(args[1])
+                index = self.param_help_index(quiet=True)
+                if index is not None:
+                    summary = index.summary(args[1].upper())
+                    if summary:
+                        print(summary)
                 return
             param = args[1]
             value = args[2]
@@ -252,7 +756,7 @@ class ParamState:
             if not param.upper() in self.mav_param:
                 print("Unable to find parameter '%s'" % param)
                 return
-            self.mav_param.mavset(master, param.upper(), value, retries=3)
+            self.param_set_bulk([(param.upper(), float(value))])
 
             if (param.upper() == "WP_LOITER_RAD" or param.upper() == "LAND_BREAK_PATH"):
                 #need to redraw rally points
@@ -268,7 +772,7 @@ class ParamState:
                 param_wildcard = args[2]
             else:
                 param_wildcard = "*"
-            self.mav_param.load(args[1], param_wildcard, master)
+            self.param_load(args[1], param_wildcard)
         elif args[0] == "preload":
             if len(args) < 2:
                 print("Usage: param preload <filename>")
@@ -282,7 +786,7 @@ class ParamState:
                 param_wildcard = args[2]
             else:
                 param_wildcard = "*"
-            self.mav_param.load(args[1], param_wildcard, master, check=False)
+            self.param_load(args[1], param_wildcard, check=False)
         elif args[0] == "download":
             self.param_help_download()
         elif args[0] == "apropos":
@@ -299,6 +803,10 @@ class ParamState:
             self.mav_param.show(pattern)
         elif args[0] == "status":
             print("Have %u/%u params" % (len(self.mav_param_set), self.mav_param_count))
+            print("Fetch %.0f/s %s" % (self.fetch_progress.rate(), self.fetch_window))
+            if self.param_writer is not None:
+                w = self.param_writer
+                print("Setting %u/%u params %s" % (w.progress.done, w.progress.total, w.window))
         else:
             print(usage)
 
@@ -307,11 +815,17 @@ class ParamModule(mp_module.MPModule):
     def __init__(self, mpstate, **kwargs):
         super(ParamModule, self).__init__(mpstate, "param", "parameter handling", public = True)
         self.pstate = ParamState(self.mav_param, self.logdir, self.vehicle_name, 'mav.parm')
+        # parameters of other vehicles on the link, by (sysid, compid)
+        self.vehicle_pstates = {}
+        self.param_cache = ParamCache(mp_util.dot_mavproxy('paramcache'))
+        if not hasattr(self.settings, 'paramcache'):
+            self.settings.append(MPSetting('paramcache', bool, True, 'Cache parameters between connections'))
         self.add_command('param', self.cmd_param, "parameter handling",
-                         ["<download|status>",
+                         ["<download|status|vehicles>",
                           "<set|show|fetch|help|apropos> (PARAMETER)",
                           "<load|save|diff> (FILENAME)",
-                          "<set_xml_filepath> (FILEPATH)"
+                          "<set_xml_filepath> (FILEPATH)",
+                          "vehicle (SYSID)"
                          ])
         if self.continue_mode and self.logdir is not None:
             parmfile = os.path.join(self.logdir, 'mav.parm')
@@ -321,17 +835,123 @@ class ParamModule(mp_module.MPModule):
 
         self.pstate.xml_filepath = kwargs.get("xml-filepath", None)
 
+    def vehicle_pstate(self, sysid, compid):
+        '''return the ParamState for a vehicle, creating it if needed'''
+        key = (sysid, compid)
+        if not key in self.vehicle_pstates:
+            pstate = ParamState(mavparm.MAVParmDict(), self.logdir, None,
+                                'mav-%u-%u.parm' % (sysid, compid), target=key)
+            pstate.xml_filepath = self.pstate.xml_filepath
+            self.vehicle_pstates[key] = pstate
+            print("param: tracking parameters of vehicle %u:%u" % key)
+        return self.vehicle_pstates[key]
+
+    def all_pstates(self):
+        '''return a list of ((sysid, compid), ParamState) for every vehicle'''
+        ret = [((self.target_system, self.target_component), self.pstate)]
+        for key in sorted(self.vehicle_pstates.keys()):
+            ret.append((key, self.vehicle_pstates[key]))
+        return ret
+
+    def find_pstate(self, name):
+        '''find a ParamState from a SYSID or SYSID:COMPID string'''
+        try:
+            a = [int(x) for x in name.split(':')]
+        except ValueError:
+            return None
+        if a[0] == self.target_system and (len(a) == 1 or a[1] == self.target_component):
+            return self.pstate
+        for (key, pstate) in self.vehicle_pstates.items():
+            if key[0] == a[0] and (len(a) == 1 or key[1] == a[1]):
+                return pstate
+        return None
+
     def mavlink_packet(self, m):
         '''handle an incoming mavlink packet'''
-        self.pstate.handle_mavlink_packet(self.master, m)
+        sysid = m.get_srcSystem()
+        if self.target_system == 0 or sysid == self.target_system:
+            self.pstate.handle_mavlink_packet(self.master, m)
+            return
+        mtype = m.get_type()
+        if (mtype == 'HEARTBEAT' and m.type != mavutil.mavlink.MAV_TYPE_GCS and
+            m.autopilot != mavutil.mavlink.MAV_AUTOPILOT_INVALID):
+            self.vehicle_pstate(sysid, m.get_srcComponent())
+        if mtype in ['PARAM_VALUE', 'AUTOPILOT_VERSION']:
+            pstate = self.vehicle_pstates.get((sysid, m.get_srcComponent()), None)
+            if pstate is not None:
+                pstate.handle_mavlink_packet(self.master, m)
 
     def idle_task(self):
         '''handle missing parameters'''
         self.pstate.vehicle_name = self.vehicle_name
-        self.pstate.fetch_check(self.master)
+        if self.settings.paramcache:
+            cache = self.param_cache
+        else:
+            cache = None
+        pstates = self.all_pstates()
+        # concurrent fetches share the link
+        window = max(2, 20 // len(pstates))
+        for (key, pstate) in pstates:
+            pstate.cache = cache
+            pstate.fetch_window.maximum = window
+            pstate.fetch_check(self.master)
+
+    def param_vehicles(self):
+        '''list the vehicles we have parameters for'''
+        for (key, pstate) in self.all_pstates():
+            print("%u:%u %u/%u params" % (key[0], key[1], len(pstate.mav_param_set), pstate.mav_param_count))
+
+    def param_diff_vehicles(self, args):
+        '''compare the parameters of two vehicles without fetching them'''
+        pstate1 = self.find_pstate(args[0])
+        label1 = args[0]
+        if len(args) > 1 and self.find_pstate(args[1]) is not None:
+            pstate2 = self.find_pstate(args[1])
+            label2 = args[1]
+            args = args[2:]
+        else:
+            pstate2 = self.pstate
+            label2 = str(self.target_system)
+            args = args[1:]
+        if pstate1 is None or pstate2 is None:
+            print("Unknown vehicle")
+            return
+        wildcard = '*'
+        if len(args) > 0:
+            wildcard = args[0]
+        p1 = pstate1.mav_param
+        p2 = pstate2.mav_param
+        print("%-16.16s %12.12s %12.12s" % ('Parameter', label1, label2))
+        for name in sorted(set(p1.keys()).union(set(p2.keys()))):
+            if not fnmatch.fnmatch(name.upper(), wildcard.upper()):
+                continue
+            v1 = p1.get(name, None)
+            v2 = p2.get(name, None)
+            if v1 is None or v2 is None:
+                print("%-16.16s %12s %12s" % (name, v1 is None and 'missing' or "%f" % v1,
+                                              v2 is None and 'missing' or "%f" % v2))
+            elif math.fabs(v1 - v2) > p1.mindelta:
+                print("%-16.16s %12f %12f" % (name, v1, v2))
 
     def cmd_param(self, args):
         '''control parameters'''
+        if len(args) > 0 and args[0] == 'vehicles':
+            self.param_vehicles()
+            return
+        if len(args) > 0 and args[0] == 'vehicle':
+            if len(args) < 3:
+                print("Usage: param vehicle SYSID[:COMPID] <command...>")
+                return
+            pstate = self.find_pstate(args[1])
+            if pstate is None:
+                print("Unknown vehicle %s" % args[1])
+                return
+            pstate.handle_command(self.master, self.mpstate, args[2:])
+            return
+        if (len(args) > 1 and args[0] == 'diff' and not os.path.exists(args[1]) and
+            self.find_pstate(args[1]) is not None):
+            self.param_diff_vehicles(args[1:])
+            return
         self.pstate.handle_command(self.master, self.mpstate, args)
 
 def init(mpstate, **kwargs):
@@ -50,7 +50,7 @@ class PPPModule(mp_module.MPModule):
         self.packet_count = 0
 
         # ask mavproxy to add us to the select loop
-        self.mpself.select_extra[self.ppp_fd] = (self.ppp_read, self.ppp_fd)
+        self.add_select_fd(self.ppp_fd, self.ppp_read, self.ppp_fd)
 
 
     def stop_ppp_link(self):
@@ -58,7 +58,7 @@ class PPPModule(mp_module.MPModule):
         if self.ppp_fd == -1:
             return
         try:
-            self.mpself.select_extra.pop(self.ppp_fd)
+            self.remove_select_fd(self.ppp_fd)
             os.close(self.ppp_fd)
             os.waitpid(self.pid, 0)
         except Exception:
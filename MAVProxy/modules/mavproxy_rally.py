@@ -7,6 +7,8 @@ from pymavlink import mavutil
 import time, os, platform
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_mission
+from MAVProxy.modules.lib import mp_spatial
 
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import *
@@ -18,6 +20,10 @@ class RallyModule(mp_module.MPModule):
         self.add_command('rally', self.cmd_rally, "rally point control", ["<add|clear|land|list|move|remove|>",
                                     "<load|save> (FILENAME)"])
         self.have_list = False
+        self.rally_download = None
+        self.rally_index = mp_spatial.SpatialIndex()
+        self.rally_index_change = None
+        self.nearest_rally = None
         self.abort_alt = 50
         self.abort_first_send_time = 0
         self.abort_previous_send_time = 0
@@ -44,6 +50,12 @@ class RallyModule(mp_module.MPModule):
 
     def idle_task(self):
         '''called on idle'''
+        if self.rally_download is not None:
+            if self.rally_download.failed():
+                self.console.error("Rally download failed: %s" % self.rally_download.summary())
+                self.rally_download = None
+            else:
+                self.rally_download.check()
         if self.module('console') is not None and not self.menu_added_console:
             self.menu_added_console = True
             self.module('console').add_menu(self.menu)
@@ -202,7 +214,6 @@ class RallyModule(mp_module.MPModule):
 
         elif args[0] == "list":
             self.list_rally_points()
-            self.have_list = True
 
         elif args[0] == "load":
             if (len(args) < 2):
@@ -250,10 +261,33 @@ class RallyModule(mp_module.MPModule):
         else:
             self.print_usage()
 
+    def closest_rally_point(self, lat, lon):
+        '''return (number, distance) of the closest rally point, or (None, None)'''
+        if self.rally_index_change != self.rallyloader.last_change:
+            self.rally_index_change = self.rallyloader.last_change
+            self.rally_index.clear()
+            for i in range(self.rallyloader.rally_count()):
+                p = self.rallyloader.rally_point(i)
+                self.rally_index.add(i+1, p.lat*1.0e-7, p.lng*1.0e-7)
+        return self.rally_index.nearest(lat, lon)
+
     def mavlink_packet(self, m):
         '''handle incoming mavlink packet'''
         type = m.get_type()
-        if type in ['COMMAND_ACK']:
+        if type == 'GLOBAL_POSITION_INT' and (m.lat != 0 or m.lon != 0):
+            (i, distance) = self.closest_rally_point(m.lat*1.0e-7, m.lon*1.0e-7)
+            if i is not None:
+                self.console.set_status('Rally', 'Rally %u %.0fm' % (i, distance), row=3)
+            elif self.nearest_rally is not None:
+                self.console.set_status('Rally', 'Rally --', row=3)
+            self.nearest_rally = i
+        elif type == 'RALLY_POINT' and self.rally_download is not None:
+            if self.rally_download.received(m.idx, m):
+                if self.rally_download.complete():
+                    self.rally_download_complete()
+                else:
+                    self.rally_download.check()
+        elif type in ['COMMAND_ACK']:
             if m.command == mavutil.mavlink.MAV_CMD_DO_GO_AROUND:
                 if (m.result == 0 and self.abort_ack_received == False):
                     self.say("Landing Abort Command Successfully Sent.")
@@ -296,17 +330,29 @@ class RallyModule(mp_module.MPModule):
             return None
         return p
 
+    def send_rally_request(self, i):
+        '''request one rally point'''
+        self.master.mav.rally_fetch_point_send(self.target_system,
+                                               self.target_component, i)
+
     def list_rally_points(self):
         self.rallyloader.clear()
         rally_count = self.mav_param.get('RALLY_TOTAL',0)
         if rally_count == 0:
             print("No rally points")
+            self.have_list = True
             return
-        for i in range(int(rally_count)):
-            p = self.fetch_rally_point(i)
-            if p is None:
-                return
+        self.rally_download = mp_mission.MissionDownload(int(rally_count), self.send_rally_request,
+                                                         name='rally points')
+        self.rally_download.check()
+
+    def rally_download_complete(self):
+        '''finish a rally point download'''
+        for p in self.rally_download.items:
             self.rallyloader.append_rally_point(p)
+        self.console.writeln("Downloaded %s" % self.rally_download.summary())
+        self.rally_download = None
+        self.have_list = True
 
         for i in range(self.rallyloader.rally_count()):
             p = self.rallyloader.rally_point(i)
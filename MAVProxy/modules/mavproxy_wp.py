@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 '''waypoint command handling'''
 
-import time, os, fnmatch, copy, platform
+import time, os, fnmatch, copy, platform, random
 from pymavlink import mavutil, mavwp
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_mission
+from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib.mp_settings import MPSetting
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import *
 
@@ -12,20 +15,48 @@ class WPModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(WPModule, self).__init__(mpstate, "wp", "waypoint handling", public = True)
         self.wp_op = None
-        self.wp_requested = {}
-        self.wp_received = {}
+        self.wp_download = None
+        self.wp_upload = None
+        # further (first, last) ranges to send after the current upload
+        self.wp_upload_queue = []
+        self.wp_request_int = False
+        self.wp_opaque_id = 0
+        # sampled sequence numbers and cached candidates while checking the cache
+        self.wp_verify = None
+        self.wp_cache = mp_mission.MissionCache(mp_util.dot_mavproxy('missioncache'))
+        if not hasattr(self.settings, 'missioncache'):
+            self.settings.append(MPSetting('missioncache', bool, True,
+                                           'Use a cached mission when the vehicle reports the same mission id'))
+        if not hasattr(self.settings, 'missioncachesample'):
+            self.settings.append(MPSetting('missioncachesample', bool, False,
+                                           'Heuristic: without a mission id, trust a cached mission if a few sampled items match'))
         self.wp_save_filename = None
         self.wploader = mavwp.MAVWPLoader()
         self.loading_waypoints = False
         self.loading_waypoint_lasttime = time.time()
         self.last_waypoint = 0
-        self.wp_period = mavutil.periodic_event(0.5)
         self.undo_wp = None
         self.undo_type = None
         self.undo_wp_idx = -1
         self.add_command('wp', self.cmd_wp,       'waypoint management',
-                         ["<list|clear|move|remove|loop|set|undo|movemulti|changealt|param|status>",
-                          "<load|update|save|show> (FILENAME)"])
+                         ["<list|clear|move|remove|loop|set|undo|movemulti|changealt|scalealt|terrainalt|param|status>",
+                          "<load|update|save|show> (FILENAME)",
+                          "survey <draw|set> (SURVEYSETTING)",
+                          "survey (FILENAME)"])
+        # camera and grid settings for wp survey. hfov is across track,
+        # overlap and sidelap are in percent, a negative bearing means
+        # along the longest edge of the polygon and a spacing of 0 means
+        # the photo interval when following terrain
+        self.survey_settings = mp_settings.MPSettings([("alt", float, 60.0),
+                                                       ("hfov", float, 60.0),
+                                                       ("vfov", float, 45.0),
+                                                       ("overlap", float, 70.0),
+                                                       ("sidelap", float, 30.0),
+                                                       ("bearing", float, -1.0),
+                                                       ("terrain", bool, False),
+                                                       ("spacing", float, 0.0)])
+        self.add_completion_function('(SURVEYSETTING)', self.survey_settings.completion)
+        self.elevation_model = None
 
         if self.continue_mode and self.logdir is not None:
             waytxt = os.path.join(mpstate.status.logdir, 'way.txt')
@@ -55,35 +86,131 @@ class WPModule(mp_module.MPModule):
                                          MPMenuItem('Loop', 'Loop', '# wp loop')])
 
 
-    def missing_wps_to_request(self):
-        ret = []
-        tnow = time.time()
-        next_seq = self.wploader.count()
-        for i in range(5):
-            seq = next_seq+i
-            if seq+1 > self.wploader.expected_count:
-                continue
-            if seq in self.wp_requested and tnow - self.wp_requested[seq] < 2:
-                continue
-            ret.append(seq)
-        return ret
-
-    def send_wp_requests(self, wps=None):
-        '''send some more WP requests'''
-        if wps is None:
-            wps = self.missing_wps_to_request()
-        tnow = time.time()
-        for seq in wps:
-            #print("REQUESTING %u/%u (%u)" % (seq, self.wploader.expected_count, i))
-            self.wp_requested[seq] = tnow
+    def send_wp_request(self, seq):
+        '''request one waypoint, using MISSION_REQUEST_INT if the vehicle supports it'''
+        if self.wp_request_int:
+            self.master.mav.mission_request_int_send(self.target_system, self.target_component, seq)
+        else:
             self.master.waypoint_request_send(seq)
 
     def wp_status(self):
         '''show status of wp download'''
-        try:
-            print("Have %u of %u waypoints" % (self.wploader.count()+len(self.wp_received), self.wploader.expected_count))
-        except Exception:
-            print("Have %u waypoints" % (self.wploader.count()+len(self.wp_received)))
+        if self.wp_download is not None:
+            print(str(self.wp_download))
+        else:
+            print("Have %u waypoints" % self.wploader.count())
+
+    def wp_cache_key(self):
+        '''return the cache key for the vehicle, or None if not known'''
+        if not self.settings.missioncache or self.master is None:
+            return None
+        m = self.master.messages.get('AUTOPILOT_VERSION', None)
+        if m is None:
+            return None
+        return mp_util.vehicle_key(m.get_srcSystem(), m)
+
+    def wp_cache_check(self, m):
+        '''see if the mission announced by a MISSION_COUNT is in the cache.
+        The cache is used when the mission id from the vehicle matches
+        exactly. Without a mission id, and only if the missioncachesample
+        heuristic is enabled, a few items are fetched and compared with
+        the cached missions of the same length. Returns True if the cache
+        was used or is being checked'''
+        key = self.wp_cache_key()
+        if key is None or m.count == 0:
+            return False
+        candidates = self.wp_cache.candidates(key, m.count)
+        if len(candidates) == 0:
+            return False
+        opaque_id = getattr(m, 'opaque_id', 0)
+        if opaque_id != 0:
+            for entry in candidates:
+                if entry['opaque_id'] == opaque_id:
+                    self.wp_cache_apply(entry)
+                    return True
+            return False
+        if not self.settings.missioncachesample:
+            # sampling can miss an edit to a single item
+            return False
+        samples = set([0, m.count-1])
+        samples.update(random.sample(range(m.count), min(m.count, 3)))
+        samples = sorted(samples)
+        self.wp_verify = (samples, candidates)
+        self.wp_download = mp_mission.MissionDownload(len(samples),
+                                                      lambda i: self.send_wp_request(samples[i]),
+                                                      name='sample waypoints')
+        self.wp_download.check()
+        return True
+
+    def wp_verify_complete(self):
+        '''compare the sampled waypoints with the cached missions'''
+        (samples, candidates) = self.wp_verify
+        items = {}
+        for i in range(len(samples)):
+            items[samples[i]] = self.wp_download.items[i]
+        count = candidates[0]['count']
+        self.wp_verify = None
+        self.wp_download = None
+        for entry in candidates:
+            if self.wp_cache.matches(entry, items):
+                self.wp_cache_apply(entry)
+                return
+        self.console.writeln("Mission has changed since it was cached")
+        self.wp_start_download(count)
+
+    def wp_cache_apply(self, entry):
+        '''use a cached mission'''
+        items = self.wp_cache.load(entry, self.target_system, self.target_component)
+        self.console.writeln("Loaded %u waypoints from cache" % len(items))
+        self.wp_op_complete(items)
+
+    def wp_cache_save(self, opaque_id=0):
+        '''save the current mission to the cache. Without a mission id
+        from the vehicle only the missioncachesample heuristic can use
+        the cache, so nothing is saved unless that is enabled'''
+        key = self.wp_cache_key()
+        if key is None or self.wploader.count() == 0:
+            return
+        if opaque_id == 0 and not self.settings.missioncachesample:
+            return
+        items = [self.wploader.wp(i) for i in range(self.wploader.count())]
+        self.wp_cache.save(key, items, opaque_id)
+
+    def wp_start_download(self, count):
+        '''start downloading count waypoints'''
+        self.wp_download = mp_mission.MissionDownload(count, self.send_wp_request, name='waypoints')
+        if count == 0:
+            self.wp_download_complete()
+        else:
+            self.wp_download.check()
+
+    def wp_download_complete(self):
+        '''finish a waypoint download'''
+        self.console.writeln("Downloaded %s" % self.wp_download.summary())
+        items = self.wp_download.items
+        self.wp_download = None
+        self.wp_op_complete(items)
+        self.wp_cache_save(self.wp_opaque_id)
+
+    def wp_op_complete(self, items):
+        '''install a received mission and finish the list or save operation'''
+        self.wploader.clear()
+        for w in items:
+            self.wploader.add(w)
+        if self.wp_op == 'list':
+            for i in range(self.wploader.count()):
+                w = self.wploader.wp(i)
+                print("%u %u %.10f %.10f %f p1=%.1f p2=%.1f p3=%.1f p4=%.1f cur=%u auto=%u" % (
+                    w.command, w.frame, w.x, w.y, w.z,
+                    w.param1, w.param2, w.param3, w.param4,
+                    w.current, w.autocontinue))
+            if self.logdir is not None:
+                waytxt = os.path.join(self.logdir, 'way.txt')
+                self.save_waypoints(waytxt)
+                print("Saved waypoints to %s" % waytxt)
+        elif self.wp_op == "save":
+            self.save_waypoints(self.wp_save_filename)
+        self.wp_op = None
 
     def mavlink_packet(self, m):
         '''handle an incoming mavlink packet'''
@@ -97,44 +224,41 @@ class WPModule(mp_module.MPModule):
                 self.console.writeln("Requesting %u waypoints t=%s now=%s" % (m.count,
                                                                                  time.asctime(time.localtime(m._timestamp)),
                                                                                  time.asctime()))
-                self.send_wp_requests()
-
-        elif mtype in ['WAYPOINT', 'MISSION_ITEM'] and self.wp_op is not None:
-            if m.seq < self.wploader.count():
-                #print("DUPLICATE %u" % m.seq)
+                self.wp_request_int = mp_mission.supports_mission_int(self.master)
+                self.wp_opaque_id = getattr(m, 'opaque_id', 0)
+                self.wp_verify = None
+                if not self.wp_cache_check(m):
+                    self.wp_start_download(m.count)
+
+        elif mtype in ['WAYPOINT', 'MISSION_ITEM', 'MISSION_ITEM_INT'] and self.wp_download is not None:
+            if mtype == 'MISSION_ITEM_INT':
+                m = mp_mission.item_from_int(m)
+            if self.wp_verify is not None:
+                samples = self.wp_verify[0]
+                if not m.seq in samples:
+                    return
+                idx = samples.index(m.seq)
+            elif m.seq >= self.wp_download.count:
+                self.console.writeln("Unexpected waypoint number %u - expected %u" % (m.seq, self.wp_download.count))
                 return
-            if m.seq+1 > self.wploader.expected_count:
-                self.console.writeln("Unexpected waypoint number %u - expected %u" % (m.seq, self.wploader.count()))
-            self.wp_received[m.seq] = m
-            next_seq = self.wploader.count()
-            while next_seq in self.wp_received:
-                m = self.wp_received.pop(next_seq)
-                self.wploader.add(m)
-                next_seq += 1
-            if self.wploader.count() != self.wploader.expected_count:
-                #print("m.seq=%u expected_count=%u" % (m.seq, self.wploader.expected_count))
-                self.send_wp_requests()
+            else:
+                idx = m.seq
+            if not self.wp_download.received(idx, m):
                 return
-            if self.wp_op == 'list':
-                for i in range(self.wploader.count()):
-                    w = self.wploader.wp(i)
-                    print("%u %u %.10f %.10f %f p1=%.1f p2=%.1f p3=%.1f p4=%.1f cur=%u auto=%u" % (
-                        w.command, w.frame, w.x, w.y, w.z,
-                        w.param1, w.param2, w.param3, w.param4,
-                        w.current, w.autocontinue))
-                if self.logdir is not None:
-                    waytxt = os.path.join(self.logdir, 'way.txt')
-                    self.save_waypoints(waytxt)
-                    print("Saved waypoints to %s" % waytxt)
-            elif self.wp_op == "save":
-                self.save_waypoints(self.wp_save_filename)
-            self.wp_op = None
-            self.wp_requested = {}
-            self.wp_received = {}
-
-        elif mtype in ["WAYPOINT_REQUEST", "MISSION_REQUEST"]:
+            if not self.wp_download.complete():
+                self.wp_download.check()
+            elif self.wp_verify is not None:
+                self.wp_verify_complete()
+            else:
+                self.wp_download_complete()
+
+        elif mtype in ["WAYPOINT_REQUEST", "MISSION_REQUEST", "MISSION_REQUEST_INT"]:
             self.process_waypoint_request(m, self.master)
 
+        elif mtype == "MISSION_ACK" and self.wp_upload is not None:
+            if self.wp_upload.handle_ack(m):
+                self.wp_upload_complete()
+
         elif mtype in ["WAYPOINT_CURRENT", "MISSION_CURRENT"]:
             if m.seq != self.last_waypoint:
                 self.last_waypoint = m.seq
@@ -155,12 +279,26 @@ class WPModule(mp_module.MPModule):
 
     def idle_task(self):
         '''handle missing waypoints'''
-        if self.wp_period.trigger():
-            # cope with packet loss fetching mission
-            if self.master is not None and self.master.time_since('MISSION_ITEM') >= 2 and self.wploader.count() < getattr(self.wploader,'expected_count',0):
-                wps = self.missing_wps_to_request();
-                print("re-requesting WPs %s" % str(wps))
-                self.send_wp_requests(wps)
+        if self.wp_download is not None and self.master is not None:
+            # re-request lost waypoints and report progress
+            if self.wp_download.failed():
+                self.console.error("Waypoint download failed: %s" % self.wp_download.summary())
+                self.wp_download = None
+                self.wp_verify = None
+                self.wp_op = None
+            else:
+                self.wp_download.check()
+                msg = self.wp_download.report()
+                if msg is not None:
+                    self.console.writeln(msg)
+        if self.wp_upload is not None and self.master is not None:
+            self.wp_upload.check()
+            if self.wp_upload.finished:
+                self.wp_upload_complete()
+            else:
+                msg = self.wp_upload.report()
+                if msg is not None:
+                    self.console.writeln(msg)
         if self.module('console') is not None and not self.menu_added_console:
             self.menu_added_console = True
             self.module('console').add_menu(self.menu)
@@ -170,6 +308,11 @@ class WPModule(mp_module.MPModule):
 
     def process_waypoint_request(self, m, master):
         '''process a waypoint request from the master'''
+        if self.wp_upload is not None:
+            if not self.wp_upload.handle_request(m.seq):
+                self.console.error("Request for bad waypoint %u" % m.seq)
+            return
+        # uploads started outside this module, such as by the mission editor
         if (not self.loading_waypoints or
             time.time() > self.loading_waypoint_lasttime + 10.0):
             self.loading_waypoints = False
@@ -188,14 +331,85 @@ class WPModule(mp_module.MPModule):
             self.loading_waypoints = False
             self.console.writeln("Sent all %u waypoints" % self.wploader.count())
 
+    def upload_waypoints(self, start=0, end=None):
+        '''send waypoints start to end to the vehicle, or the whole mission
+        if end is None. The items are built up front and the vehicle's
+        requests are answered from them by a MissionUpload'''
+        if end is None:
+            count = self.wploader.count()
+            restart = lambda: self.master.waypoint_count_send(count)
+            end = count - 1
+        else:
+            restart = lambda: self.master.mav.mission_write_partial_list_send(self.target_system,
+                                                                              self.target_component,
+                                                                              start, end)
+        items = [self.wploader.wp(i) for i in range(start, min(end, self.wploader.count()-1)+1)]
+        items = mp_mission.build_upload_items(items, self.target_system, self.target_component,
+                                              mp_mission.supports_mission_int(self.master))
+        self.wp_upload = mp_mission.MissionUpload(items, self.master.mav.send, restart,
+                                                  first=start, name='waypoints')
+        self.loading_waypoints = True
+        self.loading_waypoint_lasttime = time.time()
+        restart()
+
+    def wp_upload_complete(self):
+        '''finish a waypoint upload'''
+        upload = self.wp_upload
+        self.wp_upload = None
+        self.loading_waypoints = False
+        if upload.result == mavutil.mavlink.MAV_MISSION_ACCEPTED:
+            self.console.writeln("Sent %s" % upload.summary())
+            if len(self.wp_upload_queue) > 0:
+                (first, last) = self.wp_upload_queue.pop(0)
+                self.upload_waypoints(first, last)
+                return
+            # the vehicle now has our mission
+            self.wp_cache_save(upload.opaque_id)
+        else:
+            self.console.error("Waypoint upload failed: %s after %s" % (upload.result_name(), upload.summary()))
+            self.wp_upload_queue = []
+
+    def upload_ranges(self, ranges):
+        '''send a list of (first, last) ranges of changed waypoints as a
+        series of partial uploads'''
+        if len(ranges) == 0:
+            return
+        self.wp_upload_queue = ranges[1:]
+        self.upload_waypoints(ranges[0][0], ranges[0][1])
+
+    def get_elevation(self, lat, lon):
+        '''ground height from the console elevation map, or None'''
+        elevation = getattr(self.console, 'ElevationMap', None)
+        if elevation is None:
+            return None
+        return elevation.GetElevation(lat, lon)
+
+    def mission_array(self):
+        '''return the mission as a MissionArray for bulk edits'''
+        from MAVProxy.modules.lib import mp_missionarray
+        self.wploader.target_system = self.target_system
+        self.wploader.target_component = self.target_component
+        return mp_missionarray.MissionArray(self.wploader)
+
+    def parse_range(self, args):
+        '''parse WPSTART WPEND arguments, returning (start, end) or None'''
+        try:
+            start = int(args[0])
+            end = int(args[1])
+        except ValueError:
+            print("Invalid waypoint range")
+            return None
+        if start < 1 or end >= self.wploader.count() or start > end:
+            print("Invalid waypoint range %u:%u" % (start, end))
+            return None
+        return (start, end)
+
     def send_all_waypoints(self):
         '''send all waypoints to vehicle'''
         self.master.waypoint_clear_all_send()
         if self.wploader.count() == 0:
             return
-        self.loading_waypoints = True
-        self.loading_waypoint_lasttime = time.time()
-        self.master.waypoint_count_send(self.wploader.count())
+        self.upload_waypoints()
 
     def load_waypoints(self, filename):
         '''load waypoints from a file'''
@@ -230,17 +444,13 @@ class WPModule(mp_module.MPModule):
         else:
             print("Loaded updated waypoint %u from %s" % (wpnum, filename))
 
-        self.loading_waypoints = True
-        self.loading_waypoint_lasttime = time.time()
         if wpnum == -1:
             start = 0
             end = self.wploader.count()-1
         else:
             start = wpnum
             end = wpnum
-        self.master.mav.mission_write_partial_list_send(self.target_system,
-                                                             self.target_component,
-                                                             start, end)
+        self.upload_waypoints(start, end)
 
     def save_waypoints(self, filename):
         '''save waypoints to a file'''
@@ -299,6 +509,113 @@ class WPModule(mp_module.MPModule):
             self.wploader.add_latlonalt(p[0], p[1], self.settings.wpalt, terrain_alt=use_terrain)
         self.send_all_waypoints()
 
+    def survey_elevation(self):
+        '''return a function giving the ground height at a point'''
+        elevation = getattr(self.console, 'ElevationMap', None)
+        if elevation is None:
+            if self.elevation_model is None:
+                from MAVProxy.modules.mavproxy_map import mp_elevation
+                self.elevation_model = mp_elevation.ElevationModel()
+            elevation = self.elevation_model
+        return elevation.GetElevation
+
+    def survey_polygon(self, polygon):
+        '''replace the mission with a survey grid over a polygon'''
+        from MAVProxy.modules.lib import mp_survey
+        import numpy
+        if len(polygon) < 3:
+            print("Need at least 3 points for a survey")
+            return
+        home = self.get_home()
+        if home is None:
+            print("Need home location for survey - please run gethome")
+            return
+        settings = self.survey_settings
+        t0 = time.time()
+        (width, length) = mp_survey.camera_footprint(settings.alt, settings.hfov, settings.vfov)
+        lane_spacing = width * (1 - settings.sidelap*0.01)
+        trigger_dist = length * (1 - settings.overlap*0.01)
+        if lane_spacing <= 0 or trigger_dist <= 0:
+            print("Invalid survey overlap")
+            return
+        bearing = settings.bearing
+        if bearing < 0:
+            bearing = mp_survey.longest_edge_bearing(polygon)
+        frame = self.get_default_frame()
+        # in a terrain frame the vehicle follows the ground itself
+        follow_terrain = settings.terrain and frame != mavutil.mavlink.MAV_FRAME_GLOBAL_TERRAIN_ALT
+        point_spacing = None
+        if settings.spacing > 0:
+            point_spacing = settings.spacing
+        elif follow_terrain:
+            point_spacing = trigger_dist
+        (lat, lon) = mp_survey.survey_grid(polygon, lane_spacing, bearing, point_spacing)
+        if len(lat) == 0:
+            print("Survey area too small")
+            return
+
+        alt = numpy.ones(len(lat)) * settings.alt
+        if follow_terrain:
+            get_elevation = self.survey_elevation()
+            home_ground = get_elevation(home.x, home.y)
+            if home_ground is None:
+                print("No elevation data for home")
+                return
+            ground = mp_survey.ground_heights(lat, lon, get_elevation)
+            missing = numpy.count_nonzero(numpy.isnan(ground))
+            if missing > 0:
+                # points left at home relative altitude could hit rising ground
+                print("No elevation data for %u of %u survey points - survey not created" % (
+                    missing, len(ground)))
+                return
+            alt += ground - home_ground
+
+        self.wploader.clear()
+        self.wploader.target_system = self.target_system
+        self.wploader.target_component = self.target_component
+        self.wploader.add(home)
+        mission_item = mavutil.mavlink.MAVLink_mission_item_message
+        self.wploader.add(mission_item(self.target_system, self.target_component, 0,
+                                       frame, mavutil.mavlink.MAV_CMD_DO_SET_CAM_TRIGG_DIST,
+                                       0, 1, trigger_dist, 0, 0, 0, 0, 0, 0))
+        for i in range(len(lat)):
+            self.wploader.add(mission_item(self.target_system, self.target_component, 0,
+                                           frame, mavutil.mavlink.MAV_CMD_NAV_WAYPOINT,
+                                           0, 1, 0, 0, 0, 0,
+                                           float(lat[i]), float(lon[i]), float(alt[i])))
+        self.wploader.add(mission_item(self.target_system, self.target_component, 0,
+                                       frame, mavutil.mavlink.MAV_CMD_DO_SET_CAM_TRIGG_DIST,
+                                       0, 1, 0, 0, 0, 0, 0, 0, 0))
+        print("Survey of %u points, lanes %.1fm apart at bearing %.0f, photos every %.1fm (%.2fs)" % (
+            len(lat), lane_spacing, bearing, trigger_dist, time.time() - t0))
+        self.send_all_waypoints()
+
+    def survey_draw_callback(self, points):
+        '''callback from drawing a survey area'''
+        self.survey_polygon(points)
+
+    def cmd_wp_survey(self, args):
+        '''handle wp survey'''
+        usage = "usage: wp survey <draw|set|FILENAME>"
+        if len(args) < 1:
+            print(usage)
+            return
+        if args[0] == "set":
+            self.survey_settings.command(args[1:])
+        elif args[0] == "draw":
+            if not 'draw_lines' in self.mpstate.map_functions:
+                print("No map drawing available")
+                return
+            self.mpstate.map_functions['draw_lines'](self.survey_draw_callback)
+            print("Drawing survey area on map")
+        else:
+            try:
+                polygon = mp_util.polygon_load(args[0].strip('"'))
+            except Exception as msg:
+                print("Unable to load %s - %s" % (args[0], msg))
+                return
+            self.survey_polygon(polygon)
+
     def wp_loop(self):
         '''close the loop on a mission'''
         loader = self.wploader
@@ -312,9 +629,7 @@ class WPModule(mp_module.MPModule):
         wp = mavutil.mavlink.MAVLink_mission_item_message(0, 0, 0, 0, mavutil.mavlink.MAV_CMD_DO_JUMP,
                                                           0, 1, 1, -1, 0, 0, 0, 0, 0)
         loader.add(wp)
-        self.loading_waypoints = True
-        self.loading_waypoint_lasttime = time.time()
-        self.master.waypoint_count_send(self.wploader.count())
+        self.upload_waypoints()
         print("Closed loop on mission")
 
     def set_home_location(self):
@@ -332,11 +647,7 @@ class WPModule(mp_module.MPModule):
         w.x = lat
         w.y = lon
         self.wploader.set(w, 0)
-        self.loading_waypoints = True
-        self.loading_waypoint_lasttime = time.time()
-        self.master.mav.mission_write_partial_list_send(self.target_system,
-                                                             self.target_component,
-                                                             0, 0)
+        self.upload_waypoints(0, 0)
 
 
     def cmd_wp_move(self, args):
@@ -374,12 +685,8 @@ class WPModule(mp_module.MPModule):
 
         wp.target_system    = self.target_system
         wp.target_component = self.target_component
-        self.loading_waypoints = True
-        self.loading_waypoint_lasttime = time.time()
-        self.master.mav.mission_write_partial_list_send(self.target_system,
-                                                        self.target_component,
-                                                        idx, idx)
         self.wploader.set(wp, idx)
+        self.upload_waypoints(idx, idx)
         print("Moved WP %u to %f, %f at %.1fm" % (idx, lat, lon, wp.z))
 
 
@@ -427,33 +734,16 @@ class WPModule(mp_module.MPModule):
         distance = mp_util.gps_distance(wp.x, wp.y, lat, lon)
         bearing  = mp_util.gps_bearing(wp.x, wp.y, lat, lon)
 
-        for wpnum in range(wpstart, wpend+1):
-            wp = self.wploader.wp(wpnum)
-            if not self.wploader.is_location_command(wp.command):
-                continue
-            (newlat, newlon) = mp_util.gps_newpos(wp.x, wp.y, bearing, distance)
-            if wpnum != idx and rotation != 0:
-                # add in rotation
-                d2 = mp_util.gps_distance(lat, lon, newlat, newlon)
-                b2 = mp_util.gps_bearing(lat, lon, newlat, newlon)
-                (newlat, newlon) = mp_util.gps_newpos(lat, lon, b2+rotation, d2)
-
-            if getattr(self.console, 'ElevationMap', None) is not None and wp.frame != mavutil.mavlink.MAV_FRAME_GLOBAL_TERRAIN_ALT:
-                alt1 = self.console.ElevationMap.GetElevation(newlat, newlon)
-                alt2 = self.console.ElevationMap.GetElevation(wp.x, wp.y)
-                if alt1 is not None and alt2 is not None:
-                    wp.z += alt1 - alt2
-            wp.x = newlat
-            wp.y = newlon
-            wp.target_system    = self.target_system
-            wp.target_component = self.target_component
-            self.wploader.set(wp, wpnum)
-
-        self.loading_waypoints = True
-        self.loading_waypoint_lasttime = time.time()
-        self.master.mav.mission_write_partial_list_send(self.target_system,
-                                                        self.target_component,
-                                                        wpstart, wpend+1)
+        marr = self.mission_array()
+        mask = marr.select(wpstart, wpend)
+        marr.translate(mask, bearing, distance)
+        if rotation != 0:
+            # add in rotation about the moved WPNUM
+            mask[idx] = False
+            marr.rotate(mask, lat, lon, rotation)
+            mask[idx] = True
+        marr.terrain_adjust(mask, self.get_elevation)
+        self.upload_ranges(marr.apply())
         print("Moved WPs %u:%u to %f, %f rotation=%.1f" % (wpstart, wpend, lat, lon, rotation))
 
 
@@ -472,22 +762,54 @@ class WPModule(mp_module.MPModule):
         else:
             count = 1
 
-        for wpnum in range(idx, idx+count):
-            wp = self.wploader.wp(wpnum)
-            if not self.wploader.is_location_command(wp.command):
-                continue
-            wp.z = newalt
-            wp.target_system    = self.target_system
-            wp.target_component = self.target_component
-            self.wploader.set(wp, wpnum)
-
-        self.loading_waypoints = True
-        self.loading_waypoint_lasttime = time.time()
-        self.master.mav.mission_write_partial_list_send(self.target_system,
-                                                        self.target_component,
-                                                        idx, idx+count)
+        marr = self.mission_array()
+        marr.set_alt(marr.select(idx, idx+count-1), newalt)
+        self.upload_ranges(marr.apply())
         print("Changed alt for WPs %u:%u to %f" % (idx, idx+(count-1), newalt))
 
+    def cmd_wp_scalealt(self, args):
+        '''handle wp scaling of the altitude of multiple waypoints'''
+        if len(args) < 3:
+            print("usage: wp scalealt WPSTART WPEND SCALE <OFFSET>")
+            return
+        r = self.parse_range(args)
+        if r is None:
+            return
+        scale = float(args[2])
+        if len(args) > 3:
+            offset = float(args[3])
+        else:
+            offset = 0.0
+        marr = self.mission_array()
+        marr.scale_alt(marr.select(r[0], r[1]), scale, offset)
+        ranges = marr.apply()
+        self.upload_ranges(ranges)
+        print("Scaled alt for WPs %u:%u by %.2f%+.1f (%u ranges changed)" % (r[0], r[1], scale, offset, len(ranges)))
+
+    def cmd_wp_terrainalt(self, args):
+        '''handle wp setting multiple waypoints to a height above terrain'''
+        if len(args) < 3:
+            print("usage: wp terrainalt WPSTART WPEND AGL")
+            return
+        r = self.parse_range(args)
+        if r is None:
+            return
+        agl = float(args[2])
+        home = self.get_home()
+        if home is None:
+            print("Need home location - please run gethome")
+            return
+        home_elevation = self.get_elevation(home.x, home.y)
+        if home_elevation is None:
+            print("No elevation data available")
+            return
+        marr = self.mission_array()
+        missing = marr.terrain_alt(marr.select(r[0], r[1]), agl, self.get_elevation, home_elevation)
+        ranges = marr.apply()
+        self.upload_ranges(ranges)
+        print("Set WPs %u:%u to %.1fm above terrain (%u ranges changed, %u without elevation)" % (
+            r[0], r[1], agl, len(ranges), missing))
+
     def cmd_wp_remove(self, args):
         '''handle wp remove'''
         if len(args) != 1:
@@ -517,12 +839,8 @@ class WPModule(mp_module.MPModule):
         if self.undo_type == 'move':
             wp.target_system    = self.target_system
             wp.target_component = self.target_component
-            self.loading_waypoints = True
-            self.loading_waypoint_lasttime = time.time()
-            self.master.mav.mission_write_partial_list_send(self.target_system,
-                                                            self.target_component,
-                                                            self.undo_wp_idx, self.undo_wp_idx)
             self.wploader.set(wp, self.undo_wp_idx)
+            self.upload_waypoints(self.undo_wp_idx, self.undo_wp_idx)
             print("Undid WP move")
         elif self.undo_type == 'remove':
             self.wploader.insert(self.undo_wp_idx, wp)
@@ -561,17 +879,13 @@ class WPModule(mp_module.MPModule):
 
         wp.target_system    = self.target_system
         wp.target_component = self.target_component
-        self.loading_waypoints = True
-        self.loading_waypoint_lasttime = time.time()
-        self.master.mav.mission_write_partial_list_send(self.target_system,
-                                                        self.target_component,
-                                                        idx, idx)
         self.wploader.set(wp, idx)
+        self.upload_waypoints(idx, idx)
         print("Set param %u for %u to %f" % (pnum, idx, param[pnum-1]))
 
     def cmd_wp(self, args):
         '''waypoint commands'''
-        usage = "usage: wp <editor|list|load|update|save|set|clear|loop|remove|move|movemulti|changealt>"
+        usage = "usage: wp <editor|list|load|update|save|set|clear|loop|remove|move|movemulti|changealt|scalealt|terrainalt|survey>"
         if len(args) < 1:
             print(usage)
             return
@@ -616,6 +930,12 @@ class WPModule(mp_module.MPModule):
             self.cmd_wp_movemulti(args[1:])
         elif args[0] == "changealt":
             self.cmd_wp_changealt(args[1:])
+        elif args[0] == "scalealt":
+            self.cmd_wp_scalealt(args[1:])
+        elif args[0] == "terrainalt":
+            self.cmd_wp_terrainalt(args[1:])
+        elif args[0] == "survey":
+            self.cmd_wp_survey(args[1:])
         elif args[0] == "param":
             self.cmd_wp_param(args[1:])
         elif args[0] == "remove":
@@ -21,7 +21,8 @@ from math import *
 from MAVProxy.modules.lib import rline
 from MAVProxy.modules.lib import wxconsole
 from MAVProxy.modules.lib.graph_ui import Graph_UI
-from MAVProxy.modules.lib import mavmemlog
+from MAVProxy.modules.lib import mavcolumnlog
+from MAVProxy.modules.lib.graphcache import SeriesCache
 from pymavlink.mavextra import *
 from MAVProxy.modules.lib.mp_menu import *
 import MAVProxy.modules.lib.mp_util as mp_util
@@ -57,11 +58,13 @@ class MEState(object):
               MPSetting('linestyle', str, None, 'linestyle'),
               MPSetting('show_flightmode', bool, True, 'show flightmode'),
               MPSetting('legend', str, 'upper left', 'legend position'),
-              MPSetting('legend2', str, 'upper right', 'legend2 position')
+              MPSetting('legend2', str, 'upper right', 'legend2 position'),
+              MPSetting('graph_cache_mb', int, 256, 'graph cache size (MB)')
               ]
             )
 
         self.mlog = None
+        self.series_cache = SeriesCache()
         self.command_map = command_map
         self.completions = {
             "set"       : ["(SETTING)"],
@@ -283,6 +286,7 @@ def cmd_graph(args):
     else:
         expression = ' '.join(args)
         mestate.last_graph = GraphDefinition('Untitled', expression, '', [expression], None)
+    mestate.series_cache.max_bytes = mestate.settings.graph_cache_mb * 1024 * 1024
     grui.append(Graph_UI(mestate))
     grui[-1].display_graph(mestate.last_graph)
 
@@ -444,10 +448,10 @@ def loadfile(args):
     '''load a log file (path given by arg)'''
     mestate.console.write("Loading %s...\n" % args)
     t0 = time.time()
-    mlog = mavutil.mavlink_connection(args, notimestamps=False,
-                                      zero_time_base=False)
-    mestate.mlog = mavmemlog.mavmemlog(mlog, progress_bar)
-    mestate.status.msgs = mlog.messages
+    mestate.series_cache.clear()
+    mestate.mlog = mavcolumnlog.load(args, progress_bar, notimestamps=False,
+                                     zero_time_base=False)
+    mestate.status.msgs = mestate.mlog.last_messages()
     t1 = time.time()
     mestate.console.write("\ndone (%u messages in %.1fs)\n" % (mestate.mlog._count, t1-t0))
 